@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Benchmark the parallel disseminators against the DefaultDisseminator.
+
+This makes the package of a number of files of the given size in each of the ways the disseminators do (the
+DefaultDisseminator's zip, which is stored rather than compressed; the same zip deflated in a single thread; and the
+zip and tar.gz of the ParallelZipDisseminator and ParallelTarGzDisseminator with increasing numbers of workers), and
+reports the throughput and the size of each package.  The content is made-up text, which compresses about as well as
+typical documents do, and is generated as it is read so that the disk does not come into it.
+
+Run from the root of the repository:
+
+    python benchmarks/package_compression.py [--size MB] [--files N] [--level 0-9] [--workers N]
+"""
+import os, sys, time, random
+from functools import partial
+from multiprocessing import cpu_count
+from optparse import OptionParser
+from zipfile import ZIP_DEFLATED
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sss"))
+from ingesters_disseminators import ZipStream, ParallelZipStream, TarStream, ParallelGzipStream
+
+CHUNK_SIZE = 65536
+
+class TextStream(object):
+    """ A read-only stream of the given size, of made-up text which is repeated every megabyte """
+    words = ["sword", "deposit", "container", "statement", "package", "metadata", "atom", "entry", "collection",
+                "the", "of", "and", "a", "to", "in", "is", "repository", "content", "resource", "media"]
+
+    def __init__(self, size):
+        self.remaining = size
+        r = random.Random(size)
+        self.block = " ".join([r.choice(self.words) for i in range(200000)])[:1048576]
+        self.position = 0
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        parts = []
+        while n > 0:
+            part = self.block[self.position:self.position + n]
+            parts.append(part)
+            n -= len(part)
+            self.remaining -= len(part)
+            self.position = (self.position + len(part)) % len(self.block)
+        return "".join(parts)
+
+    def close(self):
+        pass
+
+def run(make_stream):
+    """ the seconds it takes to read the whole package, and its size """
+    start = time.time()
+    stream = make_stream()
+    size = 0
+    try:
+        while True:
+            data = stream.read(CHUNK_SIZE)
+            if not data:
+                break
+            size += len(data)
+    finally:
+        stream.close()
+    return time.time() - start, size
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--size", type="int", default=64, help="size of each file in MB (default 64)")
+    parser.add_option("--files", type="int", default=4, help="number of files in the package (default 4)")
+    parser.add_option("--level", type="int", default=6, help="package_compression_level (default 6)")
+    parser.add_option("--workers", type="int", default=cpu_count(), help="most workers to try (default: the number of CPUs)")
+    options, args = parser.parse_args()
+
+    size = options.size * 1024 * 1024
+    total = options.size * options.files
+    files = [("file%d.txt" % i, partial(TextStream, size), size) for i in range(options.files)]
+    workers = [1]
+    while workers[-1] * 2 <= options.workers:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != options.workers:
+        workers.append(options.workers)
+
+    packagers = [
+        ("default zip", "-", lambda: ZipStream(files, chunk_size=CHUNK_SIZE)),
+        ("deflated zip", "-", lambda: ZipStream(files, ZIP_DEFLATED, chunk_size=CHUNK_SIZE))
+    ]
+    for n in workers:
+        packagers.append(("parallel zip", n, partial(lambda n: ParallelZipStream(files, options.level, n, chunk_size=CHUNK_SIZE), n)))
+    for n in workers:
+        packagers.append(("parallel tar.gz", n, partial(lambda n: ParallelGzipStream(TarStream(files, CHUNK_SIZE), options.level, n), n)))
+
+    print "%d files of %d MB, compression level %d, %d CPUs" % (options.files, options.size, options.level, cpu_count())
+    print "%-16s %8s %10s %10s %10s" % ("packager", "workers", "seconds", "MB/s", "ratio")
+    for label, n, make_stream in packagers:
+        elapsed, package_size = run(make_stream)
+        print "%-16s %8s %10.2f %10.1f %10.3f" % (label, n, elapsed, total / elapsed, package_size / float(size * options.files))
+
+if __name__ == "__main__":
+    main()
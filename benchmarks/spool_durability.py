@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Benchmark the upload spool under each of the spool_durability modes.
+
+For each mode this spools a number of concurrent uploads of the given size into a temp directory (the same code path
+that the web front ends use for incoming deposits) and reports the upload throughput.  The fixed chunk size that was
+used before max_copy_chunk_size was introduced is also measured, so the effect of the adaptive chunk size can be seen.
+
+Run from the root of the repository:
+
+    python benchmarks/spool_durability.py [--size MB] [--concurrency N] [--dir /path/on/the/disk/to/test]
+"""
+import os, sys, time, shutil, tempfile, threading
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sss"))
+from spool import spool_to_tmp, DURABILITY_MODES, DEFAULT_CHUNK_SIZE
+
+class PatternStream(object):
+    """ A read-only stream of the given size, which behaves like wsgi.input without taking up any memory """
+    def __init__(self, size):
+        self.remaining = size
+        self.block = "x" * 65536
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        self.remaining -= n
+        if n <= len(self.block):
+            return self.block[:n]
+        return self.block * (n // len(self.block)) + self.block[:n % len(self.block)]
+
+def run(tmp_dir, size, concurrency, durability, chunk_size, max_chunk_size):
+    def upload():
+        fn, writer = spool_to_tmp(PatternStream(size), tmp_dir, size, chunk_size, max_chunk_size, durability)
+        os.remove(fn)
+
+    threads = [threading.Thread(target=upload) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--size", type="int", default=64, help="size of each upload in MB (default 64)")
+    parser.add_option("--concurrency", type="int", default=4, help="number of concurrent uploads (default 4)")
+    parser.add_option("--max-chunk-size", type="int", default=1048576, help="max_copy_chunk_size in bytes (default 1048576)")
+    parser.add_option("--dir", default=None, help="directory to spool into (default: a new temp directory)")
+    options, args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=options.dir)
+    size = options.size * 1024 * 1024
+    total = options.size * options.concurrency
+    try:
+        print "%d concurrent uploads of %d MB, spooled to %s" % (options.concurrency, options.size, tmp_dir)
+        print "%-14s %-12s %10s %10s" % ("durability", "chunking", "seconds", "MB/s")
+        for durability in DURABILITY_MODES:
+            for label, max_chunk_size in [("fixed", None), ("adaptive", options.max_chunk_size)]:
+                elapsed = run(tmp_dir, size, options.concurrency, durability, DEFAULT_CHUNK_SIZE, max_chunk_size)
+                print "%-14s %-12s %10.2f %10.1f" % (durability, label, elapsed, total / elapsed)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+Caches of the objects which are expensive to make from what is in the store, such as parsed Statements.
+
+Each entry is stored with a validator (for a container, its version; see DAO.get_version), and is only returned to
+a caller which presents the same validator, so an entry for a container which has since been changed (by this
+process or any other) is never used, and is simply replaced when the new state is read.
+
+There are two tiers: an LRUCache is held in the memory of one process, and a SharedCache is held in a SQLite
+database file which every process on the host that opens the same file shares, so that what one worker has read or
+written is there for all the others.  The dissemination packages of the containers, which are files rather than
+strings, are kept in a PackageCache directory on the local disk instead.
+"""
+import os, errno, hashlib, sqlite3, threading, time, uuid
+from collections import OrderedDict
+
+from spool import remove_quietly
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+class LRUCache(object):
+    """
+    A thread safe map of at most size entries, which forgets the least recently used entry to make room for a new
+    one, and counts its hits and misses.  A size of 0 turns it off
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (validator, value), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, validator):
+        """ The value cached for the key, if it was cached with the same validator, otherwise None """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] != validator:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, validator, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            if self.size <= 0:
+                return
+            self._entries[key] = (validator, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            while len(self._entries) > max(size, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ The size, number of entries, hits and misses of the cache """
+        with self._lock:
+            return {"size" : self.size, "entries" : len(self._entries), "hits" : self.hits, "misses" : self.misses}
+
+class SharedCache(object):
+    """
+    A cache of strings in a SQLite database file, shared by every process (and thread) which opens the same file.
+    Once it holds more than size entries, those written longest ago are removed.  It is only a cache, so if the
+    database cannot be used for any reason, that is logged and treated as a miss.  The hits and misses are those of
+    this process
+    """
+    # how many puts there are between checks on the number of entries
+    TRIM_EVERY = 100
+
+    def __init__(self, path, size):
+        self.path = os.path.abspath(path)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()     # a connection for each thread, as they cannot be shared
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            # a connection cannot be used by a process forked from the one which opened it either
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # autocommit, and write ahead logging so that readers do not wait for writers
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.text_factory = str
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, validator TEXT, value BLOB, written REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_written ON entries (written)")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _execute(self, sql, args=()):
+        """ run the statement, returning its rows, or None if the database could not be used """
+        try:
+            return self._db().execute(sql, args).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            ssslog.warn("The shared cache in " + self.path + " could not be used: " + str(e))
+            return None
+
+    def get(self, key, validator):
+        """ The value cached for the key, if it was cached with the same validator, otherwise None """
+        rows = self._execute("SELECT validator, value FROM entries WHERE key = ?", (key,))
+        if not rows or rows[0][0] != validator:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return str(rows[0][1])
+
+    def put(self, key, validator, value):
+        if self.size <= 0:
+            return
+        self._execute("INSERT OR REPLACE INTO entries (key, validator, value, written) VALUES (?, ?, ?, ?)",
+                        (key, validator, sqlite3.Binary(value), time.time()))
+        self._puts += 1
+        if self._puts % self.TRIM_EVERY == 0:
+            self.trim()
+
+    def discard(self, key):
+        self._execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def trim(self):
+        """ Remove the entries written longest ago, until there are no more than size """
+        rows = self._execute("SELECT COUNT(*) FROM entries")
+        if rows and rows[0][0] > self.size:
+            self._execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY written LIMIT ?)",
+                            (rows[0][0] - self.size,))
+
+    def stats(self):
+        """ The size, number of entries, and this process's hits and misses of the cache """
+        rows = self._execute("SELECT COUNT(*) FROM entries")
+        return {"size" : self.size, "entries" : rows[0][0] if rows else None, "hits" : self.hits, "misses" : self.misses}
+
+class PackageCache(object):
+    """
+    A directory of the dissemination packages of containers (see DisseminationPackager), each kept for the version of
+    the container and the format it was made in, so that a package is only made again once its container has
+    changed.  A new package replaces those made from earlier versions of the container; otherwise packages are
+    removed once they have not been used for max_age seconds, and those used longest ago are removed whenever the
+    packages take up more than size bytes.  Like the other caches, it is only a cache, so if the directory cannot be
+    used that is logged and treated as a miss
+    """
+    # how many puts there are between checks on the size and age of the packages
+    TRIM_EVERY = 20
+
+    def __init__(self, path, size, max_age):
+        self.path = os.path.abspath(path)
+        self.size = size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+    def _dir(self, collection, id):
+        digest = hashlib.md5(collection + "/" + id).hexdigest()
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _path(self, collection, id, version, format):
+        return os.path.join(self._dir(collection, id), version + "." + hashlib.md5(format or "").hexdigest())
+
+    def get(self, collection, id, version, format):
+        """ An open handle on the package made in the format from the version of the container, or None """
+        path = self._path(collection, id, version, format)
+        try:
+            f = open(path, "rb")
+            # the age of a package is the time since it was last used
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return f
+
+    def put(self, collection, id, version, format, stream):
+        """
+        Keep the package in the stream, as made in the format from the version of the container, as it is read.
+        Returns the stream handle to read it from instead, which keeps it once it has been read to the end (so a
+        package which is made as it is sent can be kept too, and one whose response is abandoned part way is not),
+        or the stream itself if the package cannot be kept
+        """
+        path = self._path(collection, id, version, format)
+        directory = os.path.dirname(path)
+        # written to a temp file and renamed into place, so that a request for the same package never sees it half
+        # written, however many are making it at once
+        tmp_path = os.path.join(directory, "sss_tmp." + str(uuid.uuid4()))
+        try:
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            f = open(tmp_path, "wb")
+        except (IOError, OSError) as e:
+            ssslog.warn("The package cache in " + self.path + " could not be used: " + str(e))
+            return stream
+        return _KeepingStream(self, stream, f, tmp_path, path, version)
+
+    def _kept(self, path, version):
+        """ the package has been kept at the path, so those made from earlier versions of the container can go """
+        directory = os.path.dirname(path)
+        for name in _listdir_quietly(directory):
+            if not name.startswith(version + ".") and not name.startswith("sss_tmp."):
+                remove_quietly(os.path.join(directory, name))
+        self._puts += 1
+        if self._puts % self.TRIM_EVERY == 0:
+            self.trim()
+
+    def forget(self, collection, id):
+        """ Remove all the packages of the container, which has been removed """
+        directory = self._dir(collection, id)
+        for name in _listdir_quietly(directory):
+            remove_quietly(os.path.join(directory, name))
+        _rmdir_quietly(directory)
+
+    def trim(self):
+        """
+        Remove the packages which have not been used for max_age seconds, and then those used longest ago until they
+        take up no more than size bytes
+        """
+        now = time.time()
+        packages = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if self.max_age is not None and now - st.st_mtime > self.max_age:
+                    remove_quietly(path)
+                elif not name.startswith("sss_tmp."):
+                    # a temp file is only removed once it is too old to still be being written
+                    packages.append((st.st_mtime, st.st_size, path))
+        total = sum([size for mtime, size, path in packages])
+        for mtime, size, path in sorted(packages):
+            if self.size is None or total <= self.size:
+                break
+            remove_quietly(path)
+            total -= size
+
+    def stats(self):
+        """ The size, number of packages, bytes used, and this process's hits and misses of the cache """
+        count, used = 0, 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                try:
+                    used += os.path.getsize(os.path.join(dirpath, name))
+                    count += 1
+                except OSError:
+                    pass
+        return {"size" : self.size, "entries" : count, "used" : used, "hits" : self.hits, "misses" : self.misses}
+
+class _KeepingStream(object):
+    """ A stream handle on a package, which writes what is read from it into a temp file in the package cache """
+    def __init__(self, cache, stream, f, tmp_path, path, version):
+        self.cache = cache
+        self.stream = stream
+        self.f = f
+        self.tmp_path = tmp_path
+        self.path = path
+        self.version = version
+
+    def read(self, n=-1):
+        data = self.stream.read(n)
+        if self.f is not None:
+            try:
+                if data:
+                    self.f.write(data)
+                if not data or n < 0:
+                    # the whole package has been read
+                    self.f.close()
+                    self.f = None
+                    os.rename(self.tmp_path, self.path)
+                    self.cache._kept(self.path, self.version)
+            except (IOError, OSError) as e:
+                ssslog.warn("The package cache in " + self.cache.path + " could not be used: " + str(e))
+                self._abandon()
+        return data
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self._abandon()
+
+    def _abandon(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            remove_quietly(self.tmp_path)
+
+def _listdir_quietly(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+def _rmdir_quietly(path):
+    """ remove the directory if it is empty """
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
@@ -1,4 +1,4 @@
-import web, os, base64, uuid, StringIO
+import web, os, base64, uuid, StringIO, json
 from lxml import etree
 from datetime import datetime
 from spec import Namespaces, HttpHeaders, Errors
@@ -132,6 +132,14 @@ class SwordServer(object):
         
     def get_edit_uri(self, path):
         raise NotImplementedError()
+
+    def get_version(self, path):
+        """
+        Get the version of the container, which changes whenever the container does, for use as its ETag.  A server
+        which does not keep versions returns None, and no ETag is given
+        - path:     The URI part which is the path to the container
+        """
+        return None
     
 class Authenticator(object):
     def __init__(self, config): 
@@ -581,6 +589,9 @@ class SWORDRequest(object):
         - packaging     - Packaging in HTTP; the packaging format being used
         - in_progress   - In-Progress in HTTP; whether the deposit is complete or not from a client perspective
         - metadata_relevant - Metadata-Relevant; whether or not the deposit contains relevant metadata
+        
+        and if_match, the entity tags from If-Match (see HttpHeaders.extract_entity_tags): the request must only
+        be carried out if one of them is the current version of the container.  None if any version will do
         """
 
         self.on_behalf_of = None
@@ -592,6 +603,8 @@ class SWORDRequest(object):
         self.slug = None
         self.content_type = None
         self.content_length = 0
+        self.content_encoding = None
+        self.if_match = None
 
     def set_from_headers(self, headers):
         for key, value in headers.items():
@@ -612,6 +625,10 @@ class SWORDRequest(object):
                     self.content_type = value
                 elif key == HttpHeaders.content_length:
                     self.content_length = int(value)
+                elif key == HttpHeaders.content_encoding:
+                    self.content_encoding = value
+                elif key == HttpHeaders.if_match:
+                    self.if_match = HttpHeaders().extract_entity_tags(value)
 
     def set_by_header(self, key, value):
         # FIXME: this is a webpy thing....
@@ -634,6 +651,8 @@ class SWORDRequest(object):
             self.content_md5 = value
         elif key == "HTTP_SLUG":
             self.slug = value
+        elif key == "HTTP_IF_MATCH" and value is not None:
+            self.if_match = HttpHeaders().extract_entity_tags(value)
 
 class DepositRequest(SWORDRequest):
     """
@@ -641,15 +660,22 @@ class DepositRequest(SWORDRequest):
     """
     def __init__(self):
         """
-        There are 3 content related properties:
-        - content   -   the incoming content file to be deposited
+        There are 4 content related properties:
+        - body      -   the spooled body of the incoming content to be deposited (see spool.SpooledBody), which
+                        knows the size and digests of the content, and is held in memory or on disk depending on its
+                        size
+        - content_file  -   a file-like object from which the incoming content to be deposited can be read.  This
+                            is the preferred way to get at the content, as the content is never held in memory
         - atom      -   the incoming atom document to be deposited (may be None)
         - filename  -   the desired name of the incoming content
+        
+        The content property is also available, for back-compatibility, but reads the whole content into memory
         """
         SWORDRequest.__init__(self)
 
         # content related
         self.content_type = "application/octet-stream"
+        self._body = None
         self._content = None
         self._content_file = None
         self.atom = None
@@ -657,6 +683,10 @@ class DepositRequest(SWORDRequest):
         self.filename = "unnamed.file"
         self.too_large = False
         
+        # the size and digests of the content, where they were not supplied by the body
+        self._content_size = None
+        self._digests = None
+        
     def get_entry_document(self):
         if self.entry_document is None:
             if self.atom is not None:
@@ -664,13 +694,44 @@ class DepositRequest(SWORDRequest):
         return self.entry_document
     
     def has_content(self):
-        return self._content is not None or self._content_file is not None
+        return self._body is not None or self._content is not None or self._content_file is not None
+    
+    @property
+    def body(self):
+        return self._body
+    
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._content_file = None
+    
+    @property
+    def content_size(self):
+        if self._content_size is None and self._body is not None:
+            return self._body.size
+        return self._content_size
+    
+    @content_size.setter
+    def content_size(self, size):
+        self._content_size = size
+    
+    @property
+    def digests(self):
+        if self._digests is None and self._body is not None:
+            return self._body.digests
+        return self._digests
+    
+    @digests.setter
+    def digests(self, digests):
+        self._digests = digests
     
     @property
     def content(self):
         # FIXME: this is for back-compat only; use self.content_file
         if self._content is not None:
             return self._content
+        if self._body is not None:
+            return self._body.getvalue()
         if self._content is None and self.content_file is not None:
             return self.content_file.read()
     
@@ -680,7 +741,9 @@ class DepositRequest(SWORDRequest):
     
     @property
     def content_file(self):
-        if self._content_file is None and self._content is not None:
+        if self._content_file is None and self._body is not None:
+            self._content_file = self._body.open()
+        elif self._content_file is None and self._content is not None:
             self._content_file = StringIO.StringIO(self._content)
         return self._content_file
     
@@ -701,6 +764,8 @@ class DepositResponse(object):
         - error     -   sword error document if relevant
         - receipt   -   deposit receipt if successful deposit
         - location  -   the Edit-URI which will be supplied to the client as the Location header in responses
+        - etag      -   the version of the container after the deposit, which will be supplied to the client as
+                        the ETag header in responses
         """
         self.created = False
         self.accepted = False
@@ -708,6 +773,7 @@ class DepositResponse(object):
         self.error = None
         self.receipt = None
         self.location = None
+        self.etag = None
 
 class MediaResourceResponse(object):
     """
@@ -718,13 +784,16 @@ class MediaResourceResponse(object):
         There are three properties:
         redirect    -   boolean, does the client need to be redirected to another URL for the media resource
         url         -   If redirect, then this is the URL to redirect the client to
-        filepath    -   If not redirect, then this is the path to the file that the server should serve
+        stream      -   If not redirect, then this is the stream handle on the content that the server should serve,
+                        which the server must close when it has done so
+        etag        -   the version of the container which the content is from, if the server keeps versions
         """
         self.redirect = False
         self.url = None
-        self.filepath = None
+        self.stream = None
         self.packaging = None
         self.content_type = None
+        self.etag = None
 
 class DeleteRequest(SWORDRequest):
     """
@@ -746,29 +815,49 @@ class DeleteResponse(object):
         error_code  -   if there was an error, the http code associated
         error       -   the sworderror if appropriate
         receipt     -   if successful and a request for deleting content (not container) the deposit receipt
+        etag        -   if a request for deleting content, the version of the container after the delete
         """
         self.error_code = None
         self.error = None
         self.receipt = None
+        self.etag = None
                 
+def _deposit_to_json(od):
+    """ an original deposit tuple of a Statement, with its datestamp as a string """
+    uri, datestamp, format_uri, by, obo = od
+    return (uri, datestamp.strftime("%Y-%m-%dT%H:%M:%SZ") if datestamp is not None else None, format_uri, by, obo)
+
+def _deposit_from_json(od):
+    """ an original deposit tuple of a Statement from its JSON form (see _deposit_to_json) """
+    uri, datestamp, format_uri, by, obo = od
+    return (uri, datetime.strptime(datestamp, "%Y-%m-%dT%H:%M:%SZ") if datestamp is not None else None, format_uri, by, obo)
+
 class Statement(object):
     """
     Class representing the Statement; a description of the object as it appears on the server
     """
-    def __init__(self, rdf_file=None, aggregation_uri=None, rem_uri=None, original_deposits=None, aggregates=None, states=None):
+    def __init__(self, rdf_file=None, aggregation_uri=None, rem_uri=None, original_deposits=None, aggregates=None, states=None, json_file=None):
         """
-        The statement has 4 important properties:
+        A statement may be loaded from its RDF/XML serialisation (rdf_file) or from its compact JSON one (json_file),
+        which is much quicker to read.  The statement has 4 important properties:
         - aggregation_uri   -   The URI of the aggregation in ORE terms
         - rem_uri           -   The URI of the Resource Map in ORE terms
         - original_deposits -   The list of original packages uploaded to the server (set with original_deposit())
         - in_progress       -   Is the submission in progress (boolean)
         - aggregates        -   the non-original deposit files associated with the item
+        A statement which has been saved (see mark_saved) logs the changes made to it through its methods since then
+        as events (see events_since) in unsaved_events, so that only those need be stored
         """
         self.aggregation_uri = aggregation_uri
         self.rem_uri = rem_uri
         self.original_deposits = original_deposits if original_deposits is not None else []
         self.aggregates = aggregates if aggregates is not None else []
         self.states = states if states is not None else []
+
+        # where this statement was last saved, as a tuple of the collection, the id of the container and the sequence
+        # number of the stored statement, and the events since then
+        self.saved_as = None
+        self.unsaved_events = []
         
         # Namespace map for XML serialisation
         self.ns = Namespaces()
@@ -779,15 +868,38 @@ class Statement(object):
         self.rdf = None
         if rdf_file is not None:
             self.load_from_rdf(rdf_file)
+        if json_file is not None:
+            self.load_from_json(json_file)
 
     def __str__(self):
         return str(self.aggregation_uri) + ", " + str(self.rem_uri) + ", " + str(self.original_deposits)
+
+    def copy(self):
+        """
+        A copy of this statement, which can be changed without changing this one.  Only the lists are copied, as
+        the entries in them are tuples and strings, which are never changed in place.  The copy has not been saved
+        """
+        s = Statement(aggregation_uri=self.aggregation_uri, rem_uri=self.rem_uri,
+                        original_deposits=list(self.original_deposits), aggregates=list(self.aggregates),
+                        states=list(self.states))
+        s.rdf = self.rdf
+        return s
     
+    def mark_saved(self, collection, id, seq):
+        """
+        Record that this statement is the one stored in the container with the given sequence number, so that the
+        changes made to it from now on are logged in unsaved_events (see logged_events_since)
+        """
+        self.saved_as = (collection, id, seq)
+        self.unsaved_events = []
+
     def add_state(self, state, state_description):
         self.states.append((state, state_description))
+        self._log({"event" : "state_changed", "states" : list(self.states)})
         
     def set_state(self, state, state_description):
         self.states = [(state, state_description)]
+        self._log({"event" : "state_changed", "states" : list(self.states)})
     
     def original_deposit(self, uri, deposit_time, packaging_format, by, obo):
         """
@@ -799,11 +911,21 @@ class Statement(object):
         """
         ssslog.debug("Adding original deposit to Statement: " + uri)
         self.original_deposits.append((uri, deposit_time, packaging_format, by, obo))
+        self._log({"event" : "deposit_added", "deposit" : _deposit_to_json(self.original_deposits[-1])})
 
     def add_normalised_aggregations(self, aggs):
+        added = []
         for agg in aggs:
             if agg not in self.aggregates:
                 self.aggregates.append(agg)
+                added.append(agg)
+        if len(added) > 0:
+            self._log({"event" : "aggregates_added", "aggregates" : added})
+
+    def _log(self, event):
+        """ log the event among the changes made since the statement was saved, if it has been """
+        if self.saved_as is not None:
+            self.unsaved_events.append(event)
 
     def load_from_rdf(self, filepath_or_filehandle):
         """
@@ -867,6 +989,112 @@ class Statement(object):
                 
         self.rdf = rdf
 
+    def serialise_json(self):
+        """
+        Serialise this statement into the compact JSON form in which it is stored, which holds only the properties
+        of the statement, from which the RDF/XML and Atom serialisations can be made
+        """
+        return json.dumps(self.as_dict(), separators=(",", ":"))
+
+    def as_dict(self):
+        """ The properties of this statement, as a dictionary which can be serialised as JSON """
+        return {
+            "aggregation_uri" : self.aggregation_uri,
+            "rem_uri" : self.rem_uri,
+            "states" : self.states,
+            "original_deposits" : [_deposit_to_json(od) for od in self.original_deposits],
+            "aggregates" : self.aggregates
+        }
+
+    def load_from_json(self, filepath_or_filehandle):
+        """
+        Populate this statement object from the JSON serialised statement to be found at the specified filepath
+        """
+        if hasattr(filepath_or_filehandle, "read"):
+            d = json.loads(filepath_or_filehandle.read())
+        else:
+            with open(filepath_or_filehandle, "r") as f:
+                d = json.loads(f.read())
+        self.load_from_dict(d)
+
+    def load_from_dict(self, d):
+        """ Populate this statement object from a dictionary of its properties, as made by as_dict """
+        self.aggregation_uri = d["aggregation_uri"]
+        self.rem_uri = d["rem_uri"]
+        self.states = [tuple(state) for state in d["states"]]
+        self.original_deposits = [_deposit_from_json(od) for od in d["original_deposits"]]
+        self.aggregates = d["aggregates"]
+
+    def events_since(self, base):
+        """
+        The list of events which, applied in order to the base statement (see apply_event), make this one.  Each
+        event is a small dictionary which can be serialised as JSON, whose "event" is one of:
+        - uris_changed      -   the aggregation_uri and rem_uri are replaced
+        - state_changed     -   the states are replaced
+        - content_removed   -   the original deposits and aggregates are all removed
+        - deposit_added     -   an original deposit is added
+        - aggregates_added  -   aggregates are added
+        A statement which has only had deposits and aggregates added since the base gives events for just those
+        """
+        events = []
+        if self.aggregation_uri != base.aggregation_uri or self.rem_uri != base.rem_uri:
+            events.append({"event" : "uris_changed", "aggregation_uri" : self.aggregation_uri, "rem_uri" : self.rem_uri})
+        if self.states != base.states:
+            events.append({"event" : "state_changed", "states" : self.states})
+        deposits = len(base.original_deposits)
+        aggregates = len(base.aggregates)
+        if self.original_deposits[:deposits] != base.original_deposits or self.aggregates[:aggregates] != base.aggregates:
+            events.append({"event" : "content_removed"})
+            deposits = 0
+            aggregates = 0
+        for od in self.original_deposits[deposits:]:
+            events.append({"event" : "deposit_added", "deposit" : _deposit_to_json(od)})
+        if len(self.aggregates) > aggregates:
+            events.append({"event" : "aggregates_added", "aggregates" : self.aggregates[aggregates:]})
+        return events
+
+    def logged_events_since(self, base):
+        """
+        The events which make this statement from the base, the one it was saved as (see mark_saved): those logged
+        in unsaved_events, as long as they account for it as far as can be told without comparing the lists, and
+        otherwise (as when its properties have been changed directly) those given by events_since
+        """
+        states = base.states
+        deposits = len(base.original_deposits)
+        aggregates = len(base.aggregates)
+        last_aggregate = base.aggregates[-1:]
+        for event in self.unsaved_events:
+            if event["event"] == "state_changed":
+                states = event["states"]
+            elif event["event"] == "deposit_added":
+                deposits += 1
+            elif event["event"] == "aggregates_added":
+                aggregates += len(event["aggregates"])
+                last_aggregate = event["aggregates"][-1:]
+        if (self.aggregation_uri == base.aggregation_uri and self.rem_uri == base.rem_uri and self.states == states
+                and len(self.original_deposits) == deposits and len(self.aggregates) == aggregates
+                and self.aggregates[-1:] == last_aggregate):
+            return self.unsaved_events
+        return self.events_since(base)
+
+    def apply_event(self, event):
+        """ Change this statement by one of the events given by events_since """
+        kind = event["event"]
+        if kind == "uris_changed":
+            self.aggregation_uri = event["aggregation_uri"]
+            self.rem_uri = event["rem_uri"]
+        elif kind == "state_changed":
+            self.states = [tuple(state) for state in event["states"]]
+        elif kind == "content_removed":
+            self.original_deposits = []
+            self.aggregates = []
+        elif kind == "deposit_added":
+            self.original_deposits.append(_deposit_from_json(event["deposit"]))
+        elif kind == "aggregates_added":
+            self.aggregates.extend(event["aggregates"])
+        else:
+            raise ValueError("unknown statement event: " + str(kind))
+
     def serialise_rdf(self, existing_rdf_as_string=None):
         """
         Serialise this statement into an RDF/XML string
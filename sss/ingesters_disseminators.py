@@ -1,10 +1,19 @@
-from zipfile import ZipFile
+import os, time, zlib, tempfile, struct, urllib, tarfile
+from collections import deque
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from zipfile import ZipFile, ZipInfo, BadZipfile, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT
 from lxml import etree
 from spec import Namespaces
+from spool import copy_stream
 
 from sss_logging import logging
 ssslog = logging.getLogger(__name__)
 
+# the size of the blocks of content which are compressed independently by the parallel disseminators, as in pigz
+DEFAULT_BLOCK_SIZE = 131072
 
 class DisseminationPackager(object):
     def __init__(self, dao, uri_manager):
@@ -16,8 +25,10 @@ class DisseminationPackager(object):
     def package(self, collection, id):
         """
         Package up all the content in the specified container.  This method must be implemented by the extender.  The
-        method should create a package in the store directory, and then return to the caller the path to that file
-        so that it can be served back to the client
+        method should create a package (for example, in a temporary file in the tmp_dir), and then return to the
+        caller an open stream handle on it, at its start, so that it can be served back to the client.  The caller
+        will close the handle.  The package should not be written into the container, as it is not part of the
+        content; the caller keeps it in the package cache (see DAO.get_package) until the container changes
         """
         pass
         
@@ -37,10 +48,479 @@ class IngestPackager(object):
         """
         return []
    
+def write_stream_to_zip(z, stream, arcname, size=None, chunk_size=8096):
+    """
+    Write the content of the stream into the open ZipFile as arcname, in chunks.  This does what ZipFile.write does
+    for a file on the local disk, but for any stream handle (e.g. one from DAO.open_file).  The ZipFile must be
+    writing to a seekable file, as the entry's header is rewritten once its CRC and sizes are known.  If the size is
+    not supplied, a Zip64 header is used in case the content turns out to be large
+    """
+    zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
+    zinfo.external_attr = 0644 << 16L
+    zinfo.compress_type = z.compression
+    zinfo.flag_bits = 0x00
+    zinfo.file_size = 0
+    zinfo.header_offset = z.fp.tell()
+    z._writecheck(zinfo)
+    z._didModify = True
+
+    zinfo.CRC = crc = 0
+    zinfo.compress_size = compress_size = 0
+    zip64 = z._allowZip64 and (size is None or size * 1.05 > ZIP64_LIMIT)
+    z.fp.write(zinfo.FileHeader(zip64))
+    cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if zinfo.compress_type == ZIP_DEFLATED else None
+    file_size = 0
+    while True:
+        buf = stream.read(chunk_size)
+        if not buf:
+            break
+        file_size += len(buf)
+        crc = zlib.crc32(buf, crc) & 0xffffffff
+        if cmpr is not None:
+            buf = cmpr.compress(buf)
+            compress_size += len(buf)
+        z.fp.write(buf)
+    if cmpr is not None:
+        buf = cmpr.flush()
+        compress_size += len(buf)
+        z.fp.write(buf)
+        zinfo.compress_size = compress_size
+    else:
+        zinfo.compress_size = file_size
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    if not zip64 and (file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT):
+        raise RuntimeError("content for " + arcname + " is too large for a zip file without Zip64 extensions")
+
+    # go back and rewrite the header, now with the CRC and sizes in it
+    position = z.fp.tell()
+    z.fp.seek(zinfo.header_offset, 0)
+    z.fp.write(zinfo.FileHeader(zip64))
+    z.fp.seek(position, 0)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+
+class GeneratedStream(object):
+    """
+    A read-only stream handle on the strings which the _generate method of the extender yields, made as they are
+    read.  Closing it stops the generator, so the generator should close whatever it has open in a finally block, as
+    well as the handles in closing (which are closed by close in any case)
+    """
+    def __init__(self, closing=None):
+        self.closing = closing if closing is not None else []
+        self.chunks = self._generate()
+        self.pending = ""
+
+    def read(self, n=-1):
+        parts = [self.pending]
+        have = len(self.pending)
+        while n < 0 or have < n:
+            try:
+                chunk = self.chunks.next()
+            except StopIteration:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        data = "".join(parts)
+        if n < 0:
+            self.pending = ""
+            return data
+        self.pending = data[n:]
+        return data[:n]
+
+    def close(self):
+        # stops the generator, which closes the stream it is reading
+        self.chunks.close()
+        for f in self.closing:
+            f.close()
+
+    def _generate(self):
+        return iter([])
+
+class ZipStream(GeneratedStream):
+    """
+    A read-only stream handle on a zip file which is made from the content of the files as it is read, so that it can
+    be sent to the client as soon as it is started, and in bounded memory however large it is.  Nothing is ever
+    seeked: each entry's CRC and sizes are written after its data in a data descriptor, as the zip format allows, and
+    the central directory is written at the end.  Each file is a tuple of (arcname, a function which opens a stream
+    handle on its content, its size or None); each stream is only opened when its entry is reached.  If a size is
+    not supplied, a Zip64 entry is used in case the content turns out to be large.  A file may also be a member of
+    another zip, to be copied without being inflated and deflated again, in which case its tuple has the ZipInfo of
+    the member as well, and the stream is of the member's raw compressed data (see RawMember).  The handles in
+    closing are closed once the zip has been read, or abandoned
+    """
+    def __init__(self, files, compression=ZIP_STORED, chunk_size=8096, closing=None):
+        self.files = files
+        self.chunk_size = chunk_size
+        self.buffer = _WriteBuffer()
+        self.zip = ZipFile(self.buffer, "w", compression, allowZip64=True)
+        GeneratedStream.__init__(self, closing)
+
+    def _generate(self):
+        try:
+            for entry in self.files:
+                if len(entry) > 3:
+                    generator = self._raw_entry(*entry)
+                else:
+                    generator = self._entry(*entry)
+                for chunk in generator:
+                    yield chunk
+
+            # the central directory, which ZipFile writes from the entries
+            self.zip.close()
+            yield self.buffer.drain()
+        finally:
+            for f in self.closing:
+                f.close()
+
+    def _raw_entry(self, arcname, opener, size, source):
+        """ the entry for a member of another zip, whose CRC and sizes are known, so it needs no data descriptor """
+        z = self.zip
+        zinfo = ZipInfo(arcname, source.date_time)
+        zinfo.external_attr = 0644 << 16L
+        zinfo.compress_type = source.compress_type
+        zinfo.CRC = source.CRC
+        zinfo.file_size = source.file_size
+        zinfo.compress_size = source.compress_size
+        zinfo.header_offset = self.buffer.tell()
+        z._writecheck(zinfo)
+        z._didModify = True
+        self.buffer.write(zinfo.FileHeader(source.file_size > ZIP64_LIMIT or source.compress_size > ZIP64_LIMIT))
+        yield self.buffer.drain()
+        stream = opener()
+        try:
+            while True:
+                buf = stream.read(self.chunk_size)
+                if not buf:
+                    break
+                self.buffer.write(buf)
+                yield self.buffer.drain()
+        finally:
+            stream.close()
+        z.filelist.append(zinfo)
+        z.NameToInfo[zinfo.filename] = zinfo
+
+    def _entry(self, arcname, opener, size):
+        """ the entry for a file, whose CRC and sizes follow its data """
+        zinfo, zip64 = self._start_entry(arcname, size)
+        yield self.buffer.drain()
+
+        cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if zinfo.compress_type == ZIP_DEFLATED else None
+        crc = file_size = compress_size = 0
+        stream = opener()
+        try:
+            while True:
+                buf = stream.read(self.chunk_size)
+                if not buf:
+                    break
+                file_size += len(buf)
+                crc = zlib.crc32(buf, crc) & 0xffffffff
+                if cmpr is not None:
+                    buf = cmpr.compress(buf)
+                compress_size += len(buf)
+                if buf:
+                    self.buffer.write(buf)
+                    yield self.buffer.drain()
+        finally:
+            stream.close()
+        if cmpr is not None:
+            buf = cmpr.flush()
+            compress_size += len(buf)
+            self.buffer.write(buf)
+        self._end_entry(zinfo, zip64, crc, file_size, compress_size)
+        yield self.buffer.drain()
+
+    def _start_entry(self, arcname, size):
+        """ write the local header of the entry for a file, returning its ZipInfo and whether it is a Zip64 entry """
+        z = self.zip
+        zinfo = ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0644 << 16L
+        zinfo.compress_type = z.compression
+        zinfo.flag_bits = 0x08      # the CRC and sizes follow the data
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        zinfo.header_offset = self.buffer.tell()
+        z._writecheck(zinfo)
+        z._didModify = True
+        zip64 = size is None or size * 1.05 > ZIP64_LIMIT
+        self.buffer.write(zinfo.FileHeader(zip64))
+        return zinfo, zip64
+
+    def _end_entry(self, zinfo, zip64, crc, file_size, compress_size):
+        """ write the data descriptor of the entry, now that its data has been written """
+        if not zip64 and (file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT):
+            raise RuntimeError("content for " + zinfo.filename + " is too large for a zip file without Zip64 extensions")
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        self.buffer.write(struct.pack("<4sLQQ" if zip64 else "<4sLLL", "PK\x07\x08", crc, compress_size, file_size))
+        self.zip.filelist.append(zinfo)
+        self.zip.NameToInfo[zinfo.filename] = zinfo
+
+class RawMember(object):
+    """
+    A read-only stream handle on the raw (still compressed) data of a member of a zip file, read from an open,
+    seekable handle on the zip, which is shared by all its members and left open
+    """
+    def __init__(self, f, info):
+        self.f = f
+        # the data follows the member's local header, whose extra field need not be the same as the one in the
+        # central directory
+        f.seek(info.header_offset)
+        header = f.read(30)
+        if len(header) != 30 or header[:4] != "PK\x03\x04":
+            raise BadZipfile("bad local file header for " + info.filename)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        self.remaining = info.compress_size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.f.read(n)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        pass
+
+class _WriteBuffer(object):
+    """ what a ZipFile writes, held until it is drained, and counted so that its offset can be told """
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = "".join(self.parts)
+        self.parts = []
+        return data
+
+class ParallelZipStream(ZipStream):
+    """
+    A ZipStream whose entries are deflated by a pool of threads, which zlib lets run at once as it releases the GIL
+    while it compresses.  The content of each file is split into blocks of block_size, which are deflated
+    independently (see _deflate_block) and written out in order as they are done, so the blocks of one large file are
+    compressed in parallel as well as those of many small ones.  No more than a few blocks per worker are read ahead
+    of the one being written, so memory stays bounded however large the zip is.  Members copied from another zip are
+    copied as they are, as by ZipStream
+    """
+    def __init__(self, files, level=zlib.Z_DEFAULT_COMPRESSION, workers=None, block_size=DEFAULT_BLOCK_SIZE,
+                    chunk_size=8096, closing=None):
+        self.level = level
+        self.workers = workers or cpu_count()
+        self.block_size = block_size
+        ZipStream.__init__(self, files, ZIP_DEFLATED, chunk_size, closing)
+
+    def _generate(self):
+        pool = ThreadPool(self.workers)
+        try:
+            for chunk in _in_order(self._slots(pool), self.workers * 4, self._write):
+                yield chunk
+
+            # the central directory, which ZipFile writes from the entries
+            self.zip.close()
+            yield self.buffer.drain()
+        finally:
+            pool.terminate()
+            for f in self.closing:
+                f.close()
+
+    def _slots(self, pool):
+        """ the slots (see _in_order) for the entries, which read the content of each file as they are made """
+        for entry in self.files:
+            if len(entry) > 3:
+                yield partial(self._raw_entry, *entry)
+                continue
+            arcname, opener, size = entry
+            state = {}
+            yield partial(self._start, arcname, size, state)
+            crc = file_size = 0
+            stream = opener()
+            try:
+                for block, last in _blocks(stream, self.block_size):
+                    crc = zlib.crc32(block, crc) & 0xffffffff
+                    file_size += len(block)
+                    yield pool.apply_async(_deflate_block, (block, self.level, last))
+            finally:
+                stream.close()
+            yield partial(self._end, state, crc, file_size)
+
+    def _write(self, data):
+        self.buffer.write(data)
+        return self.buffer.drain()
+
+    def _start(self, arcname, size, state):
+        state["zinfo"], state["zip64"] = self._start_entry(arcname, size)
+        state["offset"] = self.buffer.tell()
+        return [self.buffer.drain()]
+
+    def _end(self, state, crc, file_size):
+        self._end_entry(state["zinfo"], state["zip64"], crc, file_size, self.buffer.tell() - state["offset"])
+        return [self.buffer.drain()]
+
+class TarStream(GeneratedStream):
+    """
+    A read-only stream handle on a tar file (in the POSIX.1-2001 format, so that names and sizes are not limited) which
+    is made from the content of the files as it is read.  Each file is a tuple of (arcname, a function which opens a
+    stream handle on its content, its size); unlike a zip entry, a tar header must have the size in it, so it must be
+    known
+    """
+    def __init__(self, files, chunk_size=8096, closing=None):
+        self.files = files
+        self.chunk_size = chunk_size
+        GeneratedStream.__init__(self, closing)
+
+    def _generate(self):
+        try:
+            for arcname, opener, size in self.files:
+                info = tarfile.TarInfo(arcname.encode("utf-8") if isinstance(arcname, unicode) else arcname)
+                info.size = size
+                info.mtime = int(time.time())
+                info.mode = 0644
+                yield info.tobuf(tarfile.PAX_FORMAT, "utf-8")
+
+                remaining = size
+                stream = opener()
+                try:
+                    while remaining > 0:
+                        buf = stream.read(min(self.chunk_size, remaining))
+                        if not buf:
+                            raise IOError("content for " + info.name + " is shorter than its size of " + str(size))
+                        remaining -= len(buf)
+                        yield buf
+                finally:
+                    stream.close()
+                if size % tarfile.BLOCKSIZE:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+            # the end of the archive
+            yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+        finally:
+            for f in self.closing:
+                f.close()
+
+class ParallelGzipStream(GeneratedStream):
+    """
+    A read-only stream handle on the gzip compression of another stream, made as it is read.  As in pigz, the content
+    is split into blocks of block_size which are deflated independently by a pool of threads (see _deflate_block),
+    and written out in order as they are done, in a single gzip member which any gzip reader can read.  The stream is
+    closed once it has been read, or abandoned
+    """
+    def __init__(self, stream, level=zlib.Z_DEFAULT_COMPRESSION, workers=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.stream = stream
+        self.level = level
+        self.workers = workers or cpu_count()
+        self.block_size = block_size
+        GeneratedStream.__init__(self, [stream])
+
+    def _generate(self):
+        pool = ThreadPool(self.workers)
+        try:
+            # the header: deflated, with no name and an unknown operating system
+            yield "\x1f\x8b\x08\x00" + struct.pack("<L", int(time.time())) + "\x00\xff"
+            for chunk in _in_order(self._slots(pool), self.workers * 4, lambda data: data):
+                yield chunk
+        finally:
+            pool.terminate()
+            for f in self.closing:
+                f.close()
+
+    def _slots(self, pool):
+        crc = size = 0
+        for block, last in _blocks(self.stream, self.block_size):
+            crc = zlib.crc32(block, crc) & 0xffffffff
+            size += len(block)
+            yield pool.apply_async(_deflate_block, (block, self.level, last))
+        # the trailer
+        yield partial(lambda crc, size: [struct.pack("<LL", crc, size & 0xffffffff)], crc, size)
+
+def _deflate_block(data, level, last):
+    """
+    the raw deflate data of one block of a stream, which can simply be joined to that of the blocks either side of
+    it: every block but the last ends on a byte boundary (a sync flush), and only the last is marked as the end.  Each
+    block is deflated on its own, so it does not refer back to the one before; this costs very little in the size of
+    the output with blocks of a useful size
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+def _blocks(stream, block_size):
+    """ (block, whether it is the last) for the blocks of the stream, of which there is always at least one """
+    block = stream.read(block_size)
+    while True:
+        following = stream.read(block_size) if block else ""
+        yield block, not following
+        if not following:
+            return
+        block = following
+
+def _in_order(slots, window, output):
+    """
+    the strings which the slots stand for, in order, each as soon as it and all those before it are ready.  A slot is
+    either the AsyncResult of a compression in a pool, whose result is passed through output, or a function which
+    makes its strings (a list or generator of them) when its turn comes.  No more than window slots are taken from
+    the slots ahead of the one whose turn it is, so the content is read no faster than the pool can compress it
+    """
+    pending = deque()
+    for slot in slots:
+        pending.append(slot)
+        while pending and (len(pending) > window or not hasattr(pending[0], "ready") or pending[0].ready()):
+            for chunk in _resolve(pending.popleft(), output):
+                yield chunk
+    while pending:
+        for chunk in _resolve(pending.popleft(), output):
+            yield chunk
+
+def _resolve(slot, output):
+    if hasattr(slot, "get"):
+        return [output(slot.get())]
+    return slot()
+
+def _compression(configuration):
+    """ the compression level and number of workers which the configuration asks for """
+    level = configuration.package_compression_level
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    return level, configuration.package_compression_workers or cpu_count()
+
+def _package_file(stream, configuration):
+    """ the whole package in the stream, made into a temp file and returned at its start, with the stream closed """
+    chunk_size = configuration.copy_chunk_size
+    f = _temp_file(configuration.tmp_dir)
+    try:
+        copy_stream(stream, f, chunk_size)
+    except:
+        f.close()
+        raise
+    finally:
+        stream.close()
+    f.seek(0)
+    return f
+
+def _temp_file(tmp_dir):
+    """ an anonymous temporary file in the tmp_dir, which is removed when it is closed """
+    if tmp_dir is not None and not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    return tempfile.TemporaryFile(dir=tmp_dir)
+
 class DefaultDisseminator(DisseminationPackager):
     """
-    Basic default packager, this just zips up everything except the SSS specific files in the container and stores
-    them in a file called sword-default-package.zip.
+    Basic default packager, this just zips up everything except the SSS specific files in the container into a
+    ZipStream, which is made as it is sent if stream_packages is configured, and into a temporary file otherwise.
+    When the container's only original deposit is a SimpleZip package, the files which were unpacked from it and
+    have not been written since (see DAO.store_unpacked) are copied into the package from it as they are, still
+    compressed, rather than being compressed again
     """
     def __init__(self, dao, uri_manager):
         self.dao = dao
@@ -48,18 +528,90 @@ class DefaultDisseminator(DisseminationPackager):
     def package(self, collection, id):
         """ package up the content """
 
-        # get a list of the relevant content files
+        # get a list of the relevant content files (a container made by an earlier version of SSS may still have the
+        # package it was given in it)
         files = self.dao.list_content(collection, id, exclude=["sword-default-package.zip"])
+        entries = [(file, partial(self.dao.open_file, collection, id, file), self.dao.get_file_size(collection, id, file))
+                    for file in files]
+        closing = []
+        original = self._original_zip(collection, id, files)
+        if original is not None:
+            entries = self._copy_from_zip(collection, id, original, entries, closing)
 
-        # create a zip file with all the original zip files in it
-        zpath = self.dao.get_store_path(collection, id, "sword-default-package.zip")
-        z = ZipFile(zpath, "w")
-        for file in files:
-            z.write(self.dao.get_store_path(collection, id, file), file)
-        z.close()
+        stream = self._zip_stream(entries, closing)
+        if self.dao.configuration.stream_packages:
+            return stream
+
+        # create the whole zip file before it is sent, and return a handle on it to the caller
+        return _package_file(stream, self.dao.configuration)
 
-        # return the path to the package to the caller
-        return zpath
+    def _zip_stream(self, entries, closing):
+        return ZipStream(entries, chunk_size=self.dao.configuration.copy_chunk_size, closing=closing)
+
+    def _original_zip(self, collection, id, files):
+        """ the name of the content file which is the container's only original deposit, if that is a SimpleZip """
+        original_deposits = self.dao.load_statement(collection, id).original_deposits
+        if len(original_deposits) != 1 or original_deposits[0][2] != "http://purl.org/net/sword/package/SimpleZip":
+            return None
+        name = urllib.unquote(original_deposits[0][0].split("/")[-1])
+        return name if name in files else None
+
+    def _copy_from_zip(self, collection, id, original, entries, closing):
+        """
+        the entries, with those which are files unpacked from the original zip, and not written since, made into
+        members of it to copy from it as they are
+        """
+        unpacked = self.dao.get_unpacked(collection, id)
+        if unpacked is None or unpacked["package"] != original:
+            return entries
+        f = self.dao.open_file(collection, id, original, seekable=True)
+        closing.append(f)
+        try:
+            members = dict([(info.filename, info) for info in ZipFile(f).infolist()])
+        except BadZipfile:
+            return entries
+        copied = []
+        for arcname, opener, size in entries:
+            info = members.get(arcname)
+            if (info is not None and unpacked["members"].get(arcname) == info.CRC and info.file_size == size and
+                    not info.flag_bits & 0x01 and info.compress_type in [ZIP_STORED, ZIP_DEFLATED]):
+                copied.append((arcname, partial(RawMember, f, info), size, info))
+            else:
+                copied.append((arcname, opener, size))
+        return copied
+
+class ParallelZipDisseminator(DefaultDisseminator):
+    """
+    The DefaultDisseminator's zip, with its content deflated by a pool of package_compression_workers threads at the
+    package_compression_level (see ParallelZipStream), for large containers whose packages are worth compressing
+    """
+    def _zip_stream(self, entries, closing):
+        level, workers = _compression(self.dao.configuration)
+        return ParallelZipStream(entries, level, workers, chunk_size=self.dao.configuration.copy_chunk_size, closing=closing)
+
+class ParallelTarGzDisseminator(DisseminationPackager):
+    """
+    Packages everything except the SSS specific files in the container into a tar file, gzipped by a pool of
+    package_compression_workers threads at the package_compression_level (see ParallelGzipStream).  Like the
+    DefaultDisseminator, the package is made as it is sent if stream_packages is configured, and into a temporary file
+    otherwise
+    """
+    def __init__(self, dao, uri_manager):
+        self.dao = dao
+
+    def package(self, collection, id):
+        """ package up the content """
+        files = self.dao.list_content(collection, id, exclude=["sword-default-package.zip"])
+        entries = [(file, partial(self.dao.open_file, collection, id, file), self.dao.get_file_size(collection, id, file))
+                    for file in files]
+        level, workers = _compression(self.dao.configuration)
+        stream = ParallelGzipStream(TarStream(entries, self.dao.configuration.copy_chunk_size), level, workers)
+        if self.dao.configuration.stream_packages:
+            return stream
+        return _package_file(stream, self.dao.configuration)
+
+    def get_uri(self):
+        return None
 
 class FeedDisseminator(DisseminationPackager):
     def __init__(self, dao, uri_manager):
@@ -70,7 +622,8 @@ class FeedDisseminator(DisseminationPackager):
 
     def package(self, collection, id):
         """ create a feed representation of the package """
-        # get a list of the relevant content files
+        # get a list of the relevant content files (a container made by an earlier version of SSS may still have the
+        # feed it was given in it)
         files = self.dao.list_content(collection, id, exclude=["mediaresource.feed.xml"])
 
         # create a feed object with all the files as entries
@@ -91,12 +644,7 @@ class FeedDisseminator(DisseminationPackager):
             content.set("type", "application/octet-stream") # FIXME: we're not storing content types, so we don't know
             content.set("src", self.um.part_uri(collection, id, file))
         
-        fpath = self.dao.get_store_path(collection, id, "mediaresource.feed.xml")
-        f = open(fpath, "wb")
-        f.write(etree.tostring(feed, pretty_print=True))
-        f.close()
-        
-        return fpath
+        return StringIO(etree.tostring(feed, pretty_print=True))
         
     def get_uri(self):
         return None
@@ -115,17 +663,35 @@ class SimpleZipIngester(IngestPackager):
         self.ns = Namespaces()
         
     def ingest(self, collection, id, filename, metadata_relevant=True):
-        # First, let's just extract all the contents of the zip
-        z = ZipFile(self.dao.get_store_path(collection, id, filename))
-        
-        # keep track of the names of the files in the zip, as these will become
-        # our derived resources
-        derived_resources = z.namelist()
-        
-        # FIXME: what we do here is intrinsically insecure, but SSS is not a
-        # production service, so we're not worrying about it!
-        path = self.dao.get_store_path(collection, id)
-        z.extractall(path)
+        # First, let's just extract all the contents of the zip (which needs a
+        # seekable handle on it)
+        f = self.dao.open_file(collection, id, filename, seekable=True)
+        try:
+            z = ZipFile(f)
+            
+            # keep track of the names of the files in the zip, as these will become
+            # our derived resources
+            derived_resources = z.namelist()
+            
+            # FIXME: what we do here is intrinsically insecure, but SSS is not a
+            # production service, so we're not worrying about it!
+            self.dao.clear_unpacked(collection, id)
+            unpacked = {}
+            for info in z.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                member = z.open(info)
+                try:
+                    self.dao.store_file(collection, id, info.filename, member)
+                finally:
+                    member.close()
+                # reading the member to the end has checked it against its CRC
+                unpacked[info.filename] = info.CRC
+        finally:
+            f.close()
+
+        # so that the files can be copied back into a package from the zip as they are, until they are changed
+        self.dao.store_unpacked(collection, id, filename, unpacked)
         
         # check for the atom document
         atom = self.dao.get_atom_content(collection, id)
@@ -0,0 +1,294 @@
+"""
+Atomic commits of the changes to a container.
+
+A deposit changes several files in its container (the content, atom.xml, sss_metadata.xml, both statements and the
+deposit receipt), and a crash part way through would leave the container half written.  So the DAO makes each change
+in a ContainerTransaction: files are written into a staging area in the container (sss_txn.<txid>/), files to be
+deleted are only noted, and reads within the transaction see the staged state.  On commit, the full list of changes
+is written to a journal before any of them is applied, and applying them is just a rename of each staged file into
+place and a delete of each deleted file, which can safely be done again if it is interrupted.
+
+The journals are kept in the internal .journal collection of the store, one for each transaction which is still open,
+so recovery only has to read those rather than scan the store: a transaction which was committed is applied again,
+and one which was not is rolled back by removing what it staged (and the container as well, if the transaction was
+creating it) and releasing the references it added to blobs in the blob store, which are journalled as they are
+added.  Journals belonging to a process which is still running are left alone, so one SSS process starting up
+does not interfere with the transactions of another, and each container is locked (see locks.py) while its
+transaction is recovered, in case the process which started it is still running after all.
+"""
+import os, uuid, json, socket, time, errno
+
+from storage import StorageError, BlobStore
+from locks import ContainerLocks, LockTimeout
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+# the start of the name of the directory in the container in which a transaction stages its files
+STAGING = "sss_txn."
+
+# how old the journal of a transaction started by another host must be before recovery will touch it, as there is
+# no way to ask whether its process is still running
+FOREIGN_JOURNAL_AGE = 24 * 60 * 60
+
+class ContainerTransaction(object):
+    """
+    A set of changes to one container, which are applied together by commit or not at all.  Use it as a context
+    manager, which commits if the block completes and aborts if it raises.  If it is given the lock on the container
+    (see locks.py) it releases it when it is finished
+    """
+    def __init__(self, journal, blobs, collection, id, created=False, lock=None):
+        self.journal = journal
+        self.blobs = blobs
+        self.collection = collection
+        self.id = id
+        self.created = created
+        self.lock = lock
+        self.txid = str(uuid.uuid4())
+        self.puts = {}          # file name -> name of the staged file which will replace it
+        self.deletes = []       # names of the files which will be deleted
+        self.releases = []      # blobs to release from the blob store once the transaction is committed
+        self.acquired = []      # blobs referenced by the transaction, to release if it is aborted
+        self.documents = {}     # name -> JSON document of the container which the DAO keeps for the transaction
+        self.changed_documents = set()  # names of the documents to be staged when the transaction commits
+        self.before_commit = [] # functions to call before the changes are journalled, to stage what is held back
+        self.version = None     # the version the container will have once the transaction is committed
+        self.started = time.time()
+        self.finished = False
+
+    def begin(self):
+        self.journal.write(self.record("open"))
+        ssslog.debug("Began transaction " + self.txid + " on " + self.collection + "/" + self.id)
+
+    def acquire(self, sha256):
+        """
+        Note a reference which the transaction has added to a blob, to be released if it is rolled back.  It is
+        journalled straight away, so that recovery releases it too (a crash before then leaves the blob with an extra
+        reference, which wastes space but loses nothing)
+        """
+        self.acquired.append(sha256)
+        self.journal.write(self.record("open"))
+
+    def put(self, name):
+        """ Stage a new version of the named file, returning the name in the container to write it to """
+        staged = STAGING + self.txid + "/" + name
+        self.puts[name] = staged
+        if name in self.deletes:
+            self.deletes.remove(name)
+        return staged
+
+    def delete(self, name):
+        """ Delete the named file (or directory of files) from the container, if it is there """
+        for put in self.puts.keys():
+            if put == name or put.startswith(name + "/"):
+                del self.puts[put]
+        if name not in self.deletes:
+            self.deletes.append(name)
+
+    def deleted(self, name):
+        parts = name.split("/")
+        return any(["/".join(parts[:i]) in self.deletes for i in range(1, len(parts) + 1)])
+
+    def locate(self, name):
+        """ The name in the container which holds the current version of the named file, or None if it is deleted """
+        if name in self.puts:
+            return self.puts[name]
+        if self.deleted(name):
+            return None
+        return name
+
+    def list(self, names):
+        """ The top level names in the container, given those which are there outside the transaction """
+        names = [n for n in names if not n.startswith(STAGING) and not self.deleted(n)]
+        for name in self.puts.keys():
+            top = name.split("/")[0]
+            if top not in names:
+                names.append(top)
+        return names
+
+    def commit(self):
+        try:
+            for stage in self.before_commit:
+                stage()
+        except:
+            self.abort()
+            raise
+        record = self.record("committed")
+        try:
+            self.journal.write(record)
+            self.journal.apply(record)
+            self.journal.close(self.txid)
+        finally:
+            self._finish()
+        # blobs are only released once the transaction is closed, so that recovery never releases one twice; a crash
+        # here leaves a blob with an extra reference, which wastes space but loses nothing
+        for sha256 in self.releases:
+            self.blobs.release(sha256)
+        ssslog.debug("Committed transaction " + self.txid + " on " + self.collection + "/" + self.id)
+
+    def abort(self):
+        try:
+            self.journal.roll_back(self.record("open"))
+            self.journal.close(self.txid)
+        finally:
+            self._finish()
+        ssslog.debug("Aborted transaction " + self.txid + " on " + self.collection + "/" + self.id)
+
+    def _finish(self):
+        self.finished = True
+        if self.lock is not None:
+            self.lock.release()
+
+    def record(self, state):
+        record = {
+            "txid" : self.txid,
+            "state" : state,
+            "collection" : self.collection,
+            "id" : self.id,
+            "created" : self.created,
+            "host" : socket.gethostname(),
+            "pid" : os.getpid(),
+            "started" : self.started
+        }
+        # a committed transaction is applied from its changes, and an open one is rolled back by removing its staging
+        # directory, and releasing the blobs it referenced
+        if state == "committed":
+            record["puts"] = self.puts
+            record["deletes"] = self.deletes
+        else:
+            record["acquired"] = self.acquired
+        return record
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.finished:
+            return
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.commit()
+
+class Journal(object):
+    """ The journals of the open transactions, in the internal .journal collection of the storage backend """
+    COLLECTION = ".journal"
+    CONTAINER = "open"
+
+    def __init__(self, backend, locks=None, blobs=None):
+        self.backend = backend
+        self.locks = locks if locks is not None else ContainerLocks(backend.config)
+        self.blobs = blobs if blobs is not None else BlobStore(backend, backend.config)
+
+    def write(self, record):
+        # the filesystem backend writes each file to a temp file and renames it into place, and an S3 PUT replaces
+        # the whole object, so the journal is always either the old record or the new one
+        self.backend.put_blob(self.COLLECTION, self.CONTAINER, record["txid"], json.dumps(record))
+
+    def read(self, txid):
+        return json.loads(self.backend.get_blob(self.COLLECTION, self.CONTAINER, txid))
+
+    def close(self, txid):
+        if self.backend.blob_exists(self.COLLECTION, self.CONTAINER, txid):
+            self.backend.delete_blob(self.COLLECTION, self.CONTAINER, txid)
+
+    def open_transactions(self):
+        """ The ids of the transactions which have journals """
+        try:
+            txids = self.backend.list_blobs(self.COLLECTION, self.CONTAINER)
+        except (OSError, StorageError):
+            # no transaction has been journalled yet
+            return []
+        return [txid for txid in txids if not txid.startswith("sss_tmp.")]
+
+    def apply(self, record):
+        """ Apply the changes of a committed transaction, as far as they have not been applied already """
+        collection, id = record["collection"], record["id"]
+        for name in record["deletes"]:
+            self._delete(collection, id, name)
+        for name, staged in record["puts"].items():
+            if self.backend.blob_exists(collection, id, staged):
+                self.backend.rename_blob(collection, id, staged, name)
+        self._clean(record)
+
+    def roll_back(self, record):
+        """
+        Throw away whatever a transaction which did not commit staged, and the container if it was creating it, and
+        then release the references it added to blobs (the hard links among them having gone with what it staged)
+        """
+        collection, id = record["collection"], record["id"]
+        if record["created"]:
+            if self.backend.container_exists(collection, id):
+                self.backend.remove_container(collection, id)
+        else:
+            self._clean(record)
+
+        # each blob is taken out of the journal before it is released, so that a crash part way through leaves a blob
+        # with an extra reference rather than releasing one twice
+        record = dict(record, acquired=list(record.get("acquired", [])))
+        while len(record["acquired"]) > 0:
+            sha256 = record["acquired"].pop()
+            self.write(record)
+            self.blobs.release(sha256)
+
+    def _clean(self, record):
+        """ remove the staging directory of the transaction """
+        self._delete(record["collection"], record["id"], STAGING + record["txid"])
+
+    def _delete(self, collection, id, name):
+        # whether or not it is there (an S3 "directory" cannot be tested for, and it may have been deleted already)
+        try:
+            self.backend.delete_blob(collection, id, name)
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def recover(self):
+        """
+        Complete or roll back the transactions which were left open by processes which are no longer running.
+        Returns the number of transactions recovered
+        """
+        recovered = 0
+        for txid in self.open_transactions():
+            try:
+                record = self.read(txid)
+            except (ValueError, IOError, OSError):
+                # it has just been closed, or was never completely written
+                continue
+            if self._is_live(record):
+                continue
+
+            # a transaction holds the lock on its container until it is finished, so one whose process is running
+            # after all (another host's, or one whose pid has been reused) has closed its journal by the time the
+            # lock is ours
+            try:
+                lock = self.locks.lock(record["collection"], record["id"])
+            except LockTimeout:
+                ssslog.warn("Not recovering transaction " + txid + ", as the lock on " + record["collection"] + "/" + record["id"] + " is held")
+                continue
+            with lock:
+                try:
+                    record = self.read(txid)
+                except (ValueError, IOError, OSError):
+                    continue
+                if record["state"] == "committed":
+                    ssslog.info("Recovering transaction " + txid + " on " + record["collection"] + "/" + record["id"] + " by completing it")
+                    self.apply(record)
+                else:
+                    ssslog.info("Recovering transaction " + txid + " on " + record["collection"] + "/" + record["id"] + " by rolling it back")
+                    self.roll_back(record)
+                self.close(txid)
+            recovered += 1
+        return recovered
+
+    def _is_live(self, record):
+        """ Might the process which started the transaction still be running? """
+        if record.get("host") != socket.gethostname():
+            return time.time() - record.get("started", 0) < FOREIGN_JOURNAL_AGE
+        if record.get("pid") == os.getpid():
+            return True
+        try:
+            os.kill(record.get("pid"), 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
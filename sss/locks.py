@@ -0,0 +1,212 @@
+"""
+Advisory locks on containers, so that concurrent requests which change the same container (in any number of threads
+and worker processes) take turns, while those which change different containers go ahead in parallel.
+
+Each container has a lock file in the lock_dir (by default, .locks in the store_dir), which must be the same
+directory for every process writing to the store.  The lock_method is one of:
+
+- "fcntl": an exclusive flock on the lock file, which the operating system releases if the process dies.  This is the
+  default, and the one to use when the lock_dir is on a local disk
+- "lockfile": the lock file is created exclusively while the lock is held, and removed when it is released, which
+  works on shared filesystems (such as NFS) where flock cannot be relied upon.  A lock file left behind by a process
+  which died is broken straight away if the process was on this host, and otherwise once it is lock_stale_after
+  seconds old
+- "none": no locking, for a deployment with a single worker
+
+Threads within a process also take turns through an in-process lock, as flock does not always keep them apart (it
+is emulated with per-process POSIX locks on NFS, for example).  A request which cannot get a lock within lock_timeout
+seconds gives up with LockTimeout.
+"""
+import os, errno, hashlib, json, socket, threading, time
+
+try:
+    import fcntl
+except ImportError:
+    # not on this platform, so only the lockfile method can be used
+    fcntl = None
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+LOCK_FCNTL = "fcntl"
+LOCK_FILE = "lockfile"
+LOCK_NONE = "none"
+LOCK_METHODS = [LOCK_FCNTL, LOCK_FILE, LOCK_NONE]
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_STALE_AFTER = 600
+
+# the in-process locks, by lock file path, with the number of threads using each one
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+class LockTimeout(Exception):
+    """ Raised when a container's lock could not be acquired in time """
+    pass
+
+class ContainerLocks(object):
+    """ The locks on the containers in the store """
+    def __init__(self, config):
+        self.method = config.lock_method or LOCK_FCNTL
+        if self.method not in LOCK_METHODS:
+            raise ValueError("unknown lock_method: " + self.method + "; use one of " + ", ".join(LOCK_METHODS))
+        if self.method == LOCK_FCNTL and fcntl is None:
+            self.method = LOCK_FILE
+        store_dir = config.store_dirs[0] if config.store_dirs else config.store_dir
+        self.lock_dir = config.lock_dir or os.path.join(store_dir or ".", ".locks")
+        self.timeout = config.lock_timeout if config.lock_timeout is not None else DEFAULT_TIMEOUT
+        self.stale_after = config.lock_stale_after if config.lock_stale_after is not None else DEFAULT_STALE_AFTER
+
+    def lock(self, collection, id):
+        """
+        Acquire the lock on the container, waiting up to the lock_timeout for it.  Use the returned ContainerLock
+        in a with statement, or release it when done
+        """
+        digest = hashlib.md5(collection + "/" + id).hexdigest()
+        # the methods use differently named files, as an flock file is left in place when it is unlocked
+        suffix = ".lockfile" if self.method == LOCK_FILE else ".lock"
+        lock = ContainerLock(self, os.path.join(self.lock_dir, digest[:2], digest + suffix), collection + "/" + id)
+        lock.acquire()
+        return lock
+
+class ContainerLock(object):
+    """ A held lock on one container """
+    def __init__(self, locks, path, name):
+        self.locks = locks
+        self.path = path
+        self.name = name
+        self.fd = None
+        self.held = False
+
+    def acquire(self):
+        if self.locks.method == LOCK_NONE:
+            return
+        deadline = time.time() + self.locks.timeout
+        thread_lock = self._thread_lock()
+        try:
+            _wait(lambda: thread_lock.acquire(False), deadline, self.name)
+            try:
+                if self.locks.method == LOCK_FCNTL:
+                    self._acquire_fcntl(deadline)
+                else:
+                    self._acquire_file(deadline)
+            except:
+                thread_lock.release()
+                raise
+        except:
+            self._forget_thread_lock()
+            raise
+        self.held = True
+
+    def release(self):
+        if not self.held:
+            return
+        self.held = False
+        try:
+            if self.fd is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = None
+            elif self.locks.method == LOCK_FILE:
+                os.remove(self.path)
+        finally:
+            _thread_locks[self.path][0].release()
+            self._forget_thread_lock()
+
+    def _acquire_fcntl(self, deadline):
+        _makedirs(os.path.dirname(self.path))
+        self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0644)
+        def attempt():
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                return False
+        try:
+            _wait(attempt, deadline, self.name)
+        except:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def _acquire_file(self, deadline):
+        _makedirs(os.path.dirname(self.path))
+        owner = json.dumps({"host" : socket.gethostname(), "pid" : os.getpid(), "time" : time.time()})
+        def attempt():
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._break_if_stale()
+                return False
+            try:
+                os.write(fd, owner)
+            finally:
+                os.close(fd)
+            return True
+        _wait(attempt, deadline, self.name)
+
+    def _break_if_stale(self):
+        """ remove the lock file if the process which made it has died """
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+            with open(self.path) as f:
+                owner = json.loads(f.read())
+        except (IOError, OSError):
+            # it has just been released
+            return
+        except ValueError:
+            # it is still being written, unless its process died before it could be
+            owner = {}
+        if owner.get("host") == socket.gethostname():
+            try:
+                os.kill(owner.get("pid"), 0)
+                return
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    return
+        elif age < self.locks.stale_after:
+            return
+        ssslog.info("Breaking the stale lock on " + self.name + ", which was held by " + str(owner))
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _thread_lock(self):
+        with _thread_locks_lock:
+            entry = _thread_locks.setdefault(self.path, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _forget_thread_lock(self):
+        with _thread_locks_lock:
+            entry = _thread_locks[self.path]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _thread_locks[self.path]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def _wait(attempt, deadline, name):
+    """ Call attempt until it returns True, backing off between tries, or raise LockTimeout at the deadline """
+    delay = 0.001
+    while not attempt():
+        if time.time() >= deadline:
+            raise LockTimeout("timed out waiting for the lock on " + name)
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        delay = min(delay * 2, 0.1)
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
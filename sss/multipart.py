@@ -0,0 +1,247 @@
+"""
+Incremental parser for the multipart/related bodies of Atom Multipart deposits.
+
+The body is read from the stream (e.g. wsgi.input) in fixed size buffers.  The Atom Entry part is held in memory, but
+every other part is decoded into a SpooledBody as it arrives, so unless it is small it goes straight into the temp
+directory, and the memory used by a multipart deposit is bounded by the size of the Entry plus one buffer.  The
+headers of each part are kept, so that the Content-Disposition, Packaging and Content-MD5 of the Media Part can be
+interpreted just like the HTTP headers of a binary deposit
+"""
+import base64, binascii, re
+from StringIO import StringIO
+
+from spec import ValidationException
+from spool import SpooledBody, MaxSizeExceeded, DEFAULT_CHUNK_SIZE
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+# the largest block of part headers that we will accept
+MAX_HEADER_SIZE = 65536
+
+class MultipartPart(object):
+    """
+    One part of a multipart body.  The Atom Entry part has its decoded content in content; every other part has its
+    decoded content in body, which is a SpooledBody
+    """
+    def __init__(self, headers):
+        self.headers = headers
+        self.content = None
+        self.body = None
+
+    def get_header(self, name):
+        for k, v in self.headers.items():
+            if k.lower() == name.lower():
+                return v
+        return None
+
+    @property
+    def name(self):
+        """ The name parameter of the part's Content-Disposition, if there is one """
+        cd = self.get_header("content-disposition")
+        if cd is None:
+            return None
+        match = re.search(r'name\s*=\s*"?([^";]*)"?', cd)
+        return match.group(1).strip() if match is not None else None
+
+    @property
+    def content_type(self):
+        return self.get_header("content-type")
+
+    def is_entry(self):
+        """ Is this the Atom Entry part of an Atom Multipart deposit? """
+        if self.name is not None:
+            return self.name == "atom"
+        return self.content_type is not None and self.content_type.startswith("application/atom+xml")
+
+def get_boundary(content_type):
+    """ Extract the boundary parameter from the supplied multipart Content-Type """
+    match = re.search(r'boundary\s*=\s*("([^"]*)"|([^;\s]*))', content_type or "")
+    if match is None or (match.group(2) or match.group(3)) is None:
+        raise ValidationException("Multipart request has no boundary in its Content-Type")
+    return match.group(2) if match.group(2) is not None else match.group(3)
+
+def parse_multipart(stream, content_type, tmp_dir, size=None, buffer_size=None, threshold=None, durability=None,
+                    max_size=None):
+    """
+    Parse the multipart body in the supplied stream, reading no more than size bytes (or to the end of the stream,
+    if size is None) in buffers of buffer_size.  Any part which is not an Atom Entry is decoded into a SpooledBody,
+    with the supplied tmp_dir, memory threshold and durability mode.  If the body cannot be parsed, any spooled bodies
+    are discarded and a ValidationException is raised; if it turns out to be larger than max_size, they are discarded
+    and MaxSizeExceeded is raised.
+    Returns the list of MultipartPart objects in the order in which they appeared in the body
+    """
+    parser = _MultipartParser(stream, get_boundary(content_type), size, buffer_size or DEFAULT_CHUNK_SIZE, max_size)
+    parts = []
+    try:
+        for headers in parser.headers():
+            part = MultipartPart(headers)
+            parts.append(part)
+            if part.is_entry():
+                sink = StringIO()
+                parser.read_body(_decoder(part, sink))
+                part.content = sink.getvalue()
+                ssslog.debug("Read multipart Entry part of " + str(len(part.content)) + " bytes")
+            else:
+                part.body = SpooledBody(tmp_dir, threshold, durability)
+                parser.read_body(_decoder(part, part.body))
+                part.body.close()
+                ssslog.debug("Read multipart part " + str(part.name) + " of " + str(part.body.size) + " bytes")
+    except:
+        for part in parts:
+            if part.body is not None:
+                part.body.discard()
+        raise
+    return parts
+
+def get_entry_and_media_parts(parts):
+    """
+    Check that the supplied parts make an Atom Multipart deposit, and return a tuple of the Entry part and the Media
+    Part
+    """
+    if len(parts) != 2:
+        raise ValidationException("Multipart request does not contain exactly 2 parts")
+    names = [part.name for part in parts]
+    if "atom" not in names and "payload" not in names:
+        raise ValidationException("Multipart request must contain Content-Dispositions with names 'atom' and 'payload'")
+    entries = [part for part in parts if part.is_entry()]
+    if len(entries) != 1:
+        raise ValidationException("Multipart request must contain exactly one Atom Entry part")
+    entry = entries[0]
+    media = parts[1] if parts[0] is entry else parts[0]
+    return entry, media
+
+def _decoder(part, sink):
+    """ Wrap the sink so that the part's Content-Transfer-Encoding is undone as the part is written into it """
+    cte = part.get_header("content-transfer-encoding")
+    if cte is not None and cte.strip().lower() == "base64":
+        return _Base64Decoder(sink)
+    return sink
+
+class _Base64Decoder(object):
+    """ File-like object which decodes base64 content written to it in arbitrary pieces and writes it to the sink """
+    def __init__(self, sink):
+        self.sink = sink
+        self.pending = ""
+
+    def write(self, data):
+        self.pending += "".join(data.split())
+        usable = len(self.pending) - (len(self.pending) % 4)
+        if usable > 0:
+            self._decode(self.pending[:usable])
+            self.pending = self.pending[usable:]
+
+    def close(self):
+        if self.pending != "":
+            raise ValidationException("Multipart request contains a part with truncated base64 content")
+
+    def _decode(self, data):
+        try:
+            self.sink.write(base64.b64decode(data))
+        except (TypeError, binascii.Error):
+            raise ValidationException("Multipart request contains a part with invalid base64 content")
+
+class _MultipartParser(object):
+    """ The state machine which finds the boundaries and headers in the stream, and copies part bodies out of it """
+    def __init__(self, stream, boundary, size, buffer_size, max_size=None):
+        self.stream = stream
+        self.remaining = size
+        self.buffer_size = buffer_size
+        self.max_size = max_size
+        self.read = 0
+        self.delimiter = "--" + boundary
+        self.body_delimiter = "\r\n" + self.delimiter
+        self.buf = ""
+        self.eof = False
+
+    def _fill(self):
+        """ Read another buffer from the stream, returning False if there is nothing more to read """
+        if self.eof:
+            return False
+        to_read = self.buffer_size if self.remaining is None else min(self.buffer_size, self.remaining)
+        chunk = self.stream.read(to_read) if to_read > 0 else ""
+        if chunk is None or chunk == "":
+            self.eof = True
+            return False
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self.read += len(chunk)
+        if self.max_size is not None and self.read > self.max_size:
+            raise MaxSizeExceeded(self.max_size)
+        self.buf += chunk
+        return True
+
+    def _need(self, n):
+        """ Make sure that there are at least n bytes in the buffer, if the stream has that many left """
+        while len(self.buf) < n and self._fill():
+            pass
+        return len(self.buf) >= n
+
+    def headers(self):
+        """ Generator over the header dictionaries of the parts; the body of each must be read before moving on """
+        # skip the preamble, up to and including the first delimiter
+        while True:
+            idx = self.buf.find(self.delimiter)
+            if idx > -1:
+                self.buf = self.buf[idx + len(self.delimiter):]
+                break
+            self.buf = self.buf[-len(self.delimiter):]
+            if not self._fill():
+                raise ValidationException("Multipart request does not contain the boundary from its Content-Type")
+
+        while True:
+            # after each delimiter is either "--" to close the body, or the end of the line and the next part
+            if not self._need(2):
+                raise ValidationException("Multipart request is truncated")
+            if self.buf.startswith("--"):
+                return
+            while self.buf.find("\r\n") == -1:
+                if len(self.buf) > MAX_HEADER_SIZE or not self._fill():
+                    raise ValidationException("Multipart request has a malformed boundary line")
+            self.buf = self.buf[self.buf.find("\r\n") + 2:]
+
+            # then the part headers, up to the blank line
+            self._need(2)
+            if self.buf.startswith("\r\n"):
+                self.buf = self.buf[2:]
+                yield {}
+                continue
+            while self.buf.find("\r\n\r\n") == -1:
+                if len(self.buf) > MAX_HEADER_SIZE or not self._fill():
+                    raise ValidationException("Multipart request has malformed part headers")
+            idx = self.buf.find("\r\n\r\n")
+            block = self.buf[:idx]
+            self.buf = self.buf[idx + 4:]
+            yield self._parse_headers(block)
+
+    def read_body(self, sink):
+        """ Copy the body of the current part into the sink, up to and including the next delimiter """
+        keep = len(self.body_delimiter) - 1
+        while True:
+            idx = self.buf.find(self.body_delimiter)
+            if idx > -1:
+                sink.write(self.buf[:idx])
+                self.buf = self.buf[idx + len(self.body_delimiter):]
+                break
+            if len(self.buf) > keep:
+                sink.write(self.buf[:-keep])
+                self.buf = self.buf[-keep:]
+            if not self._fill():
+                raise ValidationException("Multipart request is truncated")
+        if isinstance(sink, _Base64Decoder):
+            sink.close()
+
+    def _parse_headers(self, block):
+        headers = {}
+        name = None
+        for line in block.split("\r\n"):
+            if line[:1] in [" ", "\t"] and name is not None:
+                # a folded continuation of the previous header
+                headers[name] += " " + line.strip()
+                continue
+            if ":" not in line:
+                raise ValidationException("Multipart request has a malformed part header: " + line)
+            name, value = line.split(":", 1)
+            name = name.strip()
+            headers[name] = value.strip()
+        return headers
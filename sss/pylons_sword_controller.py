@@ -7,7 +7,9 @@ import re, base64, urllib, uuid, inspect
 from core import Auth, SwordError, AuthException, DepositRequest, DeleteRequest
 from negotiator import ContentNegotiator, AcceptParameters, ContentType
 from spec import Errors, HttpHeaders, ValidationException
-
+from spool import spool_body, parse_content_encoding, DecodingReader, MaxSizeExceeded, UnsupportedContentEncoding, ContentEncodingError
+from multipart import parse_multipart, get_entry_and_media_parts
+from responses import file_size, file_body
 
 import logging
 ssslog = logging.getLogger(__name__)
@@ -39,8 +41,116 @@ class SwordController(WSGIController):
         # available in environ['pylons.routes_dict']
         return WSGIController.__call__(self, environ, start_response)
 
+    def __after__(self):
+        """ Remove any temp files that were created to hold the request body """
+        for body in getattr(self, "_spooled_bodies", []):
+            body.discard()
+
     # Generically useful methods
     ############################
+    
+    def _content_length(self):
+        try:
+            return int(request.environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return 0
+    
+    def _is_chunked(self):
+        return "chunked" in request.environ.get("HTTP_TRANSFER_ENCODING", "").lower()
+    
+    def _body_size(self):
+        # the length of a chunked body (which the server decodes for us) is not
+        # known until it has all been read, so there is no size to read up to
+        if self._is_chunked():
+            return None
+        return self._content_length()
+    
+    def _send_file(self, f):
+        # the content of the file (or stream) as the body of the response, without reading it into memory: a file on
+        # the disk goes to the server's wsgi.file_wrapper, so that it can be sent with sendfile, with its
+        # Content-Length (which is set after the app_iter, as setting that clears it), and is closed by the server
+        # once it has finished with it (see responses.py)
+        response.app_iter = file_body(request.environ, f, config.copy_chunk_size)
+        size = file_size(f)
+        if size is not None:
+            response.content_length = size
+
+    def set_etag(self, version):
+        """ Give the version of the container in the response, for the client to send back in If-Match """
+        if version is not None:
+            response.headers["ETag"] = '"' + str(version) + '"'
+
+    def _request_stream(self):
+        # the stream to read the body from, and the number of bytes to read from
+        # it (None to read to the end).  A gzip or deflate encoded body is decoded
+        # as it is read, and the max upload size applies to both the encoded bytes
+        # (checked by the DecodingReader) and the decoded ones (checked by whoever
+        # reads from it), so a small body cannot decompress to something huge
+        wsgi_input = request.environ['wsgi.input']
+        encoding = parse_content_encoding(request.environ.get("HTTP_CONTENT_ENCODING"))
+        if encoding is None:
+            return wsgi_input, self._body_size()
+        return DecodingReader(wsgi_input, encoding, self._body_size(), config.copy_chunk_size, config.max_upload_size), None
+    
+    def _max_upload_size_error(self):
+        return SwordError(error_uri=Errors.max_upload_size_exceeded, 
+                            msg="Max upload size is " + str(config.max_upload_size) + 
+                            "; incoming content exceeded it")
+    
+    def read_body(self):
+        """
+        Read the request body from wsgi.input into a SpooledBody (in memory if it is small, in a temp file if not),
+        which digests the content on its way in and can be re-read.  Any temp file will be removed once the request
+        has been dealt with
+        """
+        wsgi_input, size = self._request_stream()
+        try:
+            body = spool_body(wsgi_input, config.tmp_dir, size, config.copy_chunk_size,
+                                config.max_copy_chunk_size, config.spool_memory_threshold, config.spool_durability,
+                                config.max_upload_size)
+        except MaxSizeExceeded as e:
+            raise self._max_upload_size_error()
+        except ContentEncodingError as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=str(e))
+        self._spooled_bodies = getattr(self, "_spooled_bodies", []) + [body]
+        
+        # the checksum was computed while the content was being spooled, so we
+        # can check it now without reading the content again.  The Content-MD5
+        # of an encoded body is of the bytes as they were sent, not as decoded
+        md5 = wsgi_input.md5 if isinstance(wsgi_input, DecodingReader) else body.md5
+        self._check_md5(request.environ.get("HTTP_CONTENT_MD5"), body, md5)
+        return body
+
+    def read_multipart(self):
+        """
+        Parse the multipart body as it is read from wsgi.input, keeping the Atom Entry part in memory and reading the
+        Media Part into a SpooledBody, and return a tuple of the entry part and the media part.  Any temp file will be
+        removed once the request has been dealt with
+        """
+        wsgi_input, size = self._request_stream()
+        try:
+            parts = parse_multipart(wsgi_input, request.environ.get("CONTENT_TYPE"), config.tmp_dir,
+                                    size, config.copy_chunk_size, config.spool_memory_threshold,
+                                    config.spool_durability, config.max_upload_size)
+            self._spooled_bodies = getattr(self, "_spooled_bodies", []) + [p.body for p in parts if p.body is not None]
+            entry_part, media_part = get_entry_and_media_parts(parts)
+        except ValidationException as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=e.message)
+        except MaxSizeExceeded as e:
+            raise self._max_upload_size_error()
+        except ContentEncodingError as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=str(e))
+        
+        # the Content-MD5 of the media part is in its own headers
+        self._check_md5(media_part.get_header(HttpHeaders.content_md5), media_part.body)
+        return entry_part, media_part
+
+    def _check_md5(self, content_md5, body, md5=None):
+        md5 = md5 if md5 is not None else body.md5
+        if content_md5 is not None and content_md5.strip() != md5:
+            ssslog.info("Content-MD5 " + content_md5 + " does not match spooled content " + md5 + "; discarding")
+            body.discard()
+            raise SwordError(error_uri=Errors.checksum_mismatch, msg="Content-MD5 header does not match file checksum")
 
     def authenticate(self):
         # first check to see if there's a repoze.who auth
@@ -108,6 +218,31 @@ class SwordController(WSGIController):
         
         return auth
     
+    def check_deposit_preconditions(self, auth):
+        """
+        Check everything about a deposit request that can be determined from its headers alone.  This must be done
+        before any of the body is read from wsgi.input, so that a client which sent Expect: 100-continue can get its
+        final status without ever sending the body.  That only holds on servers which send 100 Continue lazily, when
+        the application first reads the body (such as mod_wsgi); others (such as the CherryPy wsgiserver bundled with
+        web.py) send it as soon as they have the headers, so the client sends the body anyway
+        """
+        # have we been asked to do a mediated deposit, when this is not allowed?
+        if auth is not None and auth.on_behalf_of is not None and not config.mediation:
+            raise SwordError(error_uri=Errors.mediation_not_allowed)
+        
+        # can we decode the content?
+        try:
+            parse_content_encoding(request.environ.get("HTTP_CONTENT_ENCODING"))
+        except UnsupportedContentEncoding as e:
+            raise SwordError(error_uri=Errors.content, status=415, msg=str(e))
+        
+        # is the content going to be too large?
+        content_length = self._content_length()
+        if config.max_upload_size is not None and content_length > config.max_upload_size:
+            raise SwordError(error_uri=Errors.max_upload_size_exceeded, 
+                            msg="Max upload size is " + str(config.max_upload_size) + 
+                            "; incoming content length was " + str(content_length))
+    
     def manage_error(self, sword_error):
         response.status_int = sword_error.status
         ssslog.info("Returning error (" + str(sword_error.status) + ") - " + str(sword_error.error_uri))
@@ -143,43 +278,22 @@ class SwordController(WSGIController):
   
         # run the validation
         try:
-            # there must be both an "atom" and "payload" input or data in web.data()
-            
-            # FIXME: deposit does NOT support multipart
-            if request.environ["CONTENT_TYPE"].startswith("multipart"):
-                raise SwordError(error_uri=Errors.method_not_allowed, msg="Pylons implementation does not currently support multipart/related requests")
-            """
-            # leave this out until we can get multipart sorted (at a later date)
-            webin = request.POST
-            if len(webin) != 2 and len(webin) > 0:
-                raise ValidationException("Multipart request does not contain exactly 2 parts")
-            if len(webin) >= 2 and not webin.has_key("atom") and not webin.has_key("payload"):
-                raise ValidationException("Multipart request must contain Content-Dispositions with names 'atom' and 'payload'")
-            if len(webin) > 0 and not allow_multipart:
-                raise ValidationException("Multipart request not permitted in this context")
-            """
-            
             # if we get to here then we have a valid multipart or no multipart
             is_multipart = False
             is_empty = False
-            #if len(webin) != 2: # if it is not multipart
-                # FIXME: this is reading everything in, and should be re-evaluated for performance/scalability
-            # wsgi_input = request.environ['wsgi.input']
-            f = request.body_file
-            f.seek(0, 0)
-            
-            # FIXME: can't we just look at the Content-Type header????
             
-            # read a byte in, to see if the body is empty
-            if f is not None:
-                byte = f.read(1)
-                if byte == "" and allow_empty:
-                    ssslog.debug("first byte of deposit request is the empty string")
-                    is_empty = True
-                else:
-                    ssslog.debug("first byte of deposit request is \"" + str(byte) + "\" ... not an empty request")
-                f.seek(0, 0)
-            else:
+            # the parts of a multipart request are checked as the body is parsed
+            # (see read_multipart), so here we only look at the Content-Type
+            if (request.environ.get("CONTENT_TYPE") or "").startswith("multipart/"):
+                if not allow_multipart:
+                    raise ValidationException("Multipart request not permitted in this context")
+                ssslog.info("Validating a multipart deposit")
+                is_multipart = True
+            
+            # NOTE: we look only at the headers to see if the body is empty, as the
+            # body itself must not be read until get_deposit streams it to disk
+            if not is_multipart and self._body_size() == 0:
+                ssslog.debug("Content-Length of deposit request is 0")
                 is_empty = True
                 
             # validate whether we allow an empty deposit
@@ -188,10 +302,6 @@ class SwordController(WSGIController):
             elif is_empty and allow_empty:
                 ssslog.info("Validating an empty deposit (could be a control operation)")
             
-            #else:
-            #    ssslog.info("Validating a multipart deposit")
-            #    is_multipart = True
-            
             is_entry = False
             content_type = mapped_headers.get("CONTENT-TYPE")
             if content_type is not None and content_type.startswith("application/atom+xml"):
@@ -275,7 +385,6 @@ class SwordController(WSGIController):
     '''
     
     def get_deposit(self, auth=None, atom_only=False):
-        # FIXME: this does not deal with the Media Part headers on a multipart deposit
         """
         Take a request object and extract from it the parameters and content required for a SWORD deposit.  This
         includes determining whether this is an Atom Multipart request or not, and extracting the atom/payload where
@@ -295,51 +404,43 @@ class SwordController(WSGIController):
         if d.content_type.startswith("application/atom+xml"):
             atom_only=True
         
+        # NOTE: the content length has already been checked against the max upload
+        # size by check_deposit_preconditions (and a chunked body, which has no
+        # content length, is checked as it is read)
         empty_request = False
-        if d.content_length == 0:
+        if self._body_size() == 0:
             ssslog.info("Received empty deposit request")
             empty_request = True
-        if config.max_upload_size is not None and d.content_length > config.max_upload_size:
-            raise SwordError(error_uri=Errors.max_upload_size_exceeded, 
-                            msg="Max upload size is " + str(config.max_upload_size) + 
-                            "; incoming content length was " + str(d.content_length))
         
-        # FIXME: this method does NOT support multipart
         # find out if this is a multipart or not
         is_multipart = False
         
-        # FIXME: these headers aren't populated yet, because the webpy api doesn't
-        # appear to have a mechanism to retrieve them.  urgh.
-        #entry_part_headers = {}
-        #media_part_headers = {}
-        #webin = request.POST
-        #ssslog.debug(webin)
-        #if len(webin) == 2:
-        #    ssslog.info("Received multipart deposit request")
-        #    d.atom = webin['atom']
-            # FIXME: this reads the payload into memory, we need to sort that out
-            # read the zip file from the base64 encoded string
-        #    d.content = base64.decodestring(webin['payload'])
-        #    is_multipart = True
-        #elif not empty_request:
-        if not empty_request:
-            # for this section, we have to reset the file pointer in the body_file
-            # part of the request back to the start, since it may have 
-            # already been read once
-            f = request.body_file
-            f.seek(0, 0)
-            
-            # if this wasn't a multipart, and isn't an empty request, then read the 
-            # data from the body_file
+        entry_part_headers = {}
+        media_part_headers = {}
+        if d.content_type.startswith("multipart/"):
+            ssslog.info("Received multipart deposit request")
+            entry_part, media_part = self.read_multipart()
+            d.atom = entry_part.content
+            d.body = media_part.body
+            entry_part_headers = entry_part.headers
+            media_part_headers = media_part.headers
+            
+            # in a multipart deposit the Packaging and Content-MD5 belong to the
+            # media part, so they are taken from its headers
+            d.set_from_headers(self._media_part_sword_headers(media_part_headers))
+            is_multipart = True
+        elif not empty_request:
+            # if this wasn't a multipart, and isn't an empty request, then stream
+            # the body from wsgi.input into a spooled body
+            body = self.read_body()
             if atom_only:
                 # we don't worry about scalability here - the entries should be
-                # generally small
+                # generally small, and will usually not have left memory
                 ssslog.info("Received Entry deposit request")
-                d.atom = f.read()
+                d.atom = body.getvalue()
             else:
                 ssslog.info("Received Binary deposit request")
-                # FIXME: this is reading everything in, and should be re-evaluated for performance/scalability
-                d.content_file = f
+                d.body = body
         
         if is_multipart:
             d.filename = h.extract_filename(media_part_headers)
@@ -350,6 +451,10 @@ class SwordController(WSGIController):
         d.auth = auth
         return d
     
+    def _media_part_sword_headers(self, media_part_headers):
+        normalised_dict = dict([(h.lower(), v) for h, v in media_part_headers.items()])
+        return dict([(h, normalised_dict[h]) for h in [HttpHeaders.packaging, HttpHeaders.content_md5] if h in normalised_dict])
+    
     ''' ORIGINAL NOT SCALEABLE IMPL    
     def get_deposit(self, auth=None, atom_only=False):
         # FIXME: this reads files into memory, and therefore does not scale
@@ -596,6 +701,9 @@ class SwordController(WSGIController):
             # authenticate
             auth = self.authenticate()
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(auth)
+            
             # check the validity of the request
             self.validate_deposit_request("6.3.3", "6.3.1", "6.3.2")
         
@@ -611,6 +719,7 @@ class SwordController(WSGIController):
             ssslog.info("Item created")
             response.content_type = "application/atom+xml;type=entry"
             response.headers["Location"] = str(result.location) # explicit cast to string
+            self.set_etag(result.etag)
             response.status_int = 201
             response.status = "201 Created"
             if config.return_deposit_receipt:
@@ -668,13 +777,13 @@ class SwordController(WSGIController):
             return
         else:
             response.content_type = media_resource.content_type
+            self.set_etag(media_resource.etag)
             if media_resource.packaging is not None:
                 response.headers["Packaging"] = str(media_resource.packaging)
-            f = open(media_resource.filepath, "r")
             response.status_int = 200
             response.status = "200 OK"
             ssslog.info("Returning " + response.status + " from request on " + inspect.stack()[0][3])
-            return f.read()
+            self._send_file(media_resource.stream)
 
     def _PUT_media_resource(self, path=None):
         """
@@ -694,6 +803,9 @@ class SwordController(WSGIController):
         try:
             auth = self.authenticate()
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(auth)
+            
             # check the validity of the request (note that multipart requests 
             # and atom-only are not permitted in this method)
             self.validate_deposit_request(None, "6.5.1", None, allow_multipart=False)
@@ -708,6 +820,7 @@ class SwordController(WSGIController):
             
             # replaced
             ssslog.info("Content replaced")
+            self.set_etag(result.etag)
             response.status_int = 204
             response.status = "204 No Content" # notice that this is different from the POST as per AtomPub
             ssslog.info("Returning " + response.status + " from request on " + inspect.stack()[0][3])
@@ -734,6 +847,9 @@ class SwordController(WSGIController):
         try:
             auth = self.authenticate()
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(auth)
+            
             # check the validity of the request
             self.validate_deposit_request(None, "6.7.1", None, allow_multipart=False)
             
@@ -745,6 +861,7 @@ class SwordController(WSGIController):
             
             response.content_type = "application/atom+xml;type=entry"
             response.headers["Location"] = str(result.location) # explict cast to str
+            self.set_etag(result.etag)
             response.status_int = 201
             response.status = "201 Created"
             if config.return_deposit_receipt:
@@ -787,6 +904,7 @@ class SwordController(WSGIController):
             # carry out the delete
             ss = SwordServer(config, auth)
             result = ss.delete_content(path, delete)
+            self.set_etag(result.etag)
             
             # just return, no need to give any more feedback
             response.status_int = 204
@@ -834,8 +952,11 @@ class SwordController(WSGIController):
             if accept_parameters is None:
                 raise SwordError(error_uri=Error.content, status=415, empty=True)
             
-            # now actually get hold of the representation of the container and send it to the client
+            # now actually get hold of the representation of the container and send it to the client, with the
+            # version read first, so that if the container changes in between it is the version which is stale
+            version = ss.get_version(path)
             cont = ss.get_container(path, accept_parameters)
+            self.set_etag(version)
             ssslog.info("Returning " + response.status + " from request on " + inspect.stack()[0][3])
             if cont is not None:
                 response.headers["Content-Type"] = str(accept_parameters.content_type.mimetype())
@@ -860,6 +981,9 @@ class SwordController(WSGIController):
             # authenticate
             auth = self.authenticate()
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(auth)
+            
             # check the validity of the request
             self.validate_deposit_request("6.5.2", None, "6.5.3")
             
@@ -870,6 +994,7 @@ class SwordController(WSGIController):
             result = ss.replace(path, deposit)
             
             response.headers["Location"] = str(result.location) # explicit cast to str
+            self.set_etag(result.etag)
             if config.return_deposit_receipt:
                 response.content_type = "application/atom+xml;type=entry"
                 response.status_int = 200
@@ -906,6 +1031,9 @@ class SwordController(WSGIController):
              # authenticate
             auth = self.authenticate()
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(auth)
+            
             # check the validity of the request
             self.validate_deposit_request("6.7.2", None, "6.7.3", "9.3", allow_empty=True)
             
@@ -920,6 +1048,7 @@ class SwordController(WSGIController):
             # asap)
             
             response.headers["Location"] = str(result.location) # explict cast to str
+            self.set_etag(result.etag)
             response.status_int = 200
             response.status = "200 OK"
             if config.return_deposit_receipt:
@@ -1026,7 +1155,7 @@ class SwordController(WSGIController):
         response.content_type = "application/octet-stream" # FIXME: we're not keeping track of content types
         response.status_int = 200
         response.status = "200 OK"
-        return fh.read()
+        self._send_file(fh)
         
     def _PUT_part(self, path):
         # FIXME: the spec says that we should either support this or return
@@ -1,10 +1,16 @@
-import os, hashlib, uuid, urllib
+import os, hashlib, uuid, urllib, json, threading, errno, copy
 from core import Statement, DepositResponse, MediaResourceResponse, DeleteResponse, Auth, AuthException, SwordError, ServiceDocument, SDCollection, EntryDocument, Authenticator, SwordServer, WebUI
 from spec import Namespaces, Errors
 from lxml import etree
 from datetime import datetime
 from zipfile import ZipFile
+from functools import partial
 from negotiator import AcceptParameters, ContentType
+from spool import digest_stream
+from storage import BlobStore, StorageError
+from journal import Journal, ContainerTransaction
+from locks import ContainerLocks, LockTimeout
+from cache import LRUCache, SharedCache, PackageCache
 from info import __version__
 
 from sss_logging import logging
@@ -268,13 +274,12 @@ class SSS(SwordServer):
         authorname = etree.SubElement(author, self.ns.ATOM + "name")
         authorname.text = "Simple Sword Server"
 
-        # if the collection path does not exist, then return the empty feed
-        cpath = os.path.join(self.configuration.store_dir, str(id))
-        if not os.path.exists(cpath):
+        # if the collection does not exist, then return the empty feed
+        if not self.dao.collection_exists(str(id)):
             return etree.tostring(feed, pretty_print=True)
 
         # list all of the containers in the collection
-        parts = os.listdir(cpath)
+        parts = self.dao.get_container_ids(str(id))
         for part in parts:
             entry = etree.SubElement(feed, self.ns.ATOM + "entry")
             entrytitle = etree.SubElement(entry, self.ns.ATOM + "title")
@@ -311,69 +316,71 @@ class SSS(SwordServer):
         if not self.dao.collection_exists(collection):
             raise SwordError(status=404, empty=True)
 
-        # create us a new container, passing in the Slug value (which may be None) as the proposed id
-        id = self.dao.create_container(collection, deposit.slug)
+        # create us a new container, passing in the Slug value (which may be None) as the proposed id, and make all
+        # the changes to it in one transaction, so that it is never left half made
+        with self._transaction(collection, deposit.slug, create=True) as txn:
+            id = txn.id
 
-        # store the incoming atom document if necessary
-        if deposit.atom is not None:
-            entry_ingester = self.configuration.get_entry_ingester()(self.dao)
-            entry_ingester.ingest(collection, id, deposit.atom)
+            # store the incoming atom document if necessary
+            if deposit.atom is not None:
+                entry_ingester = self.configuration.get_entry_ingester()(self.dao)
+                entry_ingester.ingest(collection, id, deposit.atom)
 
-        # store the content file if one exists, and do some processing on it
-        deposit_uri = None
-        derived_resource_uris = []
-        if deposit.content is not None:
+            # store the content file if one exists, and do some processing on it
+            deposit_uri = None
+            derived_resource_uris = []
+            if deposit.has_content():
         
-            if deposit.filename is None:
-                deposit.filename = "unnamed.file"
-            fn = self.dao.store_content(collection, id, deposit.content, deposit.filename)
+                if deposit.filename is None:
+                    deposit.filename = "unnamed.file"
+                fn = self.dao.store_content(collection, id, deposit.content_file, deposit.filename, deposit.digests)
 
-            # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
-            # all the metadata and any files we want
+                # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
+                # all the metadata and any files we want
             
-            # FIXME: because the deposit interpreter doesn't deal with multipart properly
-            # we don't get the correct packaging format here if the package is anything
-            # other than Binary
-            ssslog.info("attempting to load ingest packager for format " + str(deposit.packaging))
-            packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
-            derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
-
-            # An identifier which will resolve to the package just deposited
-            deposit_uri = self.um.part_uri(collection, id, fn)
+                # FIXME: because the deposit interpreter doesn't deal with multipart properly
+                # we don't get the correct packaging format here if the package is anything
+                # other than Binary
+                ssslog.info("attempting to load ingest packager for format " + str(deposit.packaging))
+                packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
+                derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
+
+                # An identifier which will resolve to the package just deposited
+                deposit_uri = self.um.part_uri(collection, id, fn)
             
-            # a list of identifiers which will resolve to the derived resources
-            derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
+                # a list of identifiers which will resolve to the derived resources
+                derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
 
-        # the aggregation uri
-        agg_uri = self.um.agg_uri(collection, id)
+            # the aggregation uri
+            agg_uri = self.um.agg_uri(collection, id)
 
-        # the Edit-URI
-        edit_uri = self.um.edit_uri(collection, id)
+            # the Edit-URI
+            edit_uri = self.um.edit_uri(collection, id)
         
-        # State information
-        state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
-        state_description = self.states[state_uri]
+            # State information
+            state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
+            state_description = self.states[state_uri]
         
-        # create the initial statement
-        s = Statement()
-        s.aggregation_uri = agg_uri
-        s.rem_uri = edit_uri
-        by = deposit.auth.username if deposit.auth is not None else None
-        obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
-        if deposit_uri is not None:
-            s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
-        s.aggregates = derived_resource_uris
-        s.add_state(state_uri, state_description)
+            # create the initial statement
+            s = Statement()
+            s.aggregation_uri = agg_uri
+            s.rem_uri = edit_uri
+            by = deposit.auth.username if deposit.auth is not None else None
+            obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
+            if deposit_uri is not None:
+                s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
+            s.aggregates = derived_resource_uris
+            s.add_state(state_uri, state_description)
         
-        # store the statement by itself
-        self.dao.store_statement(collection, id, s)
+            # store the statement by itself
+            self.dao.store_statement(collection, id, s)
 
-        # create the basic deposit receipt (which involves getting hold of the item's metadata first if it exists)
-        metadata = self.dao.get_metadata(collection, id)
-        receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
+            # create the basic deposit receipt (which involves getting hold of the item's metadata first if it exists)
+            metadata = self.dao.get_metadata(collection, id)
+            receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
 
-        # store the deposit receipt
-        self.dao.store_deposit_receipt(collection, id, receipt)
+            # store the deposit receipt
+            self.dao.store_deposit_receipt(collection, id, receipt)
 
         # now augment the receipt with the details of this particular deposit
         # this handles None arguments, and converts the xml receipt into a string
@@ -383,19 +390,20 @@ class SSS(SwordServer):
         dr = DepositResponse()
         dr.receipt = receipt.serialise()
         dr.location = edit_uri
+        dr.etag = txn.version
         dr.created = True
         
         return dr
 
     def get_part(self, path):
         """
-        Get a file handle to the part identified by the supplied path
+        Get a file handle to the part identified by the supplied path, or None if there is no such part.  The caller
+        must close the handle (the front ends hand it to the server, which closes it once the part has been sent)
         - path:     The URI part which is the path to the file
         """
         collection, id, fn = self.um.interpret_path(path)
         if self.dao.file_exists(collection, id, fn):
-            route = self.dao.get_store_path(collection, id, fn)
-            return open(route, "r")
+            return self.dao.open_file(collection, id, fn)
         else:
             return None
 
@@ -437,9 +445,19 @@ class SSS(SwordServer):
             mr.url = self.um.html_url(collection, id)
             return mr
         
-        # call the appropriate packager, and get back the filepath for the response
-        packager = self.configuration.get_package_disseminator(accept_parameters.media_format())(self.dao, self.um)
-        mr.filepath = packager.package(collection, id)
+        # call the appropriate packager, and get back the stream handle on the package for the response, unless it
+        # has already been made from this version of the container; the version is read first, so that if the
+        # container changes in between it is the version which is stale, not the package
+        mr.etag = self.dao.get_version(collection, id)
+        format = accept_parameters.media_format()
+        packager = self.configuration.get_package_disseminator(format)(self.dao, self.um)
+        mr.stream = self.dao.get_package(collection, id, mr.etag, format)
+        if mr.stream is None:
+            stream = packager.package(collection, id)
+            if isinstance(stream, basestring):
+                # an older packager, which returns the path to the package on the local disk
+                stream = open(stream, "rb")
+            mr.stream = self.dao.cache_package(collection, id, mr.etag, format, stream)
         mr.packaging = packager.get_uri()
         mr.content_type = accept_parameters.content_type.mimetype()
 
@@ -457,85 +475,88 @@ class SSS(SwordServer):
         self.check_deposit_errors(deposit)
 
         collection, id = self.um.interpret_oid(oid)
-        old_statement = self.dao.load_statement(collection, id)
 
         # does the object directory exist?  If not, we can't do a deposit
         if not self.exists(oid):
             return SwordError(status=404, empty=True)
                 
-        # first figure out what to do about the metadata
-        keep_atom = False
-        if deposit.atom is not None:
-            ssslog.info("Replace request has ATOM part - updating")
-            entry_ingester = self.configuration.get_entry_ingester()(self.dao)
-            entry_ingester.ingest(collection, id, deposit.atom)
-            keep_atom = True
+        # make all the changes to the container in one transaction, so that it is never left half changed
+        with self._transaction(collection, id, if_match=deposit.if_match) as txn:
+            old_statement = self.dao.load_statement(collection, id)
+
+            # first figure out what to do about the metadata
+            keep_atom = False
+            if deposit.atom is not None:
+                ssslog.info("Replace request has ATOM part - updating")
+                entry_ingester = self.configuration.get_entry_ingester()(self.dao)
+                entry_ingester.ingest(collection, id, deposit.atom)
+                keep_atom = True
             
-        deposit_uri = None
-        derived_resource_uris = []
-        if deposit.content is not None:
-            ssslog.info("Replace request has file content - updating")
+            deposit_uri = None
+            derived_resource_uris = []
+            if deposit.has_content():
+                ssslog.info("Replace request has file content - updating")
             
-            # remove all the old files before adding the new.  We always leave
-            # behind the metadata; this will be overwritten later if necessary
-            self.dao.remove_content(collection, id, True, keep_atom)
-
-            # store the content file
-            if deposit.filename is None:
-                deposit.filename = "unnamed.file"
-            fn = self.dao.store_content(collection, id, deposit.content, deposit.filename)
-            ssslog.debug("New incoming file stored with filename " + fn)
-
-            # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
-            # all the metadata and any files we want.  Notice that we pass in the metadata_relevant flag, so the
-            # packager won't overwrite the existing metadata if it isn't supposed to
-            packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
-            derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
-            ssslog.debug("Resources derived from deposit: " + str(derived_resources))
+                # remove all the old files before adding the new.  We always leave
+                # behind the metadata; this will be overwritten later if necessary
+                self.dao.remove_content(collection, id, True, keep_atom)
+
+                # store the content file
+                if deposit.filename is None:
+                    deposit.filename = "unnamed.file"
+                fn = self.dao.store_content(collection, id, deposit.content_file, deposit.filename, deposit.digests)
+                ssslog.debug("New incoming file stored with filename " + fn)
+
+                # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
+                # all the metadata and any files we want.  Notice that we pass in the metadata_relevant flag, so the
+                # packager won't overwrite the existing metadata if it isn't supposed to
+                packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
+                derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
+                ssslog.debug("Resources derived from deposit: " + str(derived_resources))
         
-            # a list of identifiers which will resolve to the derived resources
-            derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
+                # a list of identifiers which will resolve to the derived resources
+                derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
 
-            # An identifier which will resolve to the package just deposited
-            deposit_uri = self.um.part_uri(collection, id, fn)
+                # An identifier which will resolve to the package just deposited
+                deposit_uri = self.um.part_uri(collection, id, fn)
 
-        # the aggregation uri
-        agg_uri = self.um.agg_uri(collection, id)
+            # the aggregation uri
+            agg_uri = self.um.agg_uri(collection, id)
 
-        # the Edit-URI
-        edit_uri = self.um.edit_uri(collection, id)
+            # the Edit-URI
+            edit_uri = self.um.edit_uri(collection, id)
         
-        # State information
-        state_uri = None
-        state_description = None
-        if deposit.in_progress is not None:
-            state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
-            state_description = self.states[state_uri]
-
-        # create the new statement
-        s = Statement()
-        s.aggregation_uri = agg_uri
-        s.rem_uri = edit_uri
-        if deposit_uri is not None:
-            by = deposit.auth.username if deposit.auth is not None else None
-            obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
-            s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
-        if state_uri is not None:
-            s.add_state(state_uri, state_description)
-        else:
-            for old_state_uri, old_state_desc in old_statement.states:
-                s.add_state(old_state_uri, old_state_desc)
-        s.aggregates = derived_resource_uris
+            # State information
+            state_uri = None
+            state_description = None
+            if deposit.in_progress is not None:
+                state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
+                state_description = self.states[state_uri]
+
+            # create the new statement
+            s = Statement()
+            s.aggregation_uri = agg_uri
+            s.rem_uri = edit_uri
+            if deposit_uri is not None:
+                by = deposit.auth.username if deposit.auth is not None else None
+                obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
+                s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
+            if state_uri is not None:
+                s.add_state(state_uri, state_description)
+            else:
+                for old_state_uri, old_state_desc in old_statement.states:
+                    s.add_state(old_state_uri, old_state_desc)
+            s.aggregates = derived_resource_uris
 
-        # store the statement by itself
-        self.dao.store_statement(collection, id, s)
+            # store the statement by itself
+            self.dao.store_statement(collection, id, s)
 
-        # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
-        metadata = self.dao.get_metadata(collection, id)
-        receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
+            # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
+            metadata = self.dao.get_metadata(collection, id)
+            receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
 
-        # store the deposit receipt also
-        self.dao.store_deposit_receipt(collection, id, receipt)
+            # store the deposit receipt also
+            self.dao.store_deposit_receipt(collection, id, receipt)
         
         # now augment the receipt with the details of this particular deposit
         # this handles None arguments, and converts the xml receipt into a string
@@ -545,6 +566,7 @@ class SSS(SwordServer):
         dr = DepositResponse()
         dr.receipt = receipt.serialise()
         dr.location = edit_uri
+        dr.etag = txn.version
         dr.created = True
         return dr
 
@@ -567,40 +589,43 @@ class SSS(SwordServer):
         if not self.exists(oid):
             raise SwordError(status=404, empty=True)
 
-        # remove all the old files before adding the new.
-        # notice that we keep the metadata, as this is considered bound to the
-        # container and not the media resource.
-        self.dao.remove_content(collection, id, True)
+        # make all the changes to the container in one transaction, so that it is never left half changed
+        with self._transaction(collection, id, if_match=delete.if_match) as txn:
+            # remove all the old files before adding the new.
+            # notice that we keep the metadata, as this is considered bound to the
+            # container and not the media resource.
+            self.dao.remove_content(collection, id, True)
 
-        # the aggregation uri
-        agg_uri = self.um.agg_uri(collection, id)
+            # the aggregation uri
+            agg_uri = self.um.agg_uri(collection, id)
 
-        # the Edit-URI
-        edit_uri = self.um.edit_uri(collection, id)
+            # the Edit-URI
+            edit_uri = self.um.edit_uri(collection, id)
 
-        # State information
-        state_uri = self.in_progress_uri if delete.in_progress else self.archived_uri
-        state_description = self.states[state_uri]
+            # State information
+            state_uri = self.in_progress_uri if delete.in_progress else self.archived_uri
+            state_description = self.states[state_uri]
     
-        # create the statement
-        s = Statement()
-        s.aggregation_uri = agg_uri
-        s.rem_uri = edit_uri
-        s.add_state(state_uri, state_description)
+            # create the statement
+            s = Statement()
+            s.aggregation_uri = agg_uri
+            s.rem_uri = edit_uri
+            s.add_state(state_uri, state_description)
 
-        # store the statement by itself
-        self.dao.store_statement(collection, id, s)
+            # store the statement by itself
+            self.dao.store_statement(collection, id, s)
 
-        # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
-        metadata = self.dao.get_metadata(collection, id)
-        receipt = self.deposit_receipt(collection, id, delete, s, metadata)
+            # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
+            metadata = self.dao.get_metadata(collection, id)
+            receipt = self.deposit_receipt(collection, id, delete, s, metadata)
 
-        # store the deposit receipt also
-        self.dao.store_deposit_receipt(collection, id, receipt)
+            # store the deposit receipt also
+            self.dao.store_deposit_receipt(collection, id, receipt)
 
         # finally, assemble the delete response and return
         dr = DeleteResponse()
         dr.receipt = receipt.serialise()
+        dr.etag = txn.version
         return dr
         
     def add_content(self, oid, deposit):
@@ -626,52 +651,54 @@ class SSS(SwordServer):
         state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
         state_description = self.states[state_uri]
 
-        # load the statement
-        s = self.dao.load_statement(collection, id)
-        s.set_state(state_uri, state_description)
+        # make all the changes to the container in one transaction, so that it is never left half changed
+        with self._transaction(collection, id, if_match=deposit.if_match) as txn:
+            # load the statement
+            s = self.dao.load_statement(collection, id)
+            s.set_state(state_uri, state_description)
         
-        # store the content file if one exists, and do some processing on it
-        location_uri = None
-        deposit_uri = None
-        derived_resource_uris = []
-        if deposit.content is not None:
-            ssslog.debug("Add request contains content part")
+            # store the content file if one exists, and do some processing on it
+            location_uri = None
+            deposit_uri = None
+            derived_resource_uris = []
+            if deposit.has_content():
+                ssslog.debug("Add request contains content part")
             
-            if deposit.filename is None:
-                deposit.filename = "unnamed.file"
-            fn = self.dao.store_content(collection, id, deposit.content, deposit.filename)
-            ssslog.debug("New incoming file stored with filename " + fn)
+                if deposit.filename is None:
+                    deposit.filename = "unnamed.file"
+                fn = self.dao.store_content(collection, id, deposit.content_file, deposit.filename, deposit.digests)
+                ssslog.debug("New incoming file stored with filename " + fn)
                 
-            packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
-            derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
-            ssslog.debug("Resources derived from deposit: " + str(derived_resources))
+                packager = self.configuration.get_package_ingester(deposit.packaging)(self.dao)
+                derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
+                ssslog.debug("Resources derived from deposit: " + str(derived_resources))
 
-            # An identifier which will resolve to the package just deposited
-            deposit_uri = self.um.part_uri(collection, id, fn)
+                # An identifier which will resolve to the package just deposited
+                deposit_uri = self.um.part_uri(collection, id, fn)
             
-            by = deposit.auth.username if deposit.auth is not None else None
-            obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
-            s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
+                by = deposit.auth.username if deposit.auth is not None else None
+                obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
+                s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
             
-            # a list of identifiers which will resolve to the derived resources
-            derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
+                # a list of identifiers which will resolve to the derived resources
+                derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
             
-            # decide on the location URI (it differs depending on whether this was
-            # an unpackable resource or not
-            if deposit.packaging == "http://purl.org/net/sword/package/Binary":
-                location_uri = deposit_uri
-            else:
-                location_uri = self.um.em_uri(collection, id)
+                # decide on the location URI (it differs depending on whether this was
+                # an unpackable resource or not
+                if deposit.packaging == "http://purl.org/net/sword/package/Binary":
+                    location_uri = deposit_uri
+                else:
+                    location_uri = self.um.em_uri(collection, id)
         
-        # store the statement by itself
-        self.dao.store_statement(collection, id, s)
+            # store the statement by itself
+            self.dao.store_statement(collection, id, s)
 
-        # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
-        metadata = self.dao.get_metadata(collection, id)
-        receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
+            # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
+            metadata = self.dao.get_metadata(collection, id)
+            receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
 
-        # store the deposit receipt also
-        self.dao.store_deposit_receipt(collection, id, receipt)
+            # store the deposit receipt also
+            self.dao.store_deposit_receipt(collection, id, receipt)
         
         # now augment the receipt with the details of this particular deposit
         # this handles None arguments, and converts the xml receipt into a string
@@ -681,12 +708,17 @@ class SSS(SwordServer):
         dr = DepositResponse()
         dr.receipt = receipt.serialise()
         dr.location = location_uri
+        dr.etag = txn.version
         dr.created = True
         return dr
 
     def get_edit_uri(self, path):
         col, oid = self.um.interpret_oid(path)
         return self.um.edit_uri(col, oid)
+
+    def get_version(self, path):
+        col, oid = self.um.interpret_oid(path)
+        return self.dao.get_version(col, oid)
     
     def get_container(self, oid, accept_parameters):
         """
@@ -734,79 +766,81 @@ class SSS(SwordServer):
         if not self.exists(oid):
             raise SwordError(status=404, empty=True)
 
-        # State information
-        state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
-        state_description = self.states[state_uri]
+        # make all the changes to the container in one transaction, so that it is never left half changed
+        with self._transaction(collection, id, if_match=deposit.if_match) as txn:
+            # State information
+            state_uri = self.in_progress_uri if deposit.in_progress else self.archived_uri
+            state_description = self.states[state_uri]
 
-        # load the statement
-        s = self.dao.load_statement(collection, id)
+            # load the statement
+            s = self.dao.load_statement(collection, id)
         
-        # do the in-progress first, as some deposits will be empty, and will
-        # just be telling us that the client has finished working on this item
-        s.set_state(state_uri, state_description)
+            # do the in-progress first, as some deposits will be empty, and will
+            # just be telling us that the client has finished working on this item
+            s.set_state(state_uri, state_description)
         
-        # just do some useful logging
-        if deposit.atom is None and deposit.content is None:
-            ssslog.info("Empty deposit request; therefore this is just completing a previously incomplete deposit")
+            # just do some useful logging
+            if deposit.atom is None and not deposit.has_content():
+                ssslog.info("Empty deposit request; therefore this is just completing a previously incomplete deposit")
         
-        # now just store the atom file and the content (this may overwrite an existing atom document - this is
-        # intentional, although real servers would augment the existing metadata rather than overwrite)
-        if deposit.atom is not None:
-            ssslog.info("Append request has ATOM part - adding")
+            # now just store the atom file and the content (this may overwrite an existing atom document - this is
+            # intentional, although real servers would augment the existing metadata rather than overwrite)
+            if deposit.atom is not None:
+                ssslog.info("Append request has ATOM part - adding")
             
-            # when we ingest the atom file, the existing atom doc may get overwritten,
-            # but the spec requires that we only add metadata, not overwrite anything
-            # (if possible).  For a purist implementation, then, we mark additive=True
-            # in the call to the ingest method, so all metadata is added to whatever
-            # is already there
-            entry_ingester = self.configuration.get_entry_ingester()(self.dao)
-            entry_ingester.ingest(collection, id, deposit.atom, True)
-
-        # store the content file
-        deposit_uri = None
-        derived_resource_uris = []
-        if deposit.content is not None:
-            ssslog.info("Append request has file content - adding to media resource")
+                # when we ingest the atom file, the existing atom doc may get overwritten,
+                # but the spec requires that we only add metadata, not overwrite anything
+                # (if possible).  For a purist implementation, then, we mark additive=True
+                # in the call to the ingest method, so all metadata is added to whatever
+                # is already there
+                entry_ingester = self.configuration.get_entry_ingester()(self.dao)
+                entry_ingester.ingest(collection, id, deposit.atom, True)
+
+            # store the content file
+            deposit_uri = None
+            derived_resource_uris = []
+            if deposit.has_content():
+                ssslog.info("Append request has file content - adding to media resource")
             
-            if deposit.filename is None:
-                deposit.filename = "unnamed.file"
-            fn = self.dao.store_content(collection, id, deposit.content, deposit.filename)
-            ssslog.debug("New incoming file stored with filename " + fn)
-
-            # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
-            # all the metadata and any files we want.  Notice that we pass in the metadata_relevant flag, so the packager
-            # won't overwrite the metadata if it isn't supposed to
-            pclass = self.configuration.get_package_ingester(deposit.packaging)
-            if pclass is not None:
-                packager = pclass(self.dao)
-                derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
-                ssslog.debug("Resources derived from deposit: " + str(derived_resources))
+                if deposit.filename is None:
+                    deposit.filename = "unnamed.file"
+                fn = self.dao.store_content(collection, id, deposit.content_file, deposit.filename, deposit.digests)
+                ssslog.debug("New incoming file stored with filename " + fn)
+
+                # now that we have stored the atom and the content, we can invoke a package ingester over the top to extract
+                # all the metadata and any files we want.  Notice that we pass in the metadata_relevant flag, so the packager
+                # won't overwrite the metadata if it isn't supposed to
+                pclass = self.configuration.get_package_ingester(deposit.packaging)
+                if pclass is not None:
+                    packager = pclass(self.dao)
+                    derived_resources = packager.ingest(collection, id, fn, deposit.metadata_relevant)
+                    ssslog.debug("Resources derived from deposit: " + str(derived_resources))
                 
-                # a list of identifiers which will resolve to the derived resources
-                derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
+                    # a list of identifiers which will resolve to the derived resources
+                    derived_resource_uris = self.get_derived_resource_uris(collection, id, derived_resources)
 
-            # An identifier which will resolve to the package just deposited
-            deposit_uri = self.um.part_uri(collection, id, fn)
+                # An identifier which will resolve to the package just deposited
+                deposit_uri = self.um.part_uri(collection, id, fn)
 
-            # add the new deposit
-            by = deposit.auth.username if deposit.auth is not None else None
-            obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
-            s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
+                # add the new deposit
+                by = deposit.auth.username if deposit.auth is not None else None
+                obo = deposit.auth.on_behalf_of if deposit.auth is not None else None
+                s.original_deposit(deposit_uri, datetime.now(), deposit.packaging, by, obo)
         
-        # add the new list of aggregations to the existing list, allowing the
-        # statement to ensure that the list is normalised (only consisting of
-        # unique uris)
-        s.add_normalised_aggregations(derived_resource_uris)
+            # add the new list of aggregations to the existing list, allowing the
+            # statement to ensure that the list is normalised (only consisting of
+            # unique uris)
+            s.add_normalised_aggregations(derived_resource_uris)
         
-        # store the statement by itself
-        self.dao.store_statement(collection, id, s)
+            # store the statement by itself
+            self.dao.store_statement(collection, id, s)
 
-        # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
-        metadata = self.dao.get_metadata(collection, id)
-        receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
+            # create the deposit receipt (which involves getting hold of the item's metadata first if it exists
+            metadata = self.dao.get_metadata(collection, id)
+            receipt = self.deposit_receipt(collection, id, deposit, s, metadata)
 
-        # store the deposit receipt also
-        self.dao.store_deposit_receipt(collection, id, receipt)
+            # store the deposit receipt also
+            self.dao.store_deposit_receipt(collection, id, receipt)
         
         # now augment the receipt with the details of this particular deposit
         # this handles None arguments, and converts the xml receipt into a string
@@ -820,6 +854,7 @@ class SSS(SwordServer):
         # spec is INCORRECT for 6.7.3 (also, section 9.3, which comes into play here
         # also says use the edit-uri)
         dr.location = self.um.edit_uri(collection, id) 
+        dr.etag = txn.version
         dr.created = True
         return dr
 
@@ -841,9 +876,30 @@ class SSS(SwordServer):
             return SwordError(status=404, empty=True)
 
         # request the deletion of the container
-        self.dao.remove_container(collection, id)
+        try:
+            self.dao.remove_container(collection, id, delete.if_match)
+        except LockTimeout:
+            raise SwordError(status=503, empty=True)
+        except VersionConflict as e:
+            ssslog.info(str(e))
+            raise SwordError(status=412, empty=True)
         return DeleteResponse()
 
+    def _transaction(self, collection, id, create=False, if_match=None):
+        """
+        Begin a transaction on the container in the DAO.  If the container is being changed by another request for
+        longer than the lock_timeout, the client is told to try again later, and if it has changed since the
+        version the client made its request against, the precondition fails
+        """
+        try:
+            return self.dao.transaction(collection, id, create, if_match)
+        except LockTimeout:
+            ssslog.info("Timed out waiting for the lock on " + collection + "/" + str(id))
+            raise SwordError(status=503, empty=True)
+        except VersionConflict as e:
+            ssslog.info(str(e))
+            raise SwordError(status=412, empty=True)
+
     def get_derived_resource_uris(self, collection, id, derived_resource_names):
         uris = []
         for name in derived_resource_names:
@@ -937,12 +993,18 @@ class SSS(SwordServer):
         if deposit.packaging == self.configuration.error_content_package:
             raise SwordError(error_uri=Errors.content, status=415, msg="Unsupported Packaging format specified")
 
-        # have we been given an incompatible MD5?
-        if deposit.content_md5 is not None:
-            m = hashlib.md5()
-            m.update(deposit.content)
-            digest = m.hexdigest()
-            if digest != deposit.content_md5:
+        # have we been given an incompatible MD5?  (the Content-MD5 of a gzip or deflate encoded body is of the
+        # encoded bytes, which only the web front end saw, so it checks those as they arrive instead)
+        if deposit.content_md5 is not None and deposit.content_encoding is None and deposit.has_content():
+            # the digests are usually computed as the content is spooled to disk, but if they weren't we read the
+            # content in chunks, and then rewind so that the content can be stored afterwards
+            if deposit.digests is None:
+                writer = digest_stream(deposit.content_file, self.configuration.copy_chunk_size)
+                deposit.content_file.seek(0)
+                deposit.digests = writer.digests()
+                deposit.content_size = writer.size
+            digest = deposit.digests.get("md5")
+            if digest != deposit.content_md5.strip():
                 raise SwordError(error_uri=Errors.checksum_mismatch, msg="Content-MD5 header does not match file checksum")
 
         # have we been asked to do a mediated deposit, when this is not allowed?
@@ -952,39 +1014,172 @@ class SSS(SwordServer):
 
         return None
 
+# the file in each container which records the files that are references into the blob store
+MANIFEST = "sss_manifest.json"
+
+# the file in each container which records the files that were unpacked from its zip deposit, with their CRCs, for
+# as long as they have not been written since (see store_unpacked)
+UNPACKED = "sss_unpacked.json"
+
+# the file in each container which holds its version, a token which is replaced by every transaction on it, and the
+# version of a container made before versions were kept, until it is next changed
+VERSION = "sss_version"
+UNVERSIONED = "0"
+
+# the file in each container which holds its statement, in the compact JSON form from which the RDF/XML and Atom
+# serialisations are made when they are asked for (containers made before it was used have those serialisations in
+# files of their own instead, until they are next changed).  It is a checkpoint, to which the events in the log
+# files (EVENTS followed by their sequence number) since it was written are applied (see store_statement)
+STATEMENT_JSON = "sss_statement.json"
+EVENTS = "sss_statement.events."
+
+# how many changes to a statement are logged before they are folded into a new checkpoint, by default
+DEFAULT_CHECKPOINT_INTERVAL = 100
+
+# the serialisations of the statement, the deposit receipt and the metadata of each container, which are kept in
+# the shared cache (see DAO)
+STATEMENT = "sss_statement.xml"
+STATEMENT_FEED = "sss_statement.atom.xml"
+RECEIPT = "sss_deposit-receipt.xml"
+METADATA = "sss_metadata.xml"
+SHARED = [STATEMENT, STATEMENT_FEED, RECEIPT, METADATA]
+
+class VersionConflict(Exception):
+    """ Raised when a container is not at the version which a change to it was made against """
+    pass
+
 class DAO(object):
     """
-    Data Access Object for interacting with the store
+    Data Access Object for interacting with the store.  The store itself is provided by the storage backend which is
+    named in the configuration (see storage.py), so that the content may be kept on the local disk or in object storage.
+    Changes to a container may be made in a transaction (see the transaction method), so that they are applied
+    together or not at all, and while no other thread or process is changing it
     """
+    _recovered = False
+    _recovery_lock = threading.Lock()
+
+    # the parsed statements of the containers, shared by every DAO in the process (see load_statement), the
+    # serialised statements, receipts and metadata, shared by every process on the host (see _cached), and the
+    # dissemination packages (see get_package)
+    statement_cache = LRUCache(0)
+    shared_cache = None
+    package_cache = None
+    _shared_cache_lock = threading.Lock()
+
     def __init__(self, config):
         """
-        Initialise the DAO.  This creates the store directory in the Configuration() object if it does not already
-        exist and will construct the relevant number of fake collections.  In general if you make changes to the
-        number of fake collections you want to have, it's best just to burn the store and start from scratch, although
-        this method will check to see that it has enough fake collections and make up the defecit, but it WILL NOT
-        remove excess collections
+        Initialise the DAO.  This creates the store in the Configuration() object if it does not already exist and
+        will construct the relevant number of fake collections.  In general if you make changes to the number of fake
+        collections you want to have, it's best just to burn the store and start from scratch, although this method
+        will check to see that it has enough fake collections and make up the defecit, but it WILL NOT remove excess
+        collections
         """
         self.configuration = config
-
-        # first thing to do is create the store if it does not already exist
-        print self.configuration.store_dir
-        if not os.path.exists(self.configuration.store_dir):
-            os.makedirs(self.configuration.store_dir)
-
-        # now construct the fake collections
-        current_cols = os.listdir(self.configuration.store_dir)
+        self.backend = self.configuration.get_storage_backend_implementation()(self.configuration)
+        self.blobs = BlobStore(self.backend, self.configuration)
+        self.locks = ContainerLocks(self.configuration)
+        self.journal = Journal(self.backend, self.locks, self.blobs)
+        self.txn = None
+
+        cache_size = self.configuration.statement_cache_size
+        if cache_size is not None and cache_size != DAO.statement_cache.size:
+            DAO.statement_cache.resize(cache_size)
+        shared_cache_file = self.configuration.shared_cache_file
+        with DAO._shared_cache_lock:
+            if shared_cache_file is None:
+                DAO.shared_cache = None
+            elif DAO.shared_cache is None or DAO.shared_cache.path != os.path.abspath(shared_cache_file):
+                DAO.shared_cache = SharedCache(shared_cache_file, self.configuration.shared_cache_size or 0)
+            package_cache_dir = self.configuration.package_cache_dir
+            if package_cache_dir is None:
+                DAO.package_cache = None
+            elif DAO.package_cache is None or DAO.package_cache.path != os.path.abspath(package_cache_dir):
+                DAO.package_cache = PackageCache(package_cache_dir, self.configuration.package_cache_size,
+                                                self.configuration.package_cache_max_age)
+
+        # the first time the store is opened in this process, complete or roll back any transactions which were
+        # left open when a process stopped (which only needs to look at their journals)
+        with DAO._recovery_lock:
+            if not DAO._recovered:
+                self.journal.recover()
+                DAO._recovered = True
+
+        # now construct the fake collections (which creates the store if it does not already exist)
+        current_cols = self.backend.list_collections()
         create = self.configuration.num_collections - len(current_cols)
         for i in range(create):
-            name = str(uuid.uuid4())
-            cdir = os.path.join(self.configuration.store_dir, name)
-            os.makedirs(cdir)
+            self.backend.create_collection(str(uuid.uuid4()))
 
         self.ns = Namespaces()
         self.mdmap = {None : self.ns.DC_NS}
 
+    def transaction(self, collection, id=None, create=False, if_match=None):
+        """
+        Begin a transaction on the container (see journal.py), in which all the changes that this DAO makes to it
+        are staged until the transaction is committed.  Use it in a with statement, which commits the changes if
+        the block completes and throws them away if it raises.  The transaction holds the container's lock (see
+        locks.py) until it is finished, so anything read from the container within it cannot be changed by anyone
+        else before it is written back; locks.LockTimeout is raised if the lock cannot be had.  The transaction
+        gives the container a new version (see get_version).
+        Args:
+        -collection:    the collection name
+        -id:    the container id, which may be None if the container is being created
+        -create:    True to create the container (with a new UUID if there is no id), which is removed again if the
+                    transaction does not commit
+        -if_match:  a list of versions, one of which the container must be at when it is locked, or VersionConflict
+                    is raised; None if any version will do
+        Returns the ContainerTransaction, whose id is that of the container, and whose version is the one the
+        container will have once it is committed
+        """
+        if create and id is None:
+            id = str(uuid.uuid4())
+        lock = self.locks.lock(collection, id)
+        try:
+            self._check_version(collection, id, if_match)
+            created = create and not self.backend.container_exists(collection, id)
+            txn = ContainerTransaction(self.journal, self.blobs, collection, id, created, lock)
+            txn.before_commit.append(partial(self._stage_documents, txn))
+            txn.begin()
+        except:
+            lock.release()
+            raise
+        self.txn = txn
+        try:
+            if created:
+                self.backend.create_container(collection, id)
+            txn.version = uuid.uuid4().hex
+            self.save(collection, id, VERSION, txn.version)
+        except:
+            txn.abort()
+            raise
+        return txn
+
+    def get_version(self, collection, id):
+        """
+        The version of the container, which is a token that changes whenever it is changed (so it can be compared
+        with another, but tells nothing else), read from a small file rather than worked out from the container
+        """
+        if not self.file_exists(collection, id, VERSION):
+            return UNVERSIONED
+        return self._read(collection, id, VERSION).strip()
+
+    def _check_version(self, collection, id, if_match):
+        if if_match is not None and self.get_version(collection, id) not in if_match:
+            raise VersionConflict(collection + "/" + id + " is not at any of the versions " + ", ".join(if_match))
+
+    def _txn(self, collection, id):
+        """ the transaction which is open on the container, if there is one """
+        if self.txn is not None and not self.txn.finished and self.txn.collection == collection and self.txn.id == id:
+            return self.txn
+        return None
+
     def get_collection_names(self):
         """ list all the collections in the store """
-        return os.listdir(self.configuration.store_dir)
+        return self.backend.list_collections()
+
+    def get_container_ids(self, collection):
+        """ list all the containers in the specified collection """
+        return self.backend.list_containers(collection)
 
     def collection_exists(self, collection):
         """
@@ -993,8 +1188,7 @@ class DAO(object):
         -collection:    the Collection name
         Returns true or false
         """
-        cdir = os.path.join(self.configuration.store_dir, collection)
-        return os.path.exists(cdir)
+        return self.backend.collection_exists(collection)
 
     def container_exists(self, collection, id):
         """
@@ -1005,12 +1199,16 @@ class DAO(object):
         -id:    the container id
         Returns true or false
         """
-        odir = os.path.join(self.configuration.store_dir, collection, id)
-        return os.path.exists(odir)
+        return self.backend.container_exists(collection, id)
 
     def file_exists(self, collection, id, filename):
-        fpath = os.path.join(self.configuration.store_dir, collection, id, filename)
-        return os.path.exists(fpath)
+        location = self._locate(collection, id, filename)
+        return location is not None and self.backend.blob_exists(*location)
+
+    def get_file_size(self, collection, id, filename):
+        """ The size in bytes of the specified file, or None if it does not exist """
+        location = self._locate(collection, id, filename)
+        return self.backend.blob_size(*location) if location is not None else None
 
     def create_container(self, collection, id=None):
         """
@@ -1020,23 +1218,37 @@ class DAO(object):
         -collection:    the collection name in which to create the container
         Returns the ID of the container
         """
-        # invent an identifier for the item, and create its directory
+        # invent an identifier for the item, and create it
         # we may have been passed an ID to use
         if id is None:
             id = str(uuid.uuid4())
-        odir = os.path.join(self.configuration.store_dir, collection, id)
-        if not os.path.exists(odir):
-            os.makedirs(odir)
+        self.backend.create_container(collection, id)
         return id
 
-    def save(self, filepath, content, opts="w"):
+    def save(self, collection, id, filename, content):
+        """
+        Shortcut to save the content (a string or a file-like object) to the named file in the container, exactly
+        as named
+        """
+        self.backend.put_blob(collection, id, self._write_name(collection, id, filename), content)
+
+    def open_file(self, collection, id, filename, seekable=False):
         """
-        Shortcut to save the content to the filepath with the associated file handle opts (defaults to "w", so pass
-        in "wb" for binary files
+        Open the named file in the container for reading, and return the stream handle, which the caller must close.
+        Pass seekable=True if the handle will need to support seek (for example, to read it as a zip file)
         """
-        f = open(filepath, opts)
-        f.write(content)
-        f.close()
+        location = self._locate(collection, id, filename)
+        if location is None:
+            raise StorageError("no such file: " + collection + "/" + id + "/" + filename)
+        return self.backend.open_blob(*(location + (seekable,)))
+
+    def open_file_for_write(self, collection, id, filename):
+        """
+        Open the named file in the container for writing, and return the handle.  This is for packagers to write
+        their own files into the container which are not part of the content itself; the file is in place once the
+        handle has been closed
+        """
+        return self.backend.open_blob_for_write(collection, id, self._write_name(collection, id, filename))
 
     def get_filename(self, filename):
         """
@@ -1046,35 +1258,292 @@ class DAO(object):
 
     def store_atom(self, collection, id, atom):
         """ Store the supplied atom document content in the object identified by the id in the specified collection """
-        afile = os.path.join(self.configuration.store_dir, collection, id, "atom.xml")
-        self.save(afile, atom)
+        self.save(collection, id, "atom.xml", atom)
 
-    def store_content(self, collection, id, content, filename):
+    def store_content(self, collection, id, content, filename, digests=None):
         """
         Store the supplied content in the object identified by the id in the specified collection under the supplied
         filename.  In reality, to avoid name colisions the filename will be preceeded with a timestamp in the store.
+        The content should be a file-like object, which will be copied into the store in chunks of copy_chunk_size
+        bytes, so the memory used does not depend on the size of the content (a string is also accepted, for
+        back-compatibility).  If the content is a file which was spooled into the tmp_dir it is closed and moved into
+        the store instead, which is just a rename where the tmp_dir and the store_dir are on the same filesystem.
+        The digests of the content (as computed when it was spooled) may be supplied, to save working them out
+        again if the content is deduplicated (see store_file).
         Returns the localised filename the content was stored under
         """
         ufn = self.get_filename(filename)
-        cfile = os.path.join(self.configuration.store_dir, collection, id, ufn)
-        self.save(cfile, content, "wb")
+        self.store_file(collection, id, ufn, content, digests)
         return ufn
 
+    def store_file(self, collection, id, filename, content, digests=None):
+        """
+        Store the supplied content (a string or a file-like object) as a content file in the container, exactly as
+        named, replacing any file of that name.  If the deduplicate option is on, the content goes into the blob
+        store (see storage.BlobStore), and the file is just a reference to it; its SHA-256 is taken from the
+        digests, if they are supplied, or worked out as it is stored.  The reference is recorded in the container's
+        manifest, so that it can be released when the file is removed.  If the content is a file which was spooled
+        into the tmp_dir it is moved rather than copied, whichever way it is stored
+        """
+        self._release(collection, id, [filename])
+        self._forget_unpacked(collection, id, filename)
+        path = None
+        if self._is_spooled(content):
+            content.close()
+            path = content.name
+
+        if not self.configuration.deduplicate:
+            if path is not None:
+                self.backend.move_blob_in(collection, id, self._write_name(collection, id, filename), path)
+            else:
+                self.save(collection, id, filename, content)
+            return
+
+        # a pointer is only in the manifest, but a hard link is a file in the container like any other
+        name = self._write_name(collection, id, filename) if self.backend.supports_links else filename
+        sha256 = digests.get("sha256") if digests is not None else None
+        sha256 = self.blobs.store(collection, id, name, content, sha256, path)
+        txn = self._txn(collection, id)
+        if txn is not None:
+            txn.acquire(sha256)
+        manifest = self._manifest(collection, id)
+        manifest[filename] = sha256
+        self._save_manifest(collection, id, manifest)
+
+    def store_unpacked(self, collection, id, package, members):
+        """
+        Record that the files named in members (a dictionary of name to CRC-32) were unpacked from the zip file
+        package in the container, exactly as they are in it.  A file stays in the record until it is stored again
+        (see store_file), so that a packager can tell which files can still be copied from the zip as they are
+        """
+        self._save_document(collection, id, UNPACKED, {"package" : package, "members" : dict(members)})
+
+    def get_unpacked(self, collection, id):
+        """ The record of the files unpacked from the zip deposit in the container (see store_unpacked), or None """
+        unpacked = self._document(collection, id, UNPACKED)
+        return copy.deepcopy(unpacked) if unpacked is not None else None
+
+    def clear_unpacked(self, collection, id):
+        """
+        Drop the record of the files unpacked from the zip deposit in the container, as a packager does before it
+        unpacks another one (so that storing each of its files does not have to take it out of the record)
+        """
+        if self._document(collection, id, UNPACKED) is not None:
+            self._save_document(collection, id, UNPACKED, None)
+
+    def _forget_unpacked(self, collection, id, filename):
+        """ the file is being stored, so it is no longer what was unpacked from the zip deposit, if it ever was """
+        unpacked = self._document(collection, id, UNPACKED)
+        if unpacked is None:
+            return
+        if filename == unpacked["package"]:
+            self._save_document(collection, id, UNPACKED, None)
+        elif filename in unpacked["members"]:
+            del unpacked["members"][filename]
+            self._save_document(collection, id, UNPACKED, unpacked)
+
+    def get_manifest(self, collection, id):
+        """
+        Read the manifest of the container, which maps the names of the files which are references into the blob
+        store to the SHA-256 of the blob that each refers to
+        """
+        return dict(self._manifest(collection, id))
+
+    def _manifest(self, collection, id):
+        """ the manifest of the container, which within a transaction is the one kept for it (see _document) """
+        manifest = self._document(collection, id, MANIFEST)
+        return manifest if manifest is not None else {}
+
+    def _save_manifest(self, collection, id, manifest):
+        self._save_document(collection, id, MANIFEST, manifest if len(manifest) > 0 else None)
+
+    def _document(self, collection, id, filename):
+        """
+        The JSON document (such as the manifest) in the named file in the container, or None if there is none.
+        Within a transaction it is read only once, and the transaction keeps it, as _save_document changes it, so
+        the caller must not change what it is given unless it saves it
+        """
+        txn = self._txn(collection, id)
+        if txn is not None and filename in txn.documents:
+            return txn.documents[filename]
+        location = self._stored(collection, id, filename)
+        document = None
+        if location is not None and self.backend.blob_exists(*location):
+            document = json.loads(self.backend.get_blob(*location))
+        if txn is not None:
+            txn.documents[filename] = document
+        return document
+
+    def _save_document(self, collection, id, filename, document):
+        """
+        Save the JSON document to the named file in the container, or delete the file if it is None.  Within a
+        transaction it is only staged once, when the transaction commits (see _stage_documents), so that changing
+        it for each of many files costs no more than changing it once
+        """
+        txn = self._txn(collection, id)
+        if txn is not None:
+            txn.documents[filename] = document
+            txn.changed_documents.add(filename)
+            return
+        self._write_document(collection, id, filename, document)
+
+    def _stage_documents(self, txn):
+        """ stage the documents which were changed in the transaction, which is about to be committed """
+        for filename in sorted(txn.changed_documents):
+            self._write_document(txn.collection, txn.id, filename, txn.documents[filename])
+        txn.changed_documents.clear()
+
+    def _write_document(self, collection, id, filename, document):
+        if document is not None:
+            self.save(collection, id, filename, json.dumps(document, sort_keys=True))
+        else:
+            self._delete(collection, id, filename)
+
+    def _pointers(self, collection, id):
+        """
+        The files in the container which are only pointers into the blob store (because the backend cannot make
+        hard links), as a dictionary of name to SHA-256
+        """
+        if self.backend.supports_links:
+            return {}
+        return self.get_manifest(collection, id)
+
+    def _locate(self, collection, id, filename):
+        """
+        The (collection, id, name) in the backend which holds the content of the named file in the container, or
+        None if it has been deleted in the open transaction
+        """
+        sha256 = self._pointers(collection, id).get(filename)
+        if sha256 is not None:
+            return self.blobs.location(sha256)
+        return self._stored(collection, id, filename)
+
+    def _stored(self, collection, id, filename):
+        """
+        The (collection, id, name) of the named file in the container itself, allowing for any changes staged by
+        the open transaction, or None if it has been deleted in that transaction
+        """
+        txn = self._txn(collection, id)
+        if txn is None:
+            return collection, id, filename
+        name = txn.locate(filename)
+        return (collection, id, name) if name is not None else None
+
+    def _write_name(self, collection, id, filename):
+        """ The name in the container to write the named file to, which is staged if there is an open transaction """
+        self._forget(collection, id, filename)
+        txn = self._txn(collection, id)
+        return txn.put(filename) if txn is not None else filename
+
+    def _delete(self, collection, id, filename):
+        """ Delete the named file from the container, when the open transaction is committed if there is one """
+        self._forget(collection, id, filename)
+        txn = self._txn(collection, id)
+        if txn is not None:
+            txn.delete(filename)
+            return
+        try:
+            self.backend.delete_blob(collection, id, filename)
+        except (OSError, IOError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _list(self, collection, id):
+        """ The names of the files (and directories) in the container, allowing for the open transaction """
+        names = self.backend.list_blobs(collection, id)
+        txn = self._txn(collection, id)
+        return txn.list(names) if txn is not None else names
+
+    def _release(self, collection, id, filenames):
+        """ Remove those of the named files which are references into the blob store, releasing their blobs """
+        manifest = self._manifest(collection, id)
+        released = [fn for fn in filenames if fn in manifest]
+        if len(released) == 0:
+            return
+        txn = self._txn(collection, id)
+        for fn in released:
+            if self.backend.supports_links:
+                self._delete(collection, id, fn)
+            # within a transaction, the blob is only released when the file has gone for good
+            if txn is not None:
+                txn.releases.append(manifest.pop(fn))
+            else:
+                self.blobs.release(manifest.pop(fn))
+        self._save_manifest(collection, id, manifest)
+
+    def _is_spooled(self, content):
+        """
+        Is the supplied file-like object a file in the tmp_dir, which we are therefore free to move into the store?
+        """
+        path = getattr(content, "name", None)
+        if not isinstance(path, basestring) or self.configuration.tmp_dir is None or not os.path.isfile(path):
+            return False
+        tmp_dir = os.path.join(os.path.realpath(self.configuration.tmp_dir), "")
+        return os.path.realpath(path).startswith(tmp_dir)
+
     def store_statement(self, collection, id, statement):
-        """ Store the supplied statement document content in the object idenfied by the id in the specified collection """
-        # store the RDF version
-        sfile = os.path.join(self.configuration.store_dir, collection, id, "sss_statement.xml")
-        self.save(sfile, statement.serialise_rdf())
-        # store the Atom Feed version
-        sfile = os.path.join(self.configuration.store_dir, collection, id, "sss_statement.atom.xml")
-        self.save(sfile, statement.serialise_atom())
+        """
+        Store the supplied statement document content in the object idenfied by the id in the specified collection.
+        Only the compact JSON form is stored; the RDF/XML and Atom serialisations are made when they are asked for.
+        The stored statement is a checkpoint and a log of the events since it (see Statement.events_since), so a
+        change such as a new deposit only adds a small file holding its events, however large the statement has
+        grown.  A statement loaded from the container (see load_statement) brings the events of the changes made to
+        it, and any other is compared with the stored one.  Every statement_checkpoint_interval changes the log is
+        folded into a new checkpoint, so that there is never much of it to replay when the statement is read
+        """
+        checkpoint, seq = 0, 0
+        if self.file_exists(collection, id, STATEMENT_JSON):
+            checkpoint, seq, stored = self._materialise(collection, id)
+            if statement.saved_as == (collection, id, seq):
+                events = statement.logged_events_since(stored)
+            else:
+                events = statement.events_since(stored)
+            if len(events) == 0:
+                return
+            interval = self.configuration.statement_checkpoint_interval
+            if interval is None:
+                interval = DEFAULT_CHECKPOINT_INTERVAL
+            seq += 1
+            if seq - checkpoint < interval:
+                serialised = json.dumps(events, separators=(",", ":"))
+                self.save(collection, id, EVENTS + str(seq), serialised)
+                # the cached statement is made from the events as they were stored, just as it would be if it were
+                # read afresh
+                s = stored.copy()
+                for event in json.loads(serialised):
+                    s.apply_event(event)
+                self._cache_statement(collection, id, (checkpoint, seq, s))
+                statement.mark_saved(collection, id, seq)
+                return
+
+        d = statement.as_dict()
+        d["seq"] = seq
+        serialised = json.dumps(d, separators=(",", ":"))
+        self.save(collection, id, STATEMENT_JSON, serialised)
+        # the log it replaces, and any serialisations stored before the JSON form was used, are now out of date
+        for filename in [EVENTS + str(i) for i in range(checkpoint + 1, seq)] + [STATEMENT, STATEMENT_FEED]:
+            if self.file_exists(collection, id, filename):
+                self._delete(collection, id, filename)
+        # the cached statement is read back from what was stored, which keeps deposit times only to the second
+        s = Statement()
+        s.load_from_dict(json.loads(serialised))
+        self._cache_statement(collection, id, (seq, seq, s))
+        statement.mark_saved(collection, id, seq)
+
+    def _cache_statement(self, collection, id, stored):
+        """ keep the stored statement in the cache, for the version of the container that it belongs to """
+        version = self._statement_version(collection, id)
+        if version != UNVERSIONED:
+            DAO.statement_cache.put((collection, id), version, stored)
 
     def store_deposit_receipt(self, collection, id, receipt):
         """ Store the supplied receipt document content in the object idenfied by the id in the specified collection """
-        drfile = os.path.join(self.configuration.store_dir, collection, id, "sss_deposit-receipt.xml")
         if not isinstance(receipt, str):
             receipt = receipt.serialise()
-        self.save(drfile, receipt)
+        self.save(collection, id, RECEIPT, receipt)
+        version = self._file_version(collection, id, RECEIPT)
+        if version != UNVERSIONED:
+            self._cache_shared(collection, id, RECEIPT, version, receipt)
 
     def store_metadata(self, collection, id, metadata):
         """ Store the supplied metadata dictionary in the object idenfied by the id in the specified collection """
@@ -1084,15 +1553,16 @@ class DAO(object):
                 element = etree.SubElement(md, self.ns.DC + dct)
                 element.text = v
         s = etree.tostring(md, pretty_print=True)
-        mfile = os.path.join(self.configuration.store_dir, collection, id, "sss_metadata.xml")
-        self.save(mfile, s)
+        self.save(collection, id, METADATA, s)
 
     def get_metadata(self, collection, id):
-        if not self.file_exists(collection, id, "sss_metadata.xml"):
+        """ The metadata dictionary of the container, which is shared between processes through the cache """
+        return json.loads(self._cached(collection, id, METADATA, lambda: json.dumps(self._parse_metadata(collection, id))))
+
+    def _parse_metadata(self, collection, id):
+        if not self.file_exists(collection, id, METADATA):
             return {}
-        mfile = os.path.join(self.configuration.store_dir, collection, id, "sss_metadata.xml")
-        f = open(mfile, "r")
-        metadata = etree.fromstring(f.read())
+        metadata = etree.fromstring(self._read(collection, id, METADATA))
         md = {}
         for dc in metadata.getchildren():
             tag = dc.tag
@@ -1109,81 +1579,212 @@ class DAO(object):
         Remove all the content from the specified container.  If keep_metadata is True then the sss_metadata.xml
         file will not be removed
         """
-        odir = os.path.join(self.configuration.store_dir, collection, id)
-        for file in os.listdir(odir):
+        # release the files which are references into the blob store first, so that their blobs are removed when
+        # they are no longer used (the metadata and atom files are never references)
+        self._release(collection, id, self.get_manifest(collection, id).keys())
+        
+        for file in self._list(collection, id):
             # if there is a metadata.xml but metadata suppression on the deposit is turned on
             # then leave it alone
-            if file == "sss_metadata.xml" and keep_metadata:
+            if file == METADATA and keep_metadata:
                 continue
             if file == "atom.xml" and keep_atom:
                 continue
-            dpath = os.path.join(odir, file)
-            os.remove(dpath)
-
-    def remove_container(self, collection, id):
-        """ Remove the specified container and all of its contents """
-
-        # first remove the contents of the container
-        self.remove_content(collection, id)
+            if file == VERSION:
+                continue
+            self._delete(collection, id, file)
 
-        # finally remove the container itself
-        odir = os.path.join(self.configuration.store_dir, collection, id)
-        os.rmdir(odir)
+    def remove_container(self, collection, id, if_match=None):
+        """
+        Remove the specified container and all of its contents; if_match is a list of versions, one of which the
+        container must be at, or VersionConflict is raised (see transaction)
+        """
+        with self.locks.lock(collection, id):
+            self._check_version(collection, id, if_match)
+            self._release(collection, id, self.get_manifest(collection, id).keys())
+            self.backend.remove_container(collection, id)
+            for filename in [STATEMENT_JSON] + SHARED:
+                self._forget(collection, id, filename)
+            if DAO.package_cache is not None:
+                DAO.package_cache.forget(collection, id)
 
     def get_store_path(self, collection, id=None, filename=None):
         """
         Get the path to the specified filename in the store.  This is a utility method and should be used with care;
         all content which goes into the store through the store_content method will have its filename localised to
-        avoid name clashes, so this method CANNOT be used to retrieve those files.  Instead, this should be used
-        internally to locate sss specific files in the container, and for packagers to write their own files into
-        the store which are not part of the content itself.
+        avoid name clashes, so this method CANNOT be used to retrieve those files.  It only works with a storage
+        backend that keeps its files on the local disk; packagers should use open_file, open_file_for_write and save
+        instead, which work with any backend.
         """
-        if filename is not None:
-            return os.path.join(self.configuration.store_dir, collection, id, filename)
-        if id is not None:
-            return os.path.join(self.configuration.store_dir, collection, id)
-        return os.path.join(self.configuration.store_dir, collection)
+        if not hasattr(self.backend, "get_path"):
+            raise NotImplementedError("the " + self.backend.__class__.__name__ + " storage backend has no local paths")
+        return self.backend.get_path(collection, id, filename)
+
+    def _read(self, collection, id, filename):
+        """ Read the whole of the named file in the container """
+        f = self.open_file(collection, id, filename)
+        try:
+            return f.read()
+        finally:
+            f.close()
 
     def get_deposit_receipt_content(self, collection, id):
         """ Read the deposit receipt for the specified container """
-        f = open(self.get_store_path(collection, id, "sss_deposit-receipt.xml"), "r")
-        return f.read()
+        return self._cached(collection, id, RECEIPT, lambda: self._read(collection, id, RECEIPT))
 
     def get_statement_content(self, collection, id):
-        """ Read the statement for the specified container """
-        f = open(self.get_store_path(collection, id, "sss_statement.xml"), "r")
-        return f.read()
+        """ Read the statement for the specified container, as RDF/XML """
+        return self._cached(collection, id, STATEMENT, lambda: self._render_statement(collection, id, STATEMENT),
+                            self._statement_version(collection, id))
 
     def get_statement_feed(self, collection, id):
-        """ Read the statement for the specified container """
-        f = open(self.get_store_path(collection, id, "sss_statement.atom.xml"), "r")
-        return f.read()
+        """ Read the statement for the specified container, as an Atom feed """
+        return self._cached(collection, id, STATEMENT_FEED, lambda: self._render_statement(collection, id, STATEMENT_FEED),
+                            self._statement_version(collection, id))
+
+    def _render_statement(self, collection, id, filename):
+        """ the named serialisation of the statement, made from the JSON form, or read if it was stored before that """
+        if not self.file_exists(collection, id, STATEMENT_JSON):
+            return self._read(collection, id, filename)
+        statement = self.load_statement(collection, id)
+        return statement.serialise_rdf() if filename == STATEMENT else statement.serialise_atom()
+
+    def _cached(self, collection, id, filename, load, version=None):
+        """
+        the string which load makes from the named file, from the shared cache if it is there for the version of
+        the container that the file belongs to (or the given version, if it is made from something else), and
+        otherwise made and put there
+        """
+        if DAO.shared_cache is None:
+            return load()
+        if version is None:
+            version = self._file_version(collection, id, filename)
+        if version == UNVERSIONED:
+            return load()
+        value = DAO.shared_cache.get(collection + "/" + id + "/" + filename, version)
+        if value is None:
+            value = load()
+            self._cache_shared(collection, id, filename, version, value)
+        return value
+
+    def _cache_shared(self, collection, id, filename, version, value):
+        if DAO.shared_cache is not None:
+            DAO.shared_cache.put(collection + "/" + id + "/" + filename, version, value)
+
+    def _forget(self, collection, id, filename):
+        """ throw away what is cached from the named file, which is being changed """
+        if filename in [STATEMENT_JSON, STATEMENT] or filename.startswith(EVENTS):
+            DAO.statement_cache.discard((collection, id))
+        names = [STATEMENT, STATEMENT_FEED] if filename == STATEMENT_JSON or filename.startswith(EVENTS) else [filename]
+        for name in names:
+            if name in SHARED and DAO.shared_cache is not None:
+                DAO.shared_cache.discard(collection + "/" + id + "/" + name)
 
     def get_atom_content(self, collection, id):
         """ Read the statement for the specified container """
         if not self.file_exists(collection, id, "atom.xml"):
             return None
-        f = open(self.get_store_path(collection, id, "atom.xml"), "r")
-        return f.read()
+        return self._read(collection, id, "atom.xml")
 
     def load_statement(self, collection, id):
         """
-        Load the Statement object for the specified container
+        Load the Statement object for the specified container.  Statements are cached for as long as the container
+        stays at the same version, and each caller is given its own copy, so it may change it freely
         Returns a Statement object fully populated to represent this object
         """
-        sfile = os.path.join(self.configuration.store_dir, collection, id, "sss_statement.xml")
-        s = Statement(rdf_file=sfile)
+        checkpoint, seq, stored = self._materialise(collection, id)
+        s = stored.copy()
+        s.mark_saved(collection, id, seq)
         return s
 
+    def _materialise(self, collection, id):
+        """
+        the stored statement of the container, made by applying the events logged since its checkpoint to it (see
+        store_statement), from the cache if it is there for the version of the container that it belongs to.
+        Returns a tuple of the sequence number of the checkpoint, that of the last event applied, and the Statement,
+        which must not be changed
+        """
+        version = self._statement_version(collection, id)
+        if version != UNVERSIONED:
+            stored = DAO.statement_cache.get((collection, id), version)
+            if stored is not None:
+                return stored
+        if self.file_exists(collection, id, STATEMENT_JSON):
+            d = json.loads(self._read(collection, id, STATEMENT_JSON))
+            s = Statement()
+            s.load_from_dict(d)
+            checkpoint = seq = d.get("seq", 0)
+            while self.file_exists(collection, id, EVENTS + str(seq + 1)):
+                for event in json.loads(self._read(collection, id, EVENTS + str(seq + 1))):
+                    s.apply_event(event)
+                seq += 1
+        else:
+            # a statement stored before the JSON form was used
+            f = self.open_file(collection, id, STATEMENT)
+            try:
+                s = Statement(rdf_file=f)
+            finally:
+                f.close()
+            checkpoint = seq = 0
+        stored = (checkpoint, seq, s)
+        # there is no telling whether a container without a version has changed, so it is never cached
+        if version != UNVERSIONED:
+            DAO.statement_cache.put((collection, id), version, stored)
+        return stored
+
+    def _statement_version(self, collection, id):
+        """
+        the version of the container which the statement that this DAO sees belongs to (see _file_version), which
+        is changed by a change to either its checkpoint or its log
+        """
+        txn = self._txn(collection, id)
+        if txn is not None and any([name.startswith(EVENTS) for name in txn.puts.keys()]):
+            return txn.version
+        return self._file_version(collection, id, STATEMENT_JSON)
+
+    def _file_version(self, collection, id, filename):
+        """
+        the version of the container which the named file that this DAO sees belongs to: within a transaction which
+        has changed the file, the version the container will have once it is committed, and otherwise the one it
+        has outside the transaction
+        """
+        txn = self._txn(collection, id)
+        if txn is None:
+            return self.get_version(collection, id)
+        if txn.locate(filename) != filename:
+            return txn.version
+        if not self.backend.blob_exists(collection, id, VERSION):
+            return UNVERSIONED
+        return self.backend.get_blob(collection, id, VERSION).strip()
+
+    def get_package(self, collection, id, version, format):
+        """
+        An open handle on the dissemination package of the container which was made in the format (the negotiated
+        media format) from the specified version of it, if one is in the package cache, otherwise None
+        """
+        if DAO.package_cache is None or version == UNVERSIONED:
+            return None
+        return DAO.package_cache.get(collection, id, version, format)
+
+    def cache_package(self, collection, id, version, format, stream):
+        """
+        Keep the dissemination package in the stream in the package cache, as made in the format from the specified
+        version of the container, as it is read.  Returns the handle to serve it from, which is the stream itself if
+        it is not cached
+        """
+        if DAO.package_cache is None or version == UNVERSIONED:
+            return stream
+        cached = DAO.package_cache.put(collection, id, version, format, stream)
+        return cached if cached is not None else stream
+
     def list_content(self, collection, id, exclude=[]):
         """
         List the contents of the specified container, excluding any files whose name exactly matches those in the
         exclude list.  This method will also not list sss specific files, thus limiting it to the content files of
         the object.
         """
-        cdir = os.path.join(self.configuration.store_dir, collection)
-        odir = os.path.join(cdir, id)
-        cfiles = [f for f in os.listdir(odir) if not f.startswith("sss_") and not f in exclude]
+        files = self._list(collection, id) + self._pointers(collection, id).keys()
+        cfiles = [f for f in files if not f.startswith("sss_") and not f in exclude]
         return cfiles
 
 # Basic Web Interface
@@ -1228,8 +1829,7 @@ class CollectionPage(WebPage):
         frag = "<h1>Collection: " + id + "</h1>"
         
         # list all of the containers in the collection
-        cpath = self.dao.get_store_path(id)
-        containers = os.listdir(cpath)
+        containers = self.dao.get_container_ids(id)
         frag += "<h2>Containers</h2><ul>"
         for container in containers:
             frag += "<li><a href=\"" + self.um.html_url(id, container) + "\">" + container + "</a></li>"
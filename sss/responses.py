@@ -0,0 +1,85 @@
+"""
+Utilities for sending the content of files and streams to the client as the bodies of responses, without ever
+holding the whole of them in memory.  Both the web.py and the Pylons front ends use these for the parts and media
+resources of containers.
+
+A file on the local disk is handed to the server's wsgi.file_wrapper (PEP 333) where there is one, so that a server
+which can (mod_wsgi, gunicorn, uWSGI) sends it with sendfile, and the content never passes through Python at all;
+anything else is sent a chunk at a time as it is read.  Either way, the file or stream is closed as soon as the server
+has finished with the body, whether it was all sent or the client went away.
+"""
+import os
+
+# the key in the WSGI environ under which a web.py handler leaves the body of its response for file_responses
+FILE_RESPONSE = "sss.file_response"
+
+def file_size(f):
+    """ The number of bytes left to read from the file, from its stat, or None if it is not a file on the disk """
+    fileno = _fileno(f)
+    if fileno is None:
+        return None
+    try:
+        return os.fstat(fileno).st_size - f.tell()
+    except (IOError, OSError):
+        return None
+
+def file_body(environ, f, chunk_size):
+    """
+    The body of a response which sends the content of the file (or stream): the server's wsgi.file_wrapper around it
+    if it can have one (see file_wrapper), and otherwise its chunks as they are read (see read_chunks).  The server
+    closes the file once it has finished with the body
+    """
+    wrapped = file_wrapper(environ, f, chunk_size)
+    return wrapped if wrapped is not None else read_chunks(f, chunk_size)
+
+def file_wrapper(environ, f, chunk_size):
+    """ The server's wsgi.file_wrapper around the file, or None if it is not a file on the disk or there is none """
+    wrapper = environ.get("wsgi.file_wrapper")
+    if wrapper is None or _fileno(f) is None:
+        return None
+    return wrapper(f, chunk_size)
+
+def read_chunks(stream, chunk_size):
+    """
+    The content of the stream, a chunk at a time as it is read.  The stream is closed once it has all been read, or
+    once the generator is closed (as the server closes the body of a response when the client has gone away)
+    """
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        stream.close()
+
+def file_responses(app):
+    """
+    WSGI middleware for the web.py application, which wraps whatever its handlers return in an iterator of its own,
+    so that the server would never see a wsgi.file_wrapper.  A handler which leaves the body of its response in the
+    environ under FILE_RESPONSE instead has that returned to the server as it is, once web.py has finished with the
+    request
+    """
+    def wrapped(environ, start_response):
+        result = app(environ, start_response)
+        body = environ.pop(FILE_RESPONSE, None)
+        if body is None:
+            return result
+        # web.py cleans up after the request once what it returned has been read
+        try:
+            for chunk in result:
+                pass
+        except:
+            body.close()
+            raise
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return body
+    return wrapped
+
+def _fileno(f):
+    try:
+        return f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return None
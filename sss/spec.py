@@ -96,6 +96,8 @@ class HttpHeaders(object):
     metadata_relevant = "metadata-relevant"
     slug = "slug"
     content_length = "content-length"
+    content_encoding = "content-encoding"
+    if_match = "if-match"
     
     sword_headers = {
         content_type : None,
@@ -105,7 +107,9 @@ class HttpHeaders(object):
         on_behalf_of : None,
         metadata_relevant : "true",
         slug : None,
-        content_length : 0
+        content_length : 0,
+        content_encoding : None,
+        if_match : None
     }
     
     allowed_values = {
@@ -234,10 +238,26 @@ class HttpHeaders(object):
             ssslog.debug("Extracting filename from " + HttpHeaders.content_disposition + " " + str(cd))
             # ok, this is a bit obtuse, but it was fun making it.  It's not hard to understand really, if you break
             # it down
-            return cd[cd.find("filename=") + len("filename="):cd.find(";", cd.find("filename=")) if cd.find(";", cd.find("filename=")) > -1 else len(cd)]
+            fn = cd[cd.find("filename=") + len("filename="):cd.find(";", cd.find("filename=")) if cd.find(";", cd.find("filename=")) > -1 else len(cd)]
+            # the filename may be a quoted-string (as it usually is in the headers of a multipart part)
+            return fn.strip().strip('"')
         else:
             return None
 
+    def extract_entity_tags(self, value):
+        """
+        get the entity tags out of an If-Match header, without their quotes, or None if it is "*" (which matches
+        any version).  Weak tags are left out, as If-Match only ever compares tags strongly
+        """
+        tags = []
+        for tag in value.split(","):
+            tag = tag.strip()
+            if tag == "*":
+                return None
+            if tag != "" and not tag.startswith("W/"):
+                tags.append(tag.strip('"'))
+        return tags
+
 
 
 
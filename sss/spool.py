@@ -0,0 +1,424 @@
+"""
+Utilities for moving request bodies from the network into the store without ever holding the whole body in memory.
+Both the web.py and the Pylons front ends use these to spool incoming deposits to the temp directory, and the DAO
+uses them to move or copy content into the store in bounded chunks
+"""
+import os, uuid, hashlib, errno, threading, time, zlib
+from StringIO import StringIO
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 8096
+
+# the durability modes for spooled files (the spool_durability configuration option)
+DURABILITY_NONE = "none"                    # leave it to the operating system to write the file out
+DURABILITY_ON_CLOSE = "on-close"            # fsync the file once, when it has been completely written
+DURABILITY_GROUP_COMMIT = "group-commit"    # as on-close, but batch the fsyncs of concurrent requests together
+DURABILITY_MODES = [DURABILITY_NONE, DURABILITY_ON_CLOSE, DURABILITY_GROUP_COMMIT]
+
+# how long, in seconds, the group committer waits to gather up concurrent fsyncs into a batch
+GROUP_COMMIT_INTERVAL = 0.005
+
+# the size, in bytes, below which a SpooledBody is kept in memory rather than written to disk
+DEFAULT_MEMORY_THRESHOLD = 65536
+
+# the Content-Encodings that DecodingReader can undo, and the zlib window bits which select their wrappers
+CONTENT_ENCODINGS = {
+    "gzip" : 16 + zlib.MAX_WBITS,
+    "x-gzip" : 16 + zlib.MAX_WBITS,
+    "deflate" : zlib.MAX_WBITS
+}
+
+class MaxSizeExceeded(Exception):
+    """ Raised when a stream turns out to be larger than the maximum size allowed """
+    def __init__(self, max_size):
+        Exception.__init__(self, "content exceeds the maximum size of " + str(max_size) + " bytes")
+        self.max_size = max_size
+
+def copy_stream(source, target, chunk_size=None, size=None, max_chunk_size=None, max_size=None):
+    """
+    Copy the content of the file-like object source into the file-like object target, reading no more than
+    chunk_size bytes at a time.  If size is supplied, no more than size bytes will be read from the source (this is
+    important for wsgi.input, which should not be read beyond the Content-Length); if it is None the source is read
+    to the end (e.g. a chunked request body, whose length is not known in advance).  If max_size is supplied,
+    MaxSizeExceeded is raised as soon as the source turns out to hold more than that.  If max_chunk_size is supplied,
+    the chunk size is doubled every time the source fills a whole chunk, up to that maximum, so that large streams are
+    copied in fewer, larger reads and writes.  Returns the number of bytes copied
+    """
+    chunk_size = chunk_size if chunk_size is not None else DEFAULT_CHUNK_SIZE
+    copied = 0
+    while size is None or copied < size:
+        to_read = chunk_size if size is None else min(chunk_size, size - copied)
+        chunk = source.read(to_read)
+        if chunk is None or chunk == "":
+            break
+        if max_size is not None and copied + len(chunk) > max_size:
+            raise MaxSizeExceeded(max_size)
+        target.write(chunk)
+        copied += len(chunk)
+        if max_chunk_size is not None and len(chunk) == chunk_size and chunk_size < max_chunk_size:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+    return copied
+
+class _Batch(object):
+    """ A set of file descriptors which will be fsynced together by the GroupCommitter """
+    def __init__(self):
+        self.fds = []
+        self.errors = {}
+        self.done = threading.Event()
+
+class GroupCommitter(object):
+    """
+    Batches up the fsyncs of files which are being written by concurrent requests.  The first request to ask for a
+    sync waits for the commit interval, during which any other requests which ask for a sync join its batch, and then
+    syncs every file in the batch before releasing all of the waiting requests together.  This means that a busy
+    server performs one round of disk flushes per interval, rather than one per request
+    """
+    def __init__(self, interval=GROUP_COMMIT_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def sync(self, f):
+        """
+        Flush the supplied file object and block until it has been fsynced as part of a batch
+        """
+        f.flush()
+        fd = f.fileno()
+        with self._lock:
+            leader = self._batch is None
+            if leader:
+                self._batch = _Batch()
+            batch = self._batch
+            batch.fds.append(fd)
+
+        if leader:
+            # give the other requests a chance to join the batch, then close it and sync everything in it
+            time.sleep(self.interval)
+            with self._lock:
+                self._batch = None
+            ssslog.debug("Group commit of " + str(len(batch.fds)) + " spooled files")
+            for bfd in batch.fds:
+                try:
+                    os.fsync(bfd)
+                except OSError as e:
+                    batch.errors[bfd] = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if fd in batch.errors:
+            raise batch.errors[fd]
+
+# the group committer which is shared by all the requests in this process
+group_committer = GroupCommitter()
+
+def sync_file(f, durability=None):
+    """
+    Make the content written to the supplied file object durable according to the durability mode (one of
+    DURABILITY_MODES; None is the same as DURABILITY_NONE)
+    """
+    if durability is None or durability == DURABILITY_NONE:
+        return
+    if durability == DURABILITY_ON_CLOSE:
+        f.flush()
+        os.fsync(f.fileno())
+    elif durability == DURABILITY_GROUP_COMMIT:
+        group_committer.sync(f)
+    else:
+        raise ValueError("unknown spool durability mode: " + str(durability) + "; use one of " + ", ".join(DURABILITY_MODES))
+
+class DigestWriter(object):
+    """
+    File-like object which wraps a writable file and computes the MD5 and SHA-256 digests and the byte count of
+    everything that is written through it, so that checksums can be had in the same pass that writes the content.  If
+    no file is supplied the content is just digested and then discarded
+    """
+    def __init__(self, f=None):
+        self.f = f
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._md5.update(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        if self.f is not None:
+            self.f.write(data)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def digests(self):
+        return {"md5" : self.md5, "sha256" : self.sha256}
+
+def digest_stream(source, chunk_size=None):
+    """
+    Read the supplied file-like object to the end in chunks, and return a DigestWriter holding its digests and size
+    """
+    writer = DigestWriter()
+    copy_stream(source, writer, chunk_size)
+    return writer
+
+class UnsupportedContentEncoding(Exception):
+    """ Raised when a request body has a Content-Encoding that we cannot decode """
+    pass
+
+class ContentEncodingError(Exception):
+    """ Raised when a request body cannot be decoded according to its Content-Encoding """
+    pass
+
+def parse_content_encoding(value):
+    """
+    Interpret the value of a Content-Encoding header, returning the (lower case) content coding that it names, or None
+    if the content is not encoded.  UnsupportedContentEncoding is raised for anything which DecodingReader cannot
+    undo, including a series of codings
+    """
+    encoding = (value or "").strip().lower()
+    if encoding in ["", "identity"]:
+        return None
+    if encoding not in CONTENT_ENCODINGS:
+        raise UnsupportedContentEncoding("unsupported Content-Encoding: " + value)
+    return encoding
+
+class DecodingReader(object):
+    """
+    Read-only file-like object which decompresses a gzip or deflate encoded stream (e.g. wsgi.input) on the fly.  No
+    more than size encoded bytes are read from the stream (or it is read to the end, if size is None), and
+    MaxSizeExceeded is raised as soon as there turn out to be more than max_size of them.  The decompressor never
+    produces more than chunk_size bytes from a single read of the stream, so a small body which decompresses to
+    something enormous is never held in memory.  The MD5 of the encoded bytes is computed as they are read, since that
+    is what the Content-MD5 header describes, and is available as md5 once the stream has been read
+    """
+    def __init__(self, stream, encoding, size=None, chunk_size=None, max_size=None):
+        self.stream = stream
+        self.encoding = encoding
+        self.remaining = size
+        self.chunk_size = chunk_size if chunk_size is not None else DEFAULT_CHUNK_SIZE
+        self.max_size = max_size
+        self.encoded_size = 0
+        self._md5 = hashlib.md5()
+        self._decompressor = zlib.decompressobj(CONTENT_ENCODINGS[encoding])
+        self._buffer = ""
+        self._eof = False
+
+        # many clients send raw deflate data rather than the zlib format that HTTP calls deflate, so if the first
+        # block of a deflate body is not zlib we go back and try it as raw deflate
+        self._first = encoding == "deflate"
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    def read(self, n=-1):
+        while not self._eof and (n is None or n < 0 or len(self._buffer) < n):
+            self._decode()
+        if n is None or n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def _read_encoded(self):
+        to_read = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+        chunk = self.stream.read(to_read) if to_read > 0 else ""
+        if chunk is None:
+            return ""
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self.encoded_size += len(chunk)
+        if self.max_size is not None and self.encoded_size > self.max_size:
+            raise MaxSizeExceeded(self.max_size)
+        self._md5.update(chunk)
+        return chunk
+
+    def _decode(self):
+        data = self._decompressor.unconsumed_tail
+        if data == "":
+            data = self._read_encoded()
+            if data == "":
+                self._finish()
+                return
+        try:
+            try:
+                out = self._decompressor.decompress(data, self.chunk_size)
+            except zlib.error:
+                if not self._first:
+                    raise
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                out = self._decompressor.decompress(data, self.chunk_size)
+        except zlib.error as e:
+            raise ContentEncodingError("content is not valid " + self.encoding + ": " + str(e))
+        self._first = False
+        self._buffer += out
+
+    def _finish(self):
+        self._eof = True
+        try:
+            # zlib (at least in python 2) does not tell us whether it has seen the end of the compressed data, so we
+            # feed a copy of the decompressor another byte: if the data was complete it is left over as unused_data,
+            # and if it was truncated it is taken as more compressed data
+            probe = self._decompressor.copy()
+            probe.decompress("\0")
+            complete = probe.unused_data != ""
+            self._buffer += self._decompressor.flush()
+        except zlib.error as e:
+            raise ContentEncodingError("content is not valid " + self.encoding + ": " + str(e))
+        if not complete:
+            raise ContentEncodingError("truncated " + self.encoding + " content")
+
+class SpooledBody(object):
+    """
+    The body of a request, as received from the network.  Content written to it is held in memory until it grows
+    beyond the threshold, at which point it is rolled over into a new file in the tmp_dir, so that small bodies never
+    touch the disk and large ones are never held in memory.  The content is digested as it is written.
+
+    Once the body has been closed, its content can be read (as many times as necessary) from the handles returned by
+    open().  If the body is on disk, path is the file that holds it (and is None otherwise).  The file is removed by
+    discard(), or failing that when the body is garbage collected
+    """
+    def __init__(self, tmp_dir, threshold=None, durability=None):
+        self.tmp_dir = tmp_dir
+        self.threshold = threshold if threshold is not None else DEFAULT_MEMORY_THRESHOLD
+        self.durability = durability
+        self.path = None
+        self._buffer = StringIO()
+        self._file = None
+        self._digest = DigestWriter()
+
+    def write(self, data):
+        self._digest.write(data)
+        if self._file is None and self._buffer.tell() + len(data) > self.threshold:
+            self._rollover()
+        if self._file is not None:
+            self._file.write(data)
+        else:
+            self._buffer.write(data)
+
+    def close(self):
+        """ Finish writing the body; if it is on disk, it is synced according to the durability mode """
+        if self._file is not None:
+            sync_file(self._file, self.durability)
+            self._file.close()
+            self._file = None
+            ssslog.debug("Spooled " + str(self.size) + " bytes to " + self.path + " with MD5 " + self.md5)
+
+    def _rollover(self):
+        if not os.path.exists(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, str(uuid.uuid4()))
+        ssslog.info("Spooling incoming content to temp file " + self.path)
+        self._file = open(self.path, "wb")
+        self._file.write(self._buffer.getvalue())
+        self._buffer = None
+
+    @property
+    def in_memory(self):
+        return self.path is None
+
+    @property
+    def size(self):
+        return self._digest.size
+
+    @property
+    def md5(self):
+        return self._digest.md5
+
+    @property
+    def digests(self):
+        return self._digest.digests()
+
+    def open(self):
+        """ Return a new file-like object, positioned at the start of the content """
+        if self.path is not None:
+            return open(self.path, "rb")
+        return StringIO(self._buffer.getvalue())
+
+    def getvalue(self):
+        """ Return the whole of the content as a string """
+        if self.path is None:
+            return self._buffer.getvalue()
+        with self.open() as f:
+            return f.read()
+
+    def discard(self):
+        """ Remove the temp file that holds the body, if there is one """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            remove_quietly(self.path)
+
+    def __del__(self):
+        self.discard()
+
+def spool_body(stream, tmp_dir, size=None, chunk_size=None, max_chunk_size=None, threshold=None, durability=None,
+                max_size=None):
+    """
+    Read the content of the supplied stream (e.g. wsgi.input) into a new SpooledBody, in the same way as spool_to_tmp,
+    and return the closed body.  If the stream holds more than max_size bytes, the body is discarded and
+    MaxSizeExceeded is raised
+    """
+    body = SpooledBody(tmp_dir, threshold, durability)
+    try:
+        copy_stream(stream, body, chunk_size, size, max_chunk_size, max_size)
+        body.close()
+    except:
+        body.discard()
+        raise
+    return body
+
+def spool_to_tmp(stream, tmp_dir, size=None, chunk_size=None, max_chunk_size=None, durability=None):
+    """
+    Spool the content of the supplied stream (e.g. wsgi.input) into a new file in the tmp_dir.  The stream is read in
+    chunks, so the memory used is bounded by chunk_size (or max_chunk_size, if the chunk size is allowed to grow)
+    irrespective of the size of the body, and the content is digested as it is written.  Once the content has been
+    written the file is synced to disk according to the durability mode (see sync_file).
+    Returns a tuple of the path to the new file and the DigestWriter which holds the digests and size of the content
+    """
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    fn = os.path.join(tmp_dir, str(uuid.uuid4()))
+    ssslog.info("Spooling incoming content of size " + str(size) + " to temp file " + fn)
+    with open(fn, "wb") as outfile:
+        writer = DigestWriter(outfile)
+        copy_stream(stream, writer, chunk_size, size, max_chunk_size)
+        sync_file(outfile, durability)
+    ssslog.debug("Spooled " + str(writer.size) + " bytes to " + fn + " with MD5 " + writer.md5)
+    return fn, writer
+
+def move_file(source, target, chunk_size=None):
+    """
+    Move the file at the source path to the target path.  Where both are on the same filesystem this is just a
+    rename, so the content is not written a second time; otherwise the content is copied in chunks and the source
+    removed
+    """
+    try:
+        os.rename(source, target)
+        ssslog.debug("Renamed " + source + " to " + target)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    ssslog.debug("Unable to rename " + source + " to " + target + " across devices; copying instead")
+    with open(source, "rb") as infile:
+        with open(target, "wb") as outfile:
+            copy_stream(infile, outfile, chunk_size)
+    os.remove(source)
+
+def remove_quietly(path):
+    """
+    Remove the file at the supplied path if it still exists.  Spooled files may legitimately have been moved or
+    removed by the time the request is cleaned up, so this never raises
+    """
+    try:
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        ssslog.warn("Unable to remove temporary file " + str(path) + ": " + str(e))
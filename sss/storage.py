@@ -0,0 +1,1023 @@
+"""
+Storage backends for the DAO.
+
+The store is organised as collections, each of which holds containers, each of which holds files (blobs).  A
+StorageBackend provides the operations the DAO needs on that structure: creating, listing, testing for and removing
+collections and containers, and putting, getting, streaming and deleting the blobs within them.  Blobs are always
+written and read through file-like objects in chunks, so no backend ever needs to hold a whole file in memory.
+
+The FilesystemBackend keeps the original directory layout under the store_dir, or a sharded version of it for very
+large collections, and can spread the containers over several disks.  The S3Backend keeps the same
+structure as keys in an S3 bucket (or anything else that speaks the S3 API), so that SSS can sit in front of object
+storage.  Select the backend with the storage_backend configuration option.
+
+Either backend may also hold a BlobStore: a pool of content-addressed blobs, which lets identical files in many
+containers share one copy of their bytes (see the deduplicate configuration option).  Collections whose names begin
+with "." (such as the pool) are internal to the store, and are not listed as collections.
+"""
+import os, shutil, tempfile, hashlib, hmac, httplib, urlparse, urllib, errno, itertools, uuid
+from datetime import datetime
+from lxml import etree
+
+from StringIO import StringIO
+
+from spool import copy_stream, move_file, spool_to_tmp, digest_stream, remove_quietly, sync_file
+from locks import ContainerLocks
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+class StorageError(Exception):
+    """ Raised when the storage backend cannot carry out an operation """
+    pass
+
+class StorageBackend(object):
+    """
+    Interface for all classes wishing to provide storage for the DAO.  Collections and containers are addressed by
+    name, and blobs by the collection, container id and name.  The extender must implement all of these methods,
+    except for link_blob and link_count, which are only needed by backends which set supports_links
+    """
+    # can this backend make one blob a hard link to another (which the BlobStore uses for its references)?
+    supports_links = False
+
+    def __init__(self, config):
+        self.config = config
+
+    def list_collections(self):
+        """ list the names of all the collections in the store """
+        raise NotImplementedError()
+
+    def list_containers(self, collection):
+        """ list the ids of all the containers in the collection """
+        raise NotImplementedError()
+
+    def list_blobs(self, collection, id):
+        """ list the names of all the blobs in the container """
+        raise NotImplementedError()
+
+    def collection_exists(self, collection):
+        raise NotImplementedError()
+
+    def container_exists(self, collection, id):
+        raise NotImplementedError()
+
+    def blob_exists(self, collection, id, name):
+        raise NotImplementedError()
+
+    def blob_size(self, collection, id, name):
+        """ the size in bytes of the blob, or None if it does not exist """
+        raise NotImplementedError()
+
+    def create_collection(self, collection):
+        raise NotImplementedError()
+
+    def create_container(self, collection, id):
+        raise NotImplementedError()
+
+    def remove_container(self, collection, id):
+        """ remove the container and everything in it """
+        raise NotImplementedError()
+
+    def put_blob(self, collection, id, name, content):
+        """ store the content, which may be a string or a file-like object, as the named blob """
+        raise NotImplementedError()
+
+    def move_blob_in(self, collection, id, name, path):
+        """
+        Store the local file at the path as the named blob, removing it from the local disk.  Backends should
+        override this where they can do better than copying the file
+        """
+        with open(path, "rb") as f:
+            self.put_blob(collection, id, name, f)
+        os.remove(path)
+
+    def get_blob(self, collection, id, name):
+        """ the content of the blob, as a string """
+        f = self.open_blob(collection, id, name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def open_blob(self, collection, id, name, seekable=False):
+        """
+        Open the blob for reading, and return the file-like stream handle, which the caller must close.  If seekable
+        is True the handle must support seek and tell (e.g. for the zipfile module)
+        """
+        raise NotImplementedError()
+
+    def open_blob_for_write(self, collection, id, name):
+        """
+        Open the named blob for writing, and return a seekable file-like handle.  The content becomes the blob when
+        the handle is closed
+        """
+        raise NotImplementedError()
+
+    def delete_blob(self, collection, id, name):
+        """ delete the blob (which may be a directory of blobs, where a package was unpacked into one) """
+        raise NotImplementedError()
+
+    def rename_blob(self, collection, id, name, new_name):
+        """
+        Give the blob a new name in its container, replacing any blob which already has that name.  Backends should
+        override this where they can do better than copying the blob
+        """
+        f = self.open_blob(collection, id, name)
+        try:
+            self.put_blob(collection, id, new_name, f)
+        finally:
+            f.close()
+        self.delete_blob(collection, id, name)
+
+    def link_blob(self, collection, id, name, target_collection, target_id, target_name):
+        """ make the target blob a hard link to the blob, replacing anything already there """
+        raise NotImplementedError()
+
+    def link_count(self, collection, id, name):
+        """ the number of hard links to the blob, including the blob itself """
+        raise NotImplementedError()
+
+class FilesystemBackend(StorageBackend):
+    """
+    Stores each collection as a directory in the store_dir, each container as a directory in its collection, and each
+    blob as a file in its container.
+
+    With the store_layout option set to "sharded", the containers are spread over two levels of shard directories
+    named from the MD5 of their id (e.g. <collection>/.shards/ab/cd/<id>), so that no directory has to hold more than
+    a few of them however big the collection grows.  The shards are kept apart from the collection's other entries
+    because a container id may be anything (it may come from the Slug), so it could look like a shard.  A sharded
+    store still finds any containers which have been left in the flat layout, so an existing store keeps working
+    while migrate_layout moves them into their shards.  Names in a collection which begin with "." are internal to
+    the store, and are not listed as containers.
+
+    With several roots in the store_dirs option, the containers are spread over the disks.  The first root (which is
+    the store_dir) holds the collections as before, and each container in them is a symbolic link to the directory
+    that the store_placement policy chose for it: <root>/<collection>/.placed/ab/cd/<id> on one of the roots.  The
+    link is the record of the placement, so finding a container is still a single path lookup, and rebalance can
+    move a container to another root by copying it and then swapping its link.  Hard links cannot cross disks, so a
+    store with several roots keeps pointers to the blob store, like the S3Backend
+    """
+    SHARDS = ".shards"
+    PLACED = ".placed"
+    PLACEMENTS = ["hash", "least_used", "round_robin"]
+
+    # the sequence for round robin placement, shared by every instance in the process
+    _placements = itertools.count()
+
+    def __init__(self, config):
+        self.config = config
+        self.roots = config.store_dirs or [config.store_dir]
+        self.store_dir = self.roots[0]
+        self.sharded = config.store_layout == "sharded"
+        self.placement = config.store_placement or "hash"
+        if self.placement not in self.PLACEMENTS:
+            raise StorageError("unknown store_placement " + self.placement)
+        self.supports_links = len(self.roots) == 1
+        self.locks = ContainerLocks(config)
+
+    def get_path(self, collection, id=None, name=None):
+        """ the path to the collection, container or blob on the local disk """
+        if id is None:
+            return os.path.join(self.store_dir, collection)
+        cdir = self._container_path(collection, id)
+        if name is None:
+            return cdir
+        path = os.path.join(cdir, name)
+        if not os.path.abspath(path).startswith(os.path.join(os.path.abspath(cdir), "")):
+            raise StorageError("blob name " + name + " is outside of its container")
+        return path
+
+    def _flat_path(self, collection, id):
+        return os.path.join(self.store_dir, collection, id)
+
+    def _sharded_path(self, collection, id):
+        digest = hashlib.md5(id).hexdigest()
+        return os.path.join(self.store_dir, collection, self.SHARDS, digest[:2], digest[2:4], id)
+
+    def _container_path(self, collection, id):
+        # the internal collections (such as the blob pool) are never sharded, as they are organised already
+        if not self.sharded or collection.startswith("."):
+            return self._flat_path(collection, id)
+        sharded = self._sharded_path(collection, id)
+        if os.path.exists(sharded):
+            return sharded
+        flat = self._flat_path(collection, id)
+        if os.path.exists(flat) and id not in [self.SHARDS, self.PLACED]:
+            # not migrated yet, unless it has been moved since we looked in its shard
+            return flat
+        return sharded
+
+    def list_collections(self):
+        if not os.path.exists(self.store_dir):
+            return []
+        return [c for c in os.listdir(self.store_dir) if not c.startswith(".")]
+
+    def list_containers(self, collection):
+        cdir = self.get_path(collection)
+        if not os.path.exists(cdir):
+            return []
+        if collection.startswith("."):
+            return os.listdir(cdir)
+        ids = [id for id in os.listdir(cdir) if not id.startswith(".")]
+        if not self.sharded:
+            return ids
+
+        # anything else in the collection directory is a container that has yet to be migrated.  A container which
+        # is migrated while we are listing was either in that listing or moves into a shard we have not reached
+        # yet, so none is missed, but one may be seen twice
+        seen = set(ids)
+        sdir = os.path.join(cdir, self.SHARDS)
+        for first in _listdir_quietly(sdir):
+            for second in _listdir_quietly(os.path.join(sdir, first)):
+                for id in _listdir_quietly(os.path.join(sdir, first, second)):
+                    if id not in seen and not id.startswith("."):
+                        ids.append(id)
+                        seen.add(id)
+        return ids
+
+    def migrate_layout(self, collection=None):
+        """
+        Move every container which is still in the flat layout into its shard, in the collection or (if it is None)
+        the whole store, while the store is in use.  Each container is moved with a single rename, under its lock, so
+        it is always in one place or the other and is never copied.  Returns the number of containers moved
+        """
+        if not self.sharded:
+            raise StorageError("the store_layout must be sharded before the store can be migrated to it")
+        moved = 0
+        for c in ([collection] if collection is not None else self.list_collections()):
+            cdir = self.get_path(c)
+            for id in _listdir_quietly(cdir):
+                if id.startswith(".") or not os.path.isdir(os.path.join(cdir, id)):
+                    continue
+                target = self._sharded_path(c, id)
+                _makedirs(os.path.dirname(target))
+                # under the container's lock, so that no transaction is part way through changing it
+                with self.locks.lock(c, id):
+                    try:
+                        os.rename(self._flat_path(c, id), target)
+                    except OSError as e:
+                        # someone else removed or moved it first
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue
+                ssslog.debug("Moved container " + c + "/" + id + " into its shard")
+                moved += 1
+        return moved
+
+    def list_blobs(self, collection, id):
+        return os.listdir(self.get_path(collection, id))
+
+    def collection_exists(self, collection):
+        return os.path.exists(self.get_path(collection))
+
+    def container_exists(self, collection, id):
+        return os.path.exists(self.get_path(collection, id))
+
+    def blob_exists(self, collection, id, name):
+        return os.path.exists(self.get_path(collection, id, name))
+
+    def blob_size(self, collection, id, name):
+        path = self.get_path(collection, id, name)
+        if not os.path.isfile(path):
+            return None
+        return os.path.getsize(path)
+
+    def create_collection(self, collection):
+        cdir = self.get_path(collection)
+        if not os.path.exists(cdir):
+            os.makedirs(cdir)
+
+    def create_container(self, collection, id):
+        path = self.get_path(collection, id)
+        if len(self.roots) == 1 or collection.startswith(".") or os.path.lexists(path):
+            _makedirs(path)
+            return
+        target = self._placed_path(self._place(collection, id), collection, id)
+        _makedirs(target)
+        _makedirs(os.path.dirname(path))
+        try:
+            os.symlink(target, path)
+        except OSError as e:
+            # someone else created the container first
+            if e.errno != errno.EEXIST:
+                raise
+            if os.path.realpath(path) != target:
+                os.rmdir(target)
+        ssslog.debug("Placed container " + collection + "/" + id + " in " + target)
+
+    def remove_container(self, collection, id):
+        path = self.get_path(collection, id)
+        if os.path.islink(path):
+            # the container goes as soon as its link does
+            target = os.readlink(path)
+            os.remove(path)
+            shutil.rmtree(target)
+        else:
+            shutil.rmtree(path)
+
+    def put_blob(self, collection, id, name, content):
+        with self.open_blob_for_write(collection, id, name) as f:
+            if hasattr(content, "read"):
+                copy_stream(content, f, self.config.copy_chunk_size, max_chunk_size=self.config.max_copy_chunk_size)
+            else:
+                f.write(content)
+
+    def move_blob_in(self, collection, id, name, path):
+        # just a rename where the file is on the same filesystem as the store
+        move_file(path, self._writable_path(collection, id, name), self.config.copy_chunk_size)
+
+    def open_blob(self, collection, id, name, seekable=False):
+        return open(self.get_path(collection, id, name), "rb")
+
+    def open_blob_for_write(self, collection, id, name):
+        # written to a temp file which is renamed over the blob when it is closed, so a blob is never seen half
+        # written, and no other file which shares it through a hard link is changed
+        return _AtomicFile(self._writable_path(collection, id, name), self.config.store_durability)
+
+    def delete_blob(self, collection, id, name):
+        path = self.get_path(collection, id, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def rename_blob(self, collection, id, name, new_name):
+        os.rename(self.get_path(collection, id, name), self._writable_path(collection, id, new_name))
+
+    def link_blob(self, collection, id, name, target_collection, target_id, target_name):
+        target = self._writable_path(target_collection, target_id, target_name)
+        if os.path.lexists(target):
+            os.remove(target)
+        os.link(self.get_path(collection, id, name), target)
+
+    def link_count(self, collection, id, name):
+        return os.stat(self.get_path(collection, id, name)).st_nlink
+
+    # placement across several roots
+    #################################
+
+    def _placed_path(self, root, collection, id):
+        digest = hashlib.md5(id).hexdigest()
+        return os.path.join(os.path.abspath(root), collection, self.PLACED, digest[:2], digest[2:4], id)
+
+    def _hash_root(self, collection, id):
+        return self.roots[int(hashlib.md5(collection + "/" + id).hexdigest(), 16) % len(self.roots)]
+
+    def _place(self, collection, id):
+        """ choose the root for a new container, by the store_placement policy """
+        if self.placement == "round_robin":
+            return self.roots[self._placements.next() % len(self.roots)]
+        if self.placement == "least_used":
+            return max(self.roots, key=_free_space)
+        return self._hash_root(collection, id)
+
+    def container_root(self, collection, id):
+        """ the root which holds the container """
+        path = self.get_path(collection, id)
+        if not os.path.islink(path):
+            return self.store_dir
+        target = os.readlink(path)
+        for root in self.roots:
+            if target.startswith(os.path.join(os.path.abspath(root), "")):
+                return root
+        raise StorageError("container " + collection + "/" + id + " is linked to " + target + ", which is not in any of the store_dirs")
+
+    def move_container(self, collection, id, root):
+        """
+        Move the container to the root, while the store is in use.  The container's lock (see locks.py) is held while
+        it is copied to its place on the root, its link is swapped to the copy with a single rename, and the old copy
+        is removed, so no transaction can change it in the meantime, while requests which only read it go on reading
+        one copy or the other.  Returns whether the container was moved
+        """
+        with self.locks.lock(collection, id):
+            if self.container_root(collection, id) == root and os.path.islink(self.get_path(collection, id)):
+                return False
+            path = self.get_path(collection, id)
+            source = os.readlink(path) if os.path.islink(path) else path
+            target = self._placed_path(root, collection, id)
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            _makedirs(os.path.dirname(target))
+            shutil.copytree(source, target, symlinks=True)
+
+            link = os.path.join(os.path.dirname(path), "." + id + ".moving")
+            remove_quietly(link)
+            os.symlink(target, link)
+            if os.path.islink(path):
+                os.rename(link, path)
+            else:
+                # a container which was never placed is a directory, which a link cannot be renamed over, so it is
+                # moved aside first, and is missing for just the moment between the two renames
+                aside = os.path.join(os.path.dirname(path), "." + id + ".moved")
+                os.rename(path, aside)
+                os.rename(link, path)
+                source = aside
+
+            # nothing which takes the lock can have changed the container, but anything which does not is brought
+            # across before the old copy goes
+            _catch_up(source, target)
+            shutil.rmtree(source)
+        ssslog.debug("Moved container " + collection + "/" + id + " to " + target)
+        return True
+
+    def rebalance(self, collection=None):
+        """
+        Move containers between the roots, in the collection or (if it is None) the whole store, while the store is
+        in use.  With hash placement every container goes to the root that its hash chooses (for example, after a
+        root has been added); with the other policies, the containers of each collection are spread evenly over the
+        roots.  Returns the number of containers moved
+        """
+        moved = 0
+        for c in ([collection] if collection is not None else self.list_collections()):
+            ids = self.list_containers(c)
+            if self.placement == "hash":
+                for id in ids:
+                    if self.move_container(c, id, self._hash_root(c, id)):
+                        moved += 1
+                continue
+
+            # containers which were never placed (from before there were several roots) are always moved, so that
+            # they are placed too
+            by_root = dict([(root, []) for root in self.roots])
+            surplus = []
+            for id in ids:
+                if os.path.islink(self.get_path(c, id)):
+                    by_root[self.container_root(c, id)].append(id)
+                else:
+                    surplus.append(id)
+            share = len(ids) / len(self.roots)
+            extra = len(ids) % len(self.roots)
+            for i, root in enumerate(self.roots):
+                keep = share + (1 if i < extra else 0)
+                surplus += by_root[root][keep:]
+                by_root[root] = by_root[root][:keep]
+            for i, root in enumerate(self.roots):
+                keep = share + (1 if i < extra else 0)
+                while len(by_root[root]) < keep and len(surplus) > 0:
+                    id = surplus.pop()
+                    self.move_container(c, id, root)
+                    by_root[root].append(id)
+                    moved += 1
+        return moved
+
+    def _writable_path(self, collection, id, name):
+        """ the path to the blob, making any directories that it needs """
+        path = self.get_path(collection, id, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            # look again, in case the container has just been migrated into its shard, so that we do not make it
+            # again in the flat layout
+            path = self.get_path(collection, id, name)
+            _makedirs(os.path.dirname(path))
+        return path
+
+class S3Backend(StorageBackend):
+    """
+    Stores each blob as an object in an S3 bucket (or any other store that speaks the S3 API), under the key
+    [s3_prefix]collection/id/name.  Collections and containers are marked by empty objects whose keys end in "/", so
+    that they exist even when they are empty, in the same way that the S3 console makes folders.
+
+    Requests use path-style addressing (the endpoint, then the bucket), and are signed with AWS Signature Version 4
+    if s3_access_key is set.  Uploads are streamed from the content's file handle with a single PUT, so an individual
+    blob is limited to the 5GB that S3 allows for one
+    """
+    UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+    S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+    def __init__(self, config):
+        self.config = config
+        endpoint = urlparse.urlparse(config.s3_endpoint or "https://s3.amazonaws.com")
+        self.secure = endpoint.scheme == "https"
+        self.host = endpoint.netloc
+        self.bucket = config.s3_bucket
+        self.prefix = config.s3_prefix or ""
+        self.region = config.s3_region or "us-east-1"
+        self.access_key = config.s3_access_key
+        self.secret_key = config.s3_secret_key
+        self.chunk_size = config.max_copy_chunk_size or config.copy_chunk_size
+
+    # the structure of the store
+    ############################
+
+    def list_collections(self):
+        return [c for c in self._list(self.prefix)[1] if not c.startswith(".")]
+
+    def list_containers(self, collection):
+        return self._list(self._key(collection) + "/")[1]
+
+    def list_blobs(self, collection, id):
+        # sub-directories (e.g. from an unpacked package) are listed by name, as they are in the FilesystemBackend
+        names, prefixes = self._list(self._key(collection, id) + "/")
+        return names + prefixes
+
+    def collection_exists(self, collection):
+        return self._head(self._key(collection) + "/") is not None
+
+    def container_exists(self, collection, id):
+        return self._head(self._key(collection, id) + "/") is not None
+
+    def create_collection(self, collection):
+        self._put(self._key(collection) + "/", "")
+
+    def create_container(self, collection, id):
+        self._put(self._key(collection, id) + "/", "")
+
+    def remove_container(self, collection, id):
+        self._delete_prefix(self._key(collection, id) + "/")
+
+    # the blobs
+    ###########
+
+    def blob_exists(self, collection, id, name):
+        return self._head(self._key(collection, id, name)) is not None
+
+    def blob_size(self, collection, id, name):
+        return self._head(self._key(collection, id, name))
+
+    def put_blob(self, collection, id, name, content):
+        self._put(self._key(collection, id, name), content)
+
+    def open_blob(self, collection, id, name, seekable=False):
+        response = self._request("GET", self._key(collection, id, name))
+        if response.status == 404:
+            response.close()
+            raise StorageError("no such blob: " + self._key(collection, id, name))
+        handle = _ResponseHandle(response)
+        if not seekable:
+            return handle
+        # there is no seeking in an HTTP response, so bring it down into a temp file
+        f = _temp_file(self.config.tmp_dir)
+        try:
+            copy_stream(handle, f, self.chunk_size)
+        finally:
+            handle.close()
+        f.seek(0)
+        return f
+
+    def open_blob_for_write(self, collection, id, name):
+        return _UploadHandle(self, self._key(collection, id, name))
+
+    def delete_blob(self, collection, id, name):
+        key = self._key(collection, id, name)
+        self._delete(key)
+        self._delete_prefix(key + "/")
+
+    def rename_blob(self, collection, id, name, new_name):
+        # S3 has no rename, but it can copy an object within the bucket without it passing through here
+        key = self._key(collection, id, name)
+        source = urllib.quote("/" + self.bucket + "/" + key, safe="/-_.~")
+        self._check(self._request("PUT", self._key(collection, id, new_name), headers={"x-amz-copy-source" : source}),
+                    "copy " + key + " to", self._key(collection, id, new_name))
+        self._delete(key)
+
+    # the S3 API
+    ############
+
+    def _key(self, *parts):
+        return self.prefix + "/".join(parts)
+
+    def _list(self, prefix):
+        """
+        List the keys directly under the prefix, returning a tuple of the names of the objects and the names of the
+        common prefixes (the "directories"), each relative to the prefix
+        """
+        names = []
+        prefixes = []
+        for key, is_prefix in self._list_keys(prefix, "/"):
+            name = key[len(prefix):].rstrip("/")
+            if name == "":
+                # the marker object for the prefix itself
+                continue
+            (prefixes if is_prefix else names).append(name)
+        return names, prefixes
+
+    def _list_keys(self, prefix, delimiter=None):
+        """ Generator over (key, is_prefix) for everything under the prefix, following ListObjectsV2 continuations """
+        token = None
+        while True:
+            query = {"list-type" : "2", "prefix" : prefix}
+            if delimiter is not None:
+                query["delimiter"] = delimiter
+            if token is not None:
+                query["continuation-token"] = token
+            response = self._request("GET", None, query)
+            body = response.read()
+            if response.status != 200:
+                raise StorageError("could not list " + prefix + " in bucket " + self.bucket + ": " + str(response.status))
+            result = etree.fromstring(body)
+            for contents in result.findall(self.S3_NS + "Contents"):
+                yield contents.findtext(self.S3_NS + "Key"), False
+            for common in result.findall(self.S3_NS + "CommonPrefixes"):
+                yield common.findtext(self.S3_NS + "Prefix"), True
+            if result.findtext(self.S3_NS + "IsTruncated") != "true":
+                return
+            token = result.findtext(self.S3_NS + "NextContinuationToken")
+
+    def _head(self, key):
+        """ the size of the object, or None if it does not exist """
+        response = self._request("HEAD", key)
+        response.read()
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise StorageError("could not HEAD " + key + ": " + str(response.status))
+        return int(response.getheader("content-length", 0))
+
+    def _put(self, key, content):
+        if not hasattr(content, "read"):
+            self._check(self._request("PUT", key, body=content, size=len(content)), "PUT", key)
+            return
+        size = _remaining_size(content)
+        if size is not None:
+            self._check(self._request("PUT", key, body=content, size=size), "PUT", key)
+            return
+        # a PUT must have a Content-Length, so a stream of unknown length is spooled to find out what it is
+        with _temp_file(self.config.tmp_dir) as f:
+            size = copy_stream(content, f, self.chunk_size)
+            f.seek(0)
+            self._check(self._request("PUT", key, body=f, size=size), "PUT", key)
+
+    def _delete(self, key):
+        response = self._request("DELETE", key)
+        response.read()
+        if response.status not in [200, 204, 404]:
+            raise StorageError("could not DELETE " + key + ": " + str(response.status))
+
+    def _delete_prefix(self, prefix):
+        for key, is_prefix in list(self._list_keys(prefix)):
+            self._delete(key)
+
+    def _check(self, response, method, key):
+        response.read()
+        if response.status not in [200, 201, 204]:
+            raise StorageError("could not " + method + " " + key + ": " + str(response.status))
+
+    def _request(self, method, key, query=None, body=None, size=None, headers=None):
+        """
+        Make a request on the bucket (or on the object with the key, if there is one), streaming the body from a
+        file-like object if one is supplied, and return the httplib response, which the caller must read
+        """
+        path = "/" + self.bucket + ("/" + key if key is not None else "")
+        query = query or {}
+        headers = dict(headers or {})
+        headers["host"] = self.host
+        if size is not None:
+            headers["content-length"] = str(size)
+        if self.access_key is not None:
+            self._sign(method, path, query, headers)
+
+        url = urllib.quote(path, safe="/-_.~")
+        if len(query) > 0:
+            url += "?" + self._canonical_query(query)
+        conn = httplib.HTTPSConnection(self.host) if self.secure else httplib.HTTPConnection(self.host)
+        conn.putrequest(method, url, skip_host=True, skip_accept_encoding=True)
+        for k, v in headers.items():
+            conn.putheader(k, v)
+        # one connection per request, so that it goes away when the response has been read
+        conn.putheader("connection", "close")
+        conn.endheaders()
+        if hasattr(body, "read"):
+            copy_stream(body, _SocketWriter(conn), self.chunk_size, size)
+        elif body is not None:
+            conn.send(body)
+        response = conn.getresponse()
+        ssslog.debug("S3 " + method + " " + url + " - " + str(response.status))
+        return response
+
+    def _canonical_query(self, query):
+        return "&".join([urllib.quote(k, safe="-_.~") + "=" + urllib.quote(v, safe="-_.~") for k, v in sorted(query.items())])
+
+    def _sign(self, method, path, query, headers, payload_hash=UNSIGNED_PAYLOAD, now=None):
+        """ Add the AWS Signature Version 4 headers to the (lower case) headers dictionary """
+        now = now if now is not None else datetime.utcnow()
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        headers["x-amz-date"] = amz_date
+        headers["x-amz-content-sha256"] = payload_hash
+
+        signed_headers = ";".join(sorted(headers.keys()))
+        canonical_headers = "".join([k + ":" + str(headers[k]).strip() + "\n" for k in sorted(headers.keys())])
+        canonical_request = "\n".join([method, urllib.quote(path, safe="/-_.~"), self._canonical_query(query),
+                                        canonical_headers, signed_headers, payload_hash])
+
+        scope = date + "/" + self.region + "/s3/aws4_request"
+        string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request).hexdigest()])
+
+        key = ("AWS4" + self.secret_key).encode("utf-8")
+        for part in [date, self.region, "s3", "aws4_request"]:
+            key = hmac.new(key, part, hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign, hashlib.sha256).hexdigest()
+
+        headers["authorization"] = ("AWS4-HMAC-SHA256 Credential=" + self.access_key + "/" + scope +
+                                    ", SignedHeaders=" + signed_headers + ", Signature=" + signature)
+
+class BlobStore(object):
+    """
+    A pool of content-addressed blobs, keyed by the SHA-256 of their content, and kept in the internal .blobs
+    collection of the storage backend.  Content which is already in the pool is never written again.  Instead, each
+    container file which holds it becomes a reference to the pooled blob:
+
+    - a hard link, where the backend supports them, so that the file can be read like any other and the link count is
+      the reference count
+    - otherwise a pointer, which the caller keeps (the DAO keeps one in the container's manifest), with the reference
+      count in a .refs counter next to the blob
+
+    Blobs are removed when their last reference is released.  Each blob is added, referenced and released under a
+    lock of its own (see locks.py), so that no reference is lost, and no blob which is still referenced is removed,
+    however many SSS processes share the store (as long as they share the lock_dir)
+    """
+    COLLECTION = ".blobs"
+
+    def __init__(self, backend, config):
+        self.backend = backend
+        self.config = config
+        self.locks = ContainerLocks(config)
+
+    def location(self, sha256):
+        """ the (collection, id, name) of the pooled blob in the backend """
+        return self.COLLECTION, sha256[:2], sha256
+
+    def exists(self, sha256):
+        return self.backend.blob_exists(*self.location(sha256))
+
+    def store(self, collection, id, name, content, sha256=None, path=None):
+        """
+        Put the content into the pool, unless it is already there, and add a reference to it from the named file in
+        the container (which will be a hard link where the backend supports them).  The content may be a string or a
+        file-like object.  If its SHA-256 is not supplied it is spooled into the tmp_dir to find it.  If path is
+        supplied, it is a local file which holds the content, and which will be moved into the pool or removed.
+        Returns the SHA-256 of the content
+        """
+        if sha256 is None:
+            if path is None:
+                if not hasattr(content, "read"):
+                    content = StringIO(content)
+                path, writer = spool_to_tmp(content, self.config.tmp_dir, chunk_size=self.config.copy_chunk_size,
+                                            max_chunk_size=self.config.max_copy_chunk_size)
+            else:
+                with open(path, "rb") as f:
+                    writer = digest_stream(f, self.config.copy_chunk_size)
+            sha256 = writer.sha256
+
+        try:
+            # under the blob's lock, so that it cannot be released by someone else between our finding it in the
+            # pool and referencing it
+            with self._lock(sha256):
+                self._add(sha256, content, path)
+                self._reference(sha256, collection, id, name)
+            return sha256
+        finally:
+            remove_quietly(path)
+
+    def _lock(self, sha256):
+        return self.locks.lock(self.COLLECTION, sha256)
+
+    def _add(self, sha256, content, path):
+        """ add the content to the pool, if it is not already there, returning whether it was added """
+        if self.exists(sha256):
+            ssslog.debug("Blob " + sha256 + " is already in the store")
+            return False
+        if path is not None:
+            self.backend.move_blob_in(*(self.location(sha256) + (path,)))
+        else:
+            self.backend.put_blob(*(self.location(sha256) + (content,)))
+        ssslog.debug("Added blob " + sha256 + " to the store")
+        return True
+
+    def reference(self, sha256, collection, id, name):
+        """ add a reference to the pooled blob from the named file in the container """
+        with self._lock(sha256):
+            self._reference(sha256, collection, id, name)
+
+    def _reference(self, sha256, collection, id, name):
+        if self.backend.supports_links:
+            self.backend.link_blob(*(self.location(sha256) + (collection, id, name)))
+        else:
+            self._adjust_refs(sha256, 1)
+
+    def release(self, sha256):
+        """
+        Release a reference to the pooled blob (a hard link should already have been deleted), and remove the blob
+        if that was the last one
+        """
+        with self._lock(sha256):
+            if self.refcount(sha256) <= (0 if self.backend.supports_links else 1):
+                ssslog.debug("Removing blob " + sha256 + " from the store, as it is no longer referenced")
+                collection, id, name = self.location(sha256)
+                if self.backend.blob_exists(collection, id, name):
+                    self.backend.delete_blob(collection, id, name)
+                if self.backend.blob_exists(collection, id, name + ".refs"):
+                    self.backend.delete_blob(collection, id, name + ".refs")
+            elif not self.backend.supports_links:
+                self._adjust_refs(sha256, -1)
+
+    def refcount(self, sha256):
+        """ the number of references to the pooled blob """
+        collection, id, name = self.location(sha256)
+        if self.backend.supports_links:
+            if not self.backend.blob_exists(collection, id, name):
+                return 0
+            return self.backend.link_count(collection, id, name) - 1
+        if not self.backend.blob_exists(collection, id, name + ".refs"):
+            return 0
+        return int(self.backend.get_blob(collection, id, name + ".refs"))
+
+    def _adjust_refs(self, sha256, delta):
+        """ change the .refs counter of the blob, which must be done under the blob's lock """
+        collection, id, name = self.location(sha256)
+        refs = self.refcount(sha256) + delta
+        self.backend.put_blob(collection, id, name + ".refs", str(refs))
+
+def _free_space(root):
+    """ the space available on the disk which holds the root """
+    _makedirs(root)
+    st = os.statvfs(root)
+    return st.f_bavail * st.f_frsize
+
+def _catch_up(source, target):
+    """
+    make the target directory the same as the source: copy anything in the source which is not the same in the
+    target, and remove anything from the target which is no longer in the source
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        tdir = os.path.join(target, os.path.relpath(dirpath, source))
+        _makedirs(tdir)
+        for fn in filenames:
+            s, t = os.path.join(dirpath, fn), os.path.join(tdir, fn)
+            ss = os.stat(s)
+            if not os.path.exists(t) or os.path.getsize(t) != ss.st_size or os.path.getmtime(t) != ss.st_mtime:
+                shutil.copy2(s, t)
+    for dirpath, dirnames, filenames in os.walk(target):
+        sdir = os.path.join(source, os.path.relpath(dirpath, target))
+        for dn in list(dirnames):
+            if not os.path.isdir(os.path.join(sdir, dn)):
+                shutil.rmtree(os.path.join(dirpath, dn))
+                dirnames.remove(dn)
+        for fn in filenames:
+            if not os.path.lexists(os.path.join(sdir, fn)):
+                os.remove(os.path.join(dirpath, fn))
+
+def _makedirs(path):
+    """ make the directory and any parents, unless another thread or process got there first """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _listdir_quietly(path):
+    """ list the directory, which may have been removed by the time we get to it """
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+
+def _temp_file(tmp_dir):
+    if tmp_dir is not None and not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    return tempfile.TemporaryFile(dir=tmp_dir)
+
+def _remaining_size(f):
+    """ The number of bytes left to read from the file-like object, if that can be known without reading it """
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    if hasattr(f, "seek") and hasattr(f, "tell"):
+        try:
+            here = f.tell()
+            f.seek(0, 2)
+            size = f.tell() - here
+            f.seek(here)
+            return size
+        except (IOError, OSError, ValueError):
+            pass
+    return None
+
+class _SocketWriter(object):
+    """ File-like object which sends whatever is written to it down an httplib connection """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        self.conn.send(data)
+
+class _ResponseHandle(object):
+    """ The read-only stream handle on an object being downloaded from S3 """
+    def __init__(self, response):
+        self.response = response
+        self.size = int(response.getheader("content-length", 0))
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return self.response.read()
+        return self.response.read(n)
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # there is nothing to throw away, whether or not the block raised
+        self.close()
+
+class _AtomicFile(object):
+    """
+    The writable handle on a file in the FilesystemBackend.  The content is written into a temp file next to it, which
+    is synced according to the durability mode (see spool.sync_file) and renamed into place when the handle is closed
+    """
+    def __init__(self, path, durability=None):
+        self.path = path
+        self.durability = durability
+        self.tmp_path = os.path.join(os.path.dirname(path), "sss_tmp." + str(uuid.uuid4()))
+        self.f = open(self.tmp_path, "wb")
+
+    def write(self, data):
+        self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence=0):
+        self.f.seek(offset, whence)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            sync_file(self.f, self.durability)
+            self.f.close()
+            os.rename(self.tmp_path, self.path)
+        except:
+            self.abort()
+            raise
+        self.f = None
+
+    def abort(self):
+        """ throw the content away, leaving any existing file as it was """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        remove_quietly(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+class _UploadHandle(object):
+    """
+    The writable handle on an object being uploaded to S3.  The content is written into a temp file (which zipfile,
+    for example, can seek around in) and uploaded when the handle is closed
+    """
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+        self.f = _temp_file(backend.config.tmp_dir)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence=0):
+        self.f.seek(offset, whence)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            self.f.seek(0)
+            self.backend._put(self.key, self.f)
+        finally:
+            self.f.close()
+            self.f = None
+
+    def abort(self):
+        """ throw the content away without uploading it """
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
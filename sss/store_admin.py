@@ -0,0 +1,88 @@
+"""
+Administration of the store, from the command line.  Run from the directory with the sss.conf.json, or supply the
+path to it:
+
+    python store_admin.py migrate [config file]
+    python store_admin.py rebalance [config file]
+    python store_admin.py recover [config file]
+
+migrate moves every container in a filesystem store which is still in the flat layout into its shard, once the
+store_layout has been set to "sharded".  SSS keeps finding the containers which have not been moved yet, so this
+can be run while it is serving requests, and run again if it is interrupted.
+
+rebalance moves containers between the store_dirs of a filesystem store: to the directory chosen by the hash of
+each container's id if the store_placement is "hash", and otherwise so that each directory holds an even share of
+every collection.  It can also be run while SSS is serving requests: each container is locked while it is moved, so
+requests which change it wait until it is in its new place.
+
+recover completes or rolls back the transactions on containers which were left open by SSS processes which have
+stopped.  SSS does this itself when it starts, but it may be useful to do it again if one of several processes dies.
+Each container is locked while its transaction is recovered, so this is safe to run while SSS is serving requests
+"""
+import sys
+
+from config import Configuration
+from storage import FilesystemBackend
+from journal import Journal
+from locks import ContainerLocks
+
+from sss_logging import logging
+ssslog = logging.getLogger(__name__)
+
+def migrate(config):
+    """
+    Migrate the store to the configured layout, a collection at a time.
+    Args:
+    -config:    the Configuration of the store
+    Returns the number of containers moved
+    """
+    backend = _filesystem_backend(config)
+    moved = 0
+    for collection in backend.list_collections():
+        n = backend.migrate_layout(collection)
+        ssslog.info("Moved " + str(n) + " containers in collection " + collection + " into their shards")
+        moved += n
+    return moved
+
+def rebalance(config):
+    """
+    Move containers between the store_dirs of the store, a collection at a time.
+    Args:
+    -config:    the Configuration of the store
+    Returns the number of containers moved
+    """
+    backend = _filesystem_backend(config)
+    moved = 0
+    for collection in backend.list_collections():
+        n = backend.rebalance(collection)
+        ssslog.info("Moved " + str(n) + " containers in collection " + collection + " between store directories")
+        moved += n
+    return moved
+
+def recover(config):
+    """
+    Recover the transactions left open by processes which have stopped.
+    Args:
+    -config:    the Configuration of the store
+    Returns the number of transactions recovered
+    """
+    return Journal(config.get_storage_backend_implementation()(config), ContainerLocks(config)).recover()
+
+def _filesystem_backend(config):
+    backend = config.get_storage_backend_implementation()(config)
+    if not isinstance(backend, FilesystemBackend):
+        raise ValueError("only the filesystem backend keeps its containers in directories")
+    return backend
+
+COMMANDS = {
+    "migrate" : migrate,
+    "rebalance" : rebalance,
+    "recover" : recover
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3] or sys.argv[1] not in COMMANDS:
+        print "Usage: python store_admin.py [" + "|".join(sorted(COMMANDS.keys())) + "] [config file]"
+        exit()
+    config = Configuration(config_file=sys.argv[2] if len(sys.argv) > 2 else None)
+    print sys.argv[1] + ": " + str(COMMANDS[sys.argv[1]](config))
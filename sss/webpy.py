@@ -3,6 +3,9 @@ from web.wsgiserver import CherryPyWSGIServer
 from core import Auth, SwordError, AuthException, DepositRequest, DeleteRequest
 from negotiator import ContentNegotiator, AcceptParameters, ContentType
 from spec import Errors, HttpHeaders, ValidationException
+from spool import spool_body, parse_content_encoding, DecodingReader, MaxSizeExceeded, UnsupportedContentEncoding, ContentEncodingError
+from multipart import parse_multipart, get_entry_and_media_parts
+from responses import FILE_RESPONSE, file_size, file_wrapper, read_chunks, file_responses
 
 from sss_logging import logging
 ssslog = logging.getLogger(__name__)
@@ -63,9 +66,10 @@ STATUS_MAP = {
     404 : "404 Not Found",
     405 : "405 Method Not Allowed",
     406 : "406 Not Acceptable",
-    412 : "412 Precodition Failed",
-    413 : "412 Request Entity Too Large",
-    415 : "415 Unsupported Media Type"
+    412 : "412 Precondition Failed",
+    413 : "413 Request Entity Too Large",
+    415 : "415 Unsupported Media Type",
+    503 : "503 Service Unavailable"
 }
 
 # SWORD HTTP HANDLERS
@@ -80,30 +84,94 @@ class SwordHttpHandler(object):
         web.header('Access-Control-Allow-Method', '*')
         return
     
-    def read_to_tmp(self, web):
+    def read_body(self, web):
         # the incoming body content is in wsgi.input, which is a file-like object
         # but which only supports "read", not useful extras like "seek", so we
-        # stream this into a temp file, and return a handle to that instead
-        size = web.utils.intget(web.ctx.env.get('CONTENT_LENGTH'), 0) 
-        wsgi_input = web.ctx.env['wsgi.input']
-        if not os.path.exists(config.tmp_dir):
-            os.mkdir(config.tmp_dir)
-        fn = os.path.join(config.tmp_dir, str(uuid.uuid4()))
-        ssslog.info("Reading incoming content of size " + str(size) + "to temp file " + fn)
-        if wsgi_input is not None:
-            with open(fn, "wb") as outfile:
-                while size > 0:
-                    chunk_size = config.copy_chunk_size if size > config.copy_chunk_size else size 
-                    chunk = wsgi_input.rfile.read(chunk_size)
-                    if chunk is None or chunk == "":
-                        break
-                    outfile.write(chunk)
-                    outfile.flush()
-                    os.fsync(outfile.fileno())
-                    size -= chunk_size
-            with open(fn, "r") as tmpfile:
-                return tmpfile
-        return None
+        # read it into a SpooledBody (in memory if it is small, in a temp file
+        # if not), which digests the content on its way in and can be re-read
+        wsgi_input, size = self._request_stream(web)
+        if wsgi_input is None:
+            return None
+        try:
+            body = spool_body(wsgi_input, config.tmp_dir, size, config.copy_chunk_size,
+                                config.max_copy_chunk_size, config.spool_memory_threshold, config.spool_durability,
+                                config.max_upload_size)
+        except MaxSizeExceeded as e:
+            raise self._max_upload_size_error()
+        except ContentEncodingError as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=str(e))
+        
+        # remember the body, so that it can be cleaned up when the request has
+        # been dealt with (see cleanup_tmp)
+        web.ctx.sss_spooled_bodies = web.ctx.get("sss_spooled_bodies", []) + [body]
+        
+        # the checksum was computed while the content was being spooled, so we
+        # can check it now without reading the content again.  The Content-MD5
+        # of an encoded body is of the bytes as they were sent, not as decoded
+        md5 = wsgi_input.md5 if isinstance(wsgi_input, DecodingReader) else body.md5
+        self._check_md5(web.ctx.env.get("HTTP_CONTENT_MD5"), body, md5)
+        return body
+
+    def read_multipart(self, web):
+        # the multipart body is parsed as it is read from wsgi.input, with the
+        # atom entry kept in memory and the media part read into a SpooledBody,
+        # and we return the entry part and the media part
+        wsgi_input, size = self._request_stream(web)
+        try:
+            parts = parse_multipart(wsgi_input, web.ctx.env.get('CONTENT_TYPE'), config.tmp_dir,
+                                    size, config.copy_chunk_size, config.spool_memory_threshold,
+                                    config.spool_durability, config.max_upload_size)
+            
+            # remember the bodies, so that they can be cleaned up when the request
+            # has been dealt with (see cleanup_tmp)
+            web.ctx.sss_spooled_bodies = web.ctx.get("sss_spooled_bodies", []) + [p.body for p in parts if p.body is not None]
+            
+            entry_part, media_part = get_entry_and_media_parts(parts)
+        except ValidationException as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=e.message)
+        except MaxSizeExceeded as e:
+            raise self._max_upload_size_error()
+        except ContentEncodingError as e:
+            raise SwordError(error_uri=Errors.bad_request, msg=str(e))
+        
+        # the Content-MD5 of the media part is in its own headers
+        self._check_md5(media_part.get_header(HttpHeaders.content_md5), media_part.body)
+        return entry_part, media_part
+
+    def _is_chunked(self, web):
+        return "chunked" in web.ctx.env.get("HTTP_TRANSFER_ENCODING", "").lower()
+
+    def _body_size(self, web):
+        # the length of a chunked body (which the server decodes for us) is not
+        # known until it has all been read, so there is no size to read up to
+        if self._is_chunked(web):
+            return None
+        return web.utils.intget(web.ctx.env.get('CONTENT_LENGTH'), 0)
+
+    def _request_stream(self, web):
+        # the stream to read the body from, and the number of bytes to read from
+        # it (None to read to the end).  A gzip or deflate encoded body is decoded
+        # as it is read, and the max upload size applies to both the encoded bytes
+        # (checked by the DecodingReader) and the decoded ones (checked by whoever
+        # reads from it), so a small body cannot decompress to something huge
+        wsgi_input = web.ctx.env.get('wsgi.input')
+        size = self._body_size(web)
+        encoding = parse_content_encoding(web.ctx.env.get("HTTP_CONTENT_ENCODING"))
+        if wsgi_input is None or encoding is None:
+            return wsgi_input, size
+        return DecodingReader(wsgi_input, encoding, size, config.copy_chunk_size, config.max_upload_size), None
+
+    def _max_upload_size_error(self):
+        return SwordError(error_uri=Errors.max_upload_size_exceeded, 
+                            msg="Max upload size is " + str(config.max_upload_size) + 
+                            "; incoming content exceeded it")
+
+    def _check_md5(self, content_md5, body, md5=None):
+        md5 = md5 if md5 is not None else body.md5
+        if content_md5 is not None and content_md5.strip() != md5:
+            ssslog.info("Content-MD5 " + content_md5 + " does not match spooled content " + md5 + "; discarding")
+            body.discard()
+            raise SwordError(error_uri=Errors.checksum_mismatch, msg="Content-MD5 header does not match file checksum")
 
     def http_basic_authenticate(self, web):
         # extract the appropriate HTTP headers
@@ -143,15 +211,66 @@ class SwordHttpHandler(object):
         
         return auth
     
+    def check_deposit_preconditions(self, web, auth):
+        """
+        Check everything about a deposit request that can be determined from its headers alone.  This must be done
+        before any of the body is read from wsgi.input, so that a client which sent Expect: 100-continue can get its
+        final status without ever sending the body.  That only holds on servers which send 100 Continue lazily, when
+        the application first reads the body (such as mod_wsgi); others (such as the CherryPy wsgiserver bundled with
+        web.py) send it as soon as they have the headers, so the client sends the body anyway
+        """
+        # have we been asked to do a mediated deposit, when this is not allowed?
+        if auth is not None and auth.on_behalf_of is not None and not config.mediation:
+            raise SwordError(error_uri=Errors.mediation_not_allowed)
+        
+        # can we decode the content?
+        try:
+            parse_content_encoding(web.ctx.env.get("HTTP_CONTENT_ENCODING"))
+        except UnsupportedContentEncoding as e:
+            raise SwordError(error_uri=Errors.content, status=415, msg=str(e))
+        
+        # is the content going to be too large?
+        content_length = web.utils.intget(web.ctx.env.get('CONTENT_LENGTH'), 0)
+        if config.max_upload_size is not None and content_length > config.max_upload_size:
+            raise SwordError(error_uri=Errors.max_upload_size_exceeded, 
+                            msg="Max upload size is " + str(config.max_upload_size) + 
+                            "; incoming content length was " + str(content_length))
+    
     def manage_error(self, sword_error):
-        status = STATUS_MAP.get(sword_error.status, "400 Bad Request")
+        status = STATUS_MAP.get(sword_error.status, str(sword_error.status))
         ssslog.info("Returning error (" + str(sword_error.status) + ") - " + str(sword_error.error_uri))
-        web.ctx.status = str(sword_error.status)
+        web.ctx.status = status
+        if sword_error.status == 503:
+            # the container is locked by another request, which will not be long
+            web.header("Retry-After", "1")
         if not sword_error.empty:
             web.header("Content-Type", "text/xml")
             return sword_error.error_document
         return ""
     
+    def set_etag(self, version):
+        """ Give the version of the container in the response, for the client to send back in If-Match """
+        if version is not None:
+            web.header("ETag", '"' + version + '"')
+
+    def stream_out(self, stream):
+        """
+        The content of the stream as the body of the response, which is sent a chunk at a time as it is read, so that
+        the client gets the start of it straight away (web.py sends each chunk the generator yields), and the whole
+        of it is never held in memory.  The stream is closed once it has been sent, or the client has gone away.  A
+        file on the disk is sent with its Content-Length, and handed to the server's wsgi.file_wrapper if it has one
+        (see responses.py), so that it can be sent with sendfile
+        """
+        size = file_size(stream)
+        if size is not None:
+            web.header("Content-Length", str(size))
+        wrapped = file_wrapper(web.ctx.environ, stream, config.copy_chunk_size)
+        if wrapped is None:
+            return read_chunks(stream, config.copy_chunk_size)
+        # web.py would wrap the file_wrapper in an iterator of its own, so it is passed to the server around web.py
+        web.ctx.environ[FILE_RESPONSE] = wrapped
+        return ""
+    
     def _map_webpy_headers(self, headers):
         return dict([(c[0][5:].replace("_", "-") if c[0].startswith("HTTP_") else c[0].replace("_", "-"), c[1]) for c in headers.items()])
     
@@ -177,31 +296,29 @@ class SwordHttpHandler(object):
   
         # run the validation
         try:
-            # there must be both an "atom" and "payload" input or data in web.data()
-            webin = web.input()
-            if len(webin) != 2 and len(webin) > 0:
-                raise ValidationException("Multipart request does not contain exactly 2 parts")
-            if len(webin) >= 2 and not webin.has_key("atom") and not webin.has_key("payload"):
-                raise ValidationException("Multipart request must contain Content-Dispositions with names 'atom' and 'payload'")
-            if len(webin) > 0 and not allow_multipart:
-                raise ValidationException("Multipart request not permitted in this context")
-
-            # if we get to here then we have a valid multipart or no multipart
+            # NOTE: we must not touch the request body here (e.g. with web.input() or
+            # web.data()), as that would read the whole body into memory before
+            # get_deposit has a chance to stream it to disk.  So we look only at
+            # the headers.
             is_multipart = False
             is_empty = False
-            if len(webin) != 2: # if it is not multipart
-                if web.data() is None or web.data().strip() == "": # FIXME: this does not look safe to scale
-                    if allow_empty:
-                        ssslog.info("Validating an empty deposit (could be a control operation)")
-                        is_empty = True
-                    else:
-                        raise ValidationException("No content sent to the server")
-            else:
+            content_type = mapped_headers.get("CONTENT-TYPE")
+            if content_type is not None and content_type.startswith("multipart/"):
+                if not allow_multipart:
+                    raise ValidationException("Multipart request not permitted in this context")
+                
+                # the parts themselves are checked as the body is parsed (see
+                # read_multipart)
                 ssslog.info("Validating a multipart deposit")
                 is_multipart = True
+            elif self._body_size(web) == 0:
+                if allow_empty:
+                    ssslog.info("Validating an empty deposit (could be a control operation)")
+                    is_empty = True
+                else:
+                    raise ValidationException("No content sent to the server")
             
             is_entry = False
-            content_type = mapped_headers.get("CONTENT-TYPE")
             if content_type is not None and content_type.startswith("application/atom+xml"):
                 ssslog.info("Validating an atom-only deposit")
                 is_entry = True
@@ -329,8 +446,6 @@ class SwordHttpHandler(object):
         '''
     
     def get_deposit(self, web, auth=None, atom_only=False):
-        # FIXME: this reads files into memory, and therefore does not scale
-        # FIXME: this does not deal with the Media Part headers on a multipart deposit
         """
         Take a web.py web object and extract from it the parameters and content required for a SWORD deposit.  This
         includes determining whether this is an Atom Multipart request or not, and extracting the atom/payload where
@@ -350,39 +465,44 @@ class SwordHttpHandler(object):
         if d.content_type.startswith("application/atom+xml"):
             atom_only=True
         
+        # NOTE: the content length has already been checked against the max upload
+        # size by check_deposit_preconditions (and a chunked body, which has no
+        # content length, is checked as it is read)
         empty_request = False
-        if d.content_length == 0:
+        if self._body_size(web) == 0:
             ssslog.info("Received empty deposit request")
             empty_request = True
-        if d.content_length > config.max_upload_size:
-            raise SwordError(error_uri=Errors.max_upload_size_exceeded, 
-                            msg="Max upload size is " + str(config.max_upload_size) + 
-                            "; incoming content length was " + str(d.content_length))
         
         # find out if this is a multipart or not
         is_multipart = False
         
-        # FIXME: these headers aren't populated yet, because the webpy api doesn't
-        # appear to have a mechanism to retrieve them.  urgh.
         entry_part_headers = {}
         media_part_headers = {}
-        webin = web.input()
-        if len(webin) == 2:
+        if d.content_type.startswith("multipart/"):
             ssslog.info("Received multipart deposit request")
-            d.atom = webin['atom']
-            # FIXME: this reads the payload into memory, we need to sort that out
-            # read the zip file from the base64 encoded string
-            d.content = base64.decodestring(webin['payload'])
+            entry_part, media_part = self.read_multipart(web)
+            d.atom = entry_part.content
+            d.body = media_part.body
+            entry_part_headers = entry_part.headers
+            media_part_headers = media_part.headers
+            
+            # in a multipart deposit the Packaging and Content-MD5 belong to the
+            # media part, so they are taken from its headers
+            d.set_from_headers(self._media_part_sword_headers(media_part_headers))
             is_multipart = True
         elif not empty_request:
-            # if this wasn't a multipart, and isn't an empty request, then the data is in web.data().  This could be a binary deposit or
-            # an atom entry deposit - reply on the passed/determined argument to determine which
+            # if this wasn't a multipart, and isn't an empty request, then the data is in wsgi.input, which we stream
+            # to a spooled body.  This could be a binary deposit or an atom entry deposit - rely on the passed/determined 
+            # argument to determine which
+            body = self.read_body(web)
             if atom_only:
+                # we don't worry about scalability here - the entries should be
+                # generally small, and will usually not have left memory
                 ssslog.info("Received Entry deposit request")
-                d.atom = web.data()
+                d.atom = body.getvalue()
             else:
                 ssslog.info("Received Binary deposit request")
-                d.content = web.data()
+                d.body = body
         
         if is_multipart:
             d.filename = h.extract_filename(media_part_headers)
@@ -393,6 +513,10 @@ class SwordHttpHandler(object):
         d.auth = auth
         return d
     
+    def _media_part_sword_headers(self, media_part_headers):
+        normalised_dict = dict([(h.lower(), v) for h, v in media_part_headers.items()])
+        return dict([(h, normalised_dict[h]) for h in [HttpHeaders.packaging, HttpHeaders.content_md5] if h in normalised_dict])
+    
     ''' FIXME: this was an experimental version which was supposed to scale
     def get_deposit(self, web, file_handle, auth=None, atom_only=False):
         # FIXME: this reads files into memory, and therefore does not scale
@@ -546,6 +670,9 @@ class Collection(SwordHttpHandler):
             # authenticate
             auth = self.http_basic_authenticate(web)
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(web, auth)
+            
             # FIXME: this was supposed to help us with our scalability, but
             # unfortunately the way that web.py works, it is not possible to
             # read the incoming file to disk and still use the other functions
@@ -569,6 +696,7 @@ class Collection(SwordHttpHandler):
             ssslog.info("Item created")
             web.header("Content-Type", "application/atom+xml;type=entry")
             web.header("Location", result.location)
+            self.set_etag(result.etag)
             web.ctx.status = "201 Created"
             if config.return_deposit_receipt:
                 ssslog.info("Returning deposit receipt")
@@ -629,11 +757,11 @@ class MediaResourceContent(SwordHttpHandler):
             return web.found(media_resource.url)
         else:
             web.header("Content-Type", media_resource.content_type)
+            self.set_etag(media_resource.etag)
             if media_resource.packaging is not None:
                 web.header("Packaging", media_resource.packaging)
-            f = open(media_resource.filepath, "r")
             web.ctx.status = "200 OK"
-            return f.read()
+            return self.stream_out(media_resource.stream)
 
 class MediaResource(MediaResourceContent):
     """
@@ -660,6 +788,9 @@ class MediaResource(MediaResourceContent):
         try:
             auth = self.http_basic_authenticate(web)
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(web, auth)
+            
             # check the validity of the request (note that multipart requests 
             # and atom-only are not permitted in this method)
             self.validate_deposit_request(web, None, "6.5.1", None, allow_multipart=False)
@@ -678,6 +809,7 @@ class MediaResource(MediaResourceContent):
             
             # replaced
             ssslog.info("Content replaced")
+            self.set_etag(result.etag)
             web.ctx.status = "204 No Content" # notice that this is different from the POST as per AtomPub
             return
             
@@ -712,6 +844,7 @@ class MediaResource(MediaResourceContent):
             # carry out the delete
             ss = SwordServer(config, auth)
             result = ss.delete_content(path, delete)
+            self.set_etag(result.etag)
             
             # just return, no need to give any more feedback
             web.ctx.status = "204 No Content" # No Content
@@ -738,6 +871,9 @@ class MediaResource(MediaResourceContent):
         try:
             auth = self.http_basic_authenticate(web)
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(web, auth)
+            
             # check the validity of the request
             self.validate_deposit_request(web, None, "6.7.1", None, allow_multipart=False)
             
@@ -749,6 +885,7 @@ class MediaResource(MediaResourceContent):
             
             web.header("Content-Type", "application/atom+xml;type=entry")
             web.header("Location", result.location)
+            self.set_etag(result.etag)
             web.ctx.status = "201 Created"
             if config.return_deposit_receipt:
                 return result.receipt
@@ -800,8 +937,11 @@ class Container(SwordHttpHandler):
             if accept_parameters is None:
                 raise SwordError(error_uri=Error.content, status=415, empty=True)
             
-            # now actually get hold of the representation of the container and send it to the client
+            # now actually get hold of the representation of the container and send it to the client, with the
+            # version read first, so that if the container changes in between it is the version which is stale
+            version = ss.get_version(path)
             cont = ss.get_container(path, accept_parameters)
+            self.set_etag(version)
             if cont is not None:
                 web.header("Content-Type", accept_parameters.content_type.mimetype())
             return cont
@@ -825,6 +965,9 @@ class Container(SwordHttpHandler):
             # authenticate
             auth = self.http_basic_authenticate(web)
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(web, auth)
+            
             # check the validity of the request
             self.validate_deposit_request(web, "6.5.2", None, "6.5.3")
             
@@ -835,6 +978,7 @@ class Container(SwordHttpHandler):
             result = ss.replace(path, deposit)
             
             web.header("Location", result.location)
+            self.set_etag(result.etag)
             if config.return_deposit_receipt:
                 web.header("Content-Type", "application/atom+xml;type=entry")
                 web.ctx.status = "200 OK"
@@ -868,6 +1012,9 @@ class Container(SwordHttpHandler):
              # authenticate
             auth = self.http_basic_authenticate(web)
             
+            # check everything we can from the headers alone, before any of the body is read
+            self.check_deposit_preconditions(web, auth)
+            
             # check the validity of the request
             self.validate_deposit_request(web, "6.7.2", None, "6.7.3", "9.3", allow_empty=True)
             
@@ -882,6 +1029,7 @@ class Container(SwordHttpHandler):
             # asap)
             
             web.header("Location", result.location)
+            self.set_etag(result.etag)
             web.ctx.status = "200 OK"
             if config.return_deposit_receipt:
                 web.header("Content-Type", "application/atom+xml;type=entry")
@@ -991,7 +1139,7 @@ class Part(SwordHttpHandler):
 
         web.header("Content-Type", "application/octet-stream") # we're not keeping track of content types
         web.ctx.status = "200 OK"
-        return fh.read()
+        return self.stream_out(fh)
         
     def PUT(self, path):
         # FIXME: the spec says that we should either support this or return
@@ -1006,10 +1154,19 @@ class Part(SwordHttpHandler):
 #######################################################################
 # This is the bit which actually invokes the web.py server when this module is run
 
+def cleanup_tmp():
+    """
+    Remove any temp files that were created to hold the request body while the request was being handled
+    """
+    for body in web.ctx.get("sss_spooled_bodies", []):
+        body.discard()
+
+app = web.application(urls, globals())
+app.add_processor(web.unloadhook(cleanup_tmp))
+
 # if we run the file as a mod_wsgi module, do this
-application = web.application(urls, globals()).wsgifunc()
+application = app.wsgifunc(file_responses)
 
 # if we run the file directly, use the bundled CherryPy server ...
 if __name__ == "__main__":
-    app = web.application(urls, globals())
-    app.run()
+    app.run(file_responses)
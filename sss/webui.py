@@ -46,8 +46,7 @@ class CollectionPage(WebPage):
         frag = "<h1>Collection: " + id + "</h1>"
         
         # list all of the containers in the collection
-        cpath = self.dao.get_store_path(id)
-        containers = os.listdir(cpath)
+        containers = self.dao.get_container_ids(id)
         frag += "<h2>Containers</h2><ul>"
         for container in containers:
             frag += "<li><a href=\"" + self.um.html_url(id, container) + "\">" + container + "</a></li>"
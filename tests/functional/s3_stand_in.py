@@ -0,0 +1,151 @@
+"""
+A local stand-in for an S3 server, for testing the S3Backend without a real bucket.
+
+It keeps objects in memory and understands just the requests that the S3Backend makes: PUT (including copies), GET,
+HEAD and DELETE on objects, and ListObjectsV2 (with prefix, delimiter and continuation tokens) on the bucket, using
+path-style addressing.  Listings are returned in small pages, so that continuations are exercised.  It does not check
+signatures, but it does insist that requests are signed if require_auth is set.
+
+It can also be run on its own, to point a development SSS at:
+
+    python tests/functional/s3_stand_in.py 9000
+"""
+import sys, threading, urlparse, urllib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+class S3StandIn(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, page_size=3, require_auth=False):
+        HTTPServer.__init__(self, ("127.0.0.1", port), _Handler)
+        self.objects = {}
+        self.page_size = page_size
+        self.require_auth = require_auth
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _target(self):
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path).lstrip("/")
+        bucket, _, key = path.partition("/")
+        return bucket, key, dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+
+    def _start(self):
+        self.server.requests.append((self.command, self.path))
+        if self.server.require_auth and not self.headers.get("authorization", "").startswith("AWS4-HMAC-SHA256 "):
+            self._send(403, "")
+            return None
+        return self._target()
+
+    def _send(self, status, body, content_length=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(content_length if content_length is not None else len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_PUT(self):
+        target = self._start()
+        if target is None:
+            return
+        bucket, key, query = target
+        body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        source = self.headers.get("x-amz-copy-source")
+        with self.server.lock:
+            if source is not None:
+                body = self.server.objects.get(urllib.unquote(source).lstrip("/").partition("/")[2])
+                if body is None:
+                    self._send(404, "")
+                    return
+            self.server.objects[key] = body
+        self._send(200, "")
+
+    def do_GET(self):
+        target = self._start()
+        if target is None:
+            return
+        bucket, key, query = target
+        if key == "":
+            self._send(200, self._list(query))
+            return
+        with self.server.lock:
+            body = self.server.objects.get(key)
+        if body is None:
+            self._send(404, "")
+        else:
+            self._send(200, body)
+
+    def do_HEAD(self):
+        target = self._start()
+        if target is None:
+            return
+        bucket, key, query = target
+        with self.server.lock:
+            body = self.server.objects.get(key)
+        if body is None:
+            self._send(404, "")
+        else:
+            self._send(200, "", len(body))
+
+    def do_DELETE(self):
+        target = self._start()
+        if target is None:
+            return
+        bucket, key, query = target
+        with self.server.lock:
+            self.server.objects.pop(key, None)
+        self._send(204, "")
+
+    def _list(self, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        with self.server.lock:
+            keys = sorted([k for k in self.server.objects.keys() if k.startswith(prefix)])
+        entries = []
+        for key in keys:
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + 1]
+                if (common, True) not in entries:
+                    entries.append((common, True))
+            else:
+                entries.append((key, False))
+
+        start = int(query.get("continuation-token", 0))
+        end = start + self.server.page_size
+        xml = '<?xml version="1.0" encoding="UTF-8"?><ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        for key, is_prefix in entries[start:end]:
+            if is_prefix:
+                xml += "<CommonPrefixes><Prefix>" + escape(key) + "</Prefix></CommonPrefixes>"
+            else:
+                xml += "<Contents><Key>" + escape(key) + "</Key><Size>" + str(len(self.server.objects.get(key, ""))) + "</Size></Contents>"
+        if end < len(entries):
+            xml += "<IsTruncated>true</IsTruncated><NextContinuationToken>" + str(end) + "</NextContinuationToken>"
+        else:
+            xml += "<IsTruncated>false</IsTruncated>"
+        return xml + "</ListBucketResult>"
+
+if __name__ == "__main__":
+    server = S3StandIn(int(sys.argv[1]) if len(sys.argv) > 1 else 9000, page_size=1000)
+    print "S3 stand-in listening on " + server.endpoint
+    server.serve_forever()
@@ -0,0 +1,253 @@
+import os, shutil, tempfile, base64, json
+from datetime import datetime
+from StringIO import StringIO
+
+from . import TestController
+
+from sss import webpy
+from sss.cache import LRUCache, SharedCache
+from sss.core import Statement
+from sss.repository import DAO
+
+class TestCache(TestController):
+    def setUp(self):
+        # the DAO stores content relative to the current directory, so give it one of its own
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.config = dict(webpy.config.cfg)
+
+    def tearDown(self):
+        webpy.config.cfg = self.config
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put("a", 1, "one")
+        cache.put("b", 1, "two")
+        assert cache.get("a", 1) == "one"
+        assert cache.get("a", 2) is None
+
+        # the least recently used entry goes to make room
+        cache.put("a", 1, "one")
+        cache.put("c", 1, "three")
+        assert cache.get("b", 1) is None
+        assert cache.get("a", 1) == "one"
+        assert cache.get("c", 1) == "three"
+        assert cache.stats() == {"size" : 2, "entries" : 2, "hits" : 3, "misses" : 2}
+
+        cache.resize(1)
+        assert cache.get("a", 1) is None
+        cache.resize(0)
+        cache.put("a", 1, "one")
+        assert cache.get("a", 1) is None
+
+    def test_02_statement_cache(self):
+        dao = webpy.SwordServer(webpy.config, None).dao
+        collection = dao.get_collection_names()[0]
+        cache = DAO.statement_cache
+        cache.clear()
+
+        # a statement stored in a transaction is cached for the version that the container has once it commits
+        with dao.transaction(collection, "item", create=True) as txn:
+            dao.store_statement(collection, "item", Statement(aggregation_uri="agg", rem_uri="rem", aggregates=["one"]))
+        s = dao.load_statement(collection, "item")
+        assert s.aggregates == ["one"]
+        assert (cache.hits, cache.misses) == (1, 0)
+
+        # and callers change their own copies
+        s.aggregates.append("two")
+        assert dao.load_statement(collection, "item").aggregates == ["one"]
+        assert cache.hits == 2
+
+        # within a transaction the cached statement is used until the transaction changes it (storing a statement
+        # reads the cached one too, to log only what has changed since)
+        with dao.transaction(collection, "item") as txn:
+            s = dao.load_statement(collection, "item")
+            assert cache.hits == 3
+            s.aggregates.append("two")
+            dao.store_statement(collection, "item", s)
+            assert cache.hits == 4
+            assert dao.load_statement(collection, "item").aggregates == ["one", "two"]
+            assert cache.hits == 5
+        assert dao.load_statement(collection, "item").aggregates == ["one", "two"]
+        assert cache.hits == 6
+
+        # nor is anything it cached used if it does not commit
+        try:
+            with dao.transaction(collection, "item") as txn:
+                dao.store_statement(collection, "item", Statement(aggregation_uri="agg", rem_uri="rem"))
+                raise ValueError()
+        except ValueError:
+            pass
+        assert dao.load_statement(collection, "item").aggregates == ["one", "two"]
+        assert (cache.hits, cache.misses) == (7, 1)
+
+        # and a change made elsewhere, which gives the container a new version, is read afresh (this checkpoint
+        # covers the event logged above, so that is not applied to it)
+        other = DAO(webpy.config)
+        with other.transaction(collection, "item"):
+            other.save(collection, "item", "sss_statement.json", '{"seq":1,' + Statement(aggregation_uri="agg", rem_uri="rem", aggregates=["three"]).serialise_json()[1:])
+        assert dao.load_statement(collection, "item").aggregates == ["three"]
+        assert (cache.hits, cache.misses) == (7, 2)
+
+    def test_03_shared_cache(self):
+        path = os.path.join(self.tmp_dir, "cache", "shared.db")
+        cache = SharedCache(path, 3)
+        cache.put("a", "v1", "one")
+        assert cache.get("a", "v1") == "one"
+        assert cache.get("a", "v2") is None
+
+        # what one process puts, another can get
+        pid = os.fork()
+        if pid == 0:
+            try:
+                other = SharedCache(path, 3)
+                ok = other.get("a", "v1") == "one" and cache.get("a", "v1") == "one"
+                other.put("b", "v1", "two" if ok else "failed")
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert cache.get("b", "v1") == "two"
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        # the entries written longest ago go first
+        cache.put("c", "v1", "three")
+        cache.put("d", "v1", "four")
+        cache.trim()
+        assert cache.get("a", "v1") is None
+        assert cache.get("d", "v1") == "four"
+        assert cache.stats()["entries"] == 3
+
+        # and a cache which cannot be used is a miss
+        with open(os.path.join(self.tmp_dir, "not a directory"), "w") as f:
+            f.write("")
+        broken = SharedCache(os.path.join(self.tmp_dir, "not a directory", "shared.db"), 3)
+        broken.put("a", "v1", "one")
+        assert broken.get("a", "v1") is None
+
+    def test_04_shared_statements(self):
+        webpy.config.cfg["shared_cache_file"] = os.path.join(self.tmp_dir, "cache", "shared.db")
+        dao = webpy.SwordServer(webpy.config, None).dao
+        collection = dao.get_collection_names()[0]
+        auth = "Basic " + base64.b64encode("sword:sword")
+        def request(method, path):
+            env = {"REQUEST_METHOD" : method, "PATH_INFO" : path, "QUERY_STRING" : "", "HTTP_HOST" : "localhost:8080",
+                    "wsgi.input" : StringIO(""), "wsgi.url_scheme" : "http", "HTTP_AUTHORIZATION" : auth}
+            return "".join(webpy.application(env, lambda status, headers: None))
+
+        # the receipt written by a deposit is cached for its version, for every process to read
+        with dao.transaction(collection, "item", create=True) as txn:
+            dao.store_statement(collection, "item", Statement(aggregation_uri="agg", rem_uri="rem", aggregates=["one"]))
+            dao.store_deposit_receipt(collection, "item", "<receipt/>")
+        shared = SharedCache(webpy.config.shared_cache_file, 10)
+        assert shared.get(collection + "/item/sss_deposit-receipt.xml", txn.version) == "<receipt/>"
+        hits = DAO.shared_cache.hits
+        assert request("GET", "/edit-uri/" + collection + "/item") == "<receipt/>"
+        assert DAO.shared_cache.hits == hits + 1
+
+        # as are the serialisations of the statement, once they have been made
+        assert shared.get(collection + "/item/sss_statement.xml", txn.version) is None
+        rdf = request("GET", "/state-uri/" + collection + "/item.rdf")
+        assert "one" in rdf
+        assert shared.get(collection + "/item/sss_statement.xml", txn.version) == rdf
+        assert "one" in request("GET", "/state-uri/" + collection + "/item.atom")
+        assert request("GET", "/state-uri/" + collection + "/item.rdf") == rdf
+        assert request("GET", "/state-uri/" + collection + "/item.atom") == shared.get(collection + "/item/sss_statement.atom.xml", txn.version)
+        assert DAO.shared_cache.hits == hits + 3
+
+        # and the metadata once it has been read
+        assert dao.get_metadata(collection, "item") == {}
+        with dao.transaction(collection, "item"):
+            dao.store_metadata(collection, "item", {"title" : ["A title"]})
+        assert dao.get_metadata(collection, "item") == {"title" : ["A title"]}
+        assert dao.get_metadata(collection, "item") == {"title" : ["A title"]}
+        assert DAO.shared_cache.hits == hits + 4
+
+    def test_05_statement_stored_as_rdf(self):
+        dao = webpy.SwordServer(webpy.config, None).dao
+        collection = dao.get_collection_names()[0]
+
+        # a container whose statement was stored as RDF/XML, before the JSON form was used
+        statement = Statement(aggregation_uri="agg", rem_uri="rem", aggregates=["one"])
+        dao.backend.create_container(collection, "old")
+        dao.save(collection, "old", "sss_statement.xml", statement.serialise_rdf())
+        dao.save(collection, "old", "sss_statement.atom.xml", statement.serialise_atom())
+        assert dao.load_statement(collection, "old").aggregates == ["one"]
+        assert dao.get_statement_content(collection, "old") == statement.serialise_rdf()
+
+        # is stored in the JSON form when it next changes
+        with dao.transaction(collection, "old"):
+            s = dao.load_statement(collection, "old")
+            s.aggregates.append("two")
+            dao.store_statement(collection, "old", s)
+        assert dao.file_exists(collection, "old", "sss_statement.json")
+        assert not dao.file_exists(collection, "old", "sss_statement.xml")
+        assert not dao.file_exists(collection, "old", "sss_statement.atom.xml")
+        assert "two" in dao.get_statement_content(collection, "old")
+        assert "two" in dao.get_statement_feed(collection, "old")
+
+    def test_06_statement_log(self):
+        webpy.config.cfg["statement_checkpoint_interval"] = 3
+        dao = webpy.SwordServer(webpy.config, None).dao
+        collection = dao.get_collection_names()[0]
+        with dao.transaction(collection, "item", create=True):
+            dao.store_statement(collection, "item", Statement(aggregation_uri="agg", rem_uri="rem"))
+
+        # each change to the statement only logs its events
+        for i in range(2):
+            with dao.transaction(collection, "item"):
+                s = dao.load_statement(collection, "item")
+                s.set_state("state" + str(i), "description")
+                s.original_deposit("deposit" + str(i), datetime(2012, 1, 1), "packaging", "sword", None)
+                s.add_normalised_aggregations(["file" + str(i)])
+                dao.store_statement(collection, "item", s)
+        assert dao.file_exists(collection, "item", "sss_statement.events.2")
+        assert json.loads(dao._read(collection, "item", "sss_statement.events.2")) == [
+            {"event" : "state_changed", "states" : [["state1", "description"]]},
+            {"event" : "deposit_added", "deposit" : ["deposit1", "2012-01-01T00:00:00Z", "packaging", "sword", None]},
+            {"event" : "aggregates_added", "aggregates" : ["file1"]}]
+        assert json.loads(dao._read(collection, "item", "sss_statement.json"))["aggregates"] == []
+
+        # from which the statement is made when it is read afresh
+        DAO.statement_cache.clear()
+        s = dao.load_statement(collection, "item")
+        assert s.states == [("state1", "description")]
+        assert [od[0] for od in s.original_deposits] == ["deposit0", "deposit1"]
+        assert s.aggregates == ["file0", "file1"]
+        assert dao.list_content(collection, "item") == []
+
+        # until there are enough of them to be folded into a new checkpoint
+        with dao.transaction(collection, "item"):
+            s = dao.load_statement(collection, "item")
+            s.add_normalised_aggregations(["file2"])
+            dao.store_statement(collection, "item", s)
+        assert not dao.file_exists(collection, "item", "sss_statement.events.1")
+        assert not dao.file_exists(collection, "item", "sss_statement.events.2")
+        assert not dao.file_exists(collection, "item", "sss_statement.events.3")
+        checkpoint = json.loads(dao._read(collection, "item", "sss_statement.json"))
+        assert (checkpoint["seq"], checkpoint["aggregates"]) == (3, ["file0", "file1", "file2"])
+
+        # after which the log carries on, and content which is removed is logged too
+        with dao.transaction(collection, "item"):
+            s = dao.load_statement(collection, "item")
+            dao.store_statement(collection, "item", Statement(aggregation_uri="agg", rem_uri="rem", states=s.states, aggregates=["new"]))
+        assert dao.file_exists(collection, "item", "sss_statement.events.4")
+        DAO.statement_cache.clear()
+        s = dao.load_statement(collection, "item")
+        assert (s.original_deposits, s.aggregates) == ([], ["new"])
+        assert "new" in dao.get_statement_content(collection, "item")
+
+        # the statement which is cached when a checkpoint is written is the one that was stored, down to the second
+        now = datetime(2012, 1, 1, 12, 0, 0, 123456)
+        for i in range(2):
+            with dao.transaction(collection, "item"):
+                s = dao.load_statement(collection, "item")
+                s.original_deposit("deposit" + str(i), now, "packaging", "sword", None)
+                dao.store_statement(collection, "item", s)
+        assert json.loads(dao._read(collection, "item", "sss_statement.json"))["seq"] == 6
+        cached = dao.load_statement(collection, "item").original_deposits
+        DAO.statement_cache.clear()
+        assert cached == dao.load_statement(collection, "item").original_deposits
+        assert cached[0][1] == now.replace(microsecond=0)
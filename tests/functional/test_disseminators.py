@@ -0,0 +1,95 @@
+import gzip, tarfile, zlib
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from StringIO import StringIO
+
+from . import TestController
+
+from sss.ingesters_disseminators import ZipStream, ParallelZipStream, TarStream, ParallelGzipStream
+
+class Content(StringIO):
+    """ content which records when it is opened and closed """
+    def __init__(self, log, name, value):
+        StringIO.__init__(self, value)
+        self.log = log
+        self.name = name
+        log.append("open " + name)
+
+    def close(self):
+        self.log.append("close " + self.name)
+        StringIO.close(self)
+
+class TestDisseminators(TestController):
+    def files(self, log, sizes=True):
+        contents = [("a.txt", "first file " * 1000), ("b.bin", "".join([chr(i % 256) for i in range(70000)])), ("empty", "")]
+        return [(name, lambda name=name, value=value: Content(log, name, value), len(value) if sizes else None)
+                for name, value in contents], dict(contents)
+
+    def test_01_zip_stream(self):
+        for compression in [ZIP_STORED, ZIP_DEFLATED]:
+            for sizes in [True, False]:
+                log = []
+                files, contents = self.files(log, sizes)
+                stream = ZipStream(files, compression, chunk_size=1000)
+
+                # the zip is made as it is read, opening each file only when it is reached
+                start = stream.read(100)
+                assert start.startswith("PK\x03\x04")
+                assert log[0] == "open a.txt" and "open b.bin" not in log
+                data = start + "".join(iter(lambda: stream.read(4096), ""))
+                assert log == ["open a.txt", "close a.txt", "open b.bin", "close b.bin", "open empty", "close empty"]
+
+                # and is a complete zip file, with a Zip64 entry for any file whose size was not known
+                z = ZipFile(StringIO(data))
+                assert z.testzip() is None
+                assert z.namelist() == ["a.txt", "b.bin", "empty"]
+                for info in z.infolist():
+                    assert info.flag_bits & 0x08
+                    assert info.compress_type == compression
+                    assert z.read(info.filename) == contents[info.filename]
+                assert (("\x01\x00\x10\x00" in data[:200]) != sizes)
+
+    def test_02_abandoned_zip_stream(self):
+        log = []
+        files, contents = self.files(log)
+        stream = ZipStream(files)
+        stream.read(40000)
+        stream.close()
+        assert log == ["open a.txt", "close a.txt", "open b.bin", "close b.bin"]
+
+    def test_03_parallel_zip_stream(self):
+        log = []
+        files, contents = self.files(log)
+        data = ParallelZipStream(files, workers=3, block_size=1000, chunk_size=1000).read()
+        assert log == ["open a.txt", "close a.txt", "open b.bin", "close b.bin", "open empty", "close empty"]
+
+        # the blocks deflated in parallel make up standard entries
+        z = ZipFile(StringIO(data))
+        assert z.testzip() is None
+        assert z.namelist() == ["a.txt", "b.bin", "empty"]
+        for info in z.infolist():
+            assert info.compress_type == ZIP_DEFLATED
+            assert z.read(info.filename) == contents[info.filename]
+        assert z.getinfo("a.txt").compress_size < 1000
+
+    def test_04_parallel_gzip_stream(self):
+        log = []
+        files, contents = self.files(log)
+        data = ParallelGzipStream(TarStream(files, chunk_size=1000), workers=3, block_size=1000).read()
+
+        # a single gzip member, which the standard readers read
+        assert zlib.decompressobj(31).decompress(data) == gzip.GzipFile(fileobj=StringIO(data)).read()
+        t = tarfile.open(fileobj=StringIO(data), mode="r:gz")
+        assert t.getnames() == ["a.txt", "b.bin", "empty"]
+        for name in t.getnames():
+            assert t.extractfile(name).read() == contents[name]
+
+        # as is an empty one
+        assert gzip.GzipFile(fileobj=StringIO(ParallelGzipStream(StringIO("")).read())).read() == ""
+
+        # and one which is abandoned closes what it is reading
+        log = []
+        files, contents = self.files(log)
+        stream = ParallelGzipStream(TarStream(files, chunk_size=1000), workers=2, block_size=1000)
+        stream.read(100)
+        stream.close()
+        assert log[-1].startswith("close ")
@@ -0,0 +1,194 @@
+import os, shutil, tempfile, subprocess, sys, json, threading
+
+from . import TestController
+from .s3_stand_in import S3StandIn
+from .test_storage import Config
+
+from sss.storage import FilesystemBackend, S3Backend, BlobStore
+from sss.journal import ContainerTransaction, Journal, STAGING
+from sss.locks import ContainerLocks
+
+class TestJournal(TestController):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def transaction(self, backend, id, created=False):
+        txn = ContainerTransaction(Journal(backend), BlobStore(backend, backend.config), "col", id, created)
+        txn.begin()
+        return txn
+
+    def exercise(self, backend):
+        """ the behaviour of transactions, which is the same over any backend """
+        backend.create_collection("col")
+        backend.create_container("col", "a")
+        backend.put_blob("col", "a", "one", "old one")
+        backend.put_blob("col", "a", "two", "old two")
+        backend.put_blob("col", "a", "dir/three", "old three")
+        journal = Journal(backend)
+
+        # nothing changes until the transaction is committed, but it sees its own changes
+        with self.transaction(backend, "a") as txn:
+            backend.put_blob("col", "a", txn.put("one"), "new one")
+            backend.put_blob("col", "a", txn.put("four/five"), "new five")
+            txn.delete("two")
+            txn.delete("dir")
+            assert journal.open_transactions() == [txn.txid]
+            assert backend.get_blob("col", "a", "one") == "old one"
+            assert backend.blob_exists("col", "a", "two")
+            assert txn.locate("two") is None
+            assert txn.locate("dir/three") is None
+            assert backend.get_blob("col", "a", txn.locate("one")) == "new one"
+            assert sorted(txn.list(backend.list_blobs("col", "a"))) == ["four", "one"]
+        assert sorted(backend.list_blobs("col", "a")) == ["four", "one"]
+        assert backend.get_blob("col", "a", "one") == "new one"
+        assert backend.get_blob("col", "a", "four/five") == "new five"
+        assert journal.open_transactions() == []
+
+        # nor if it fails
+        try:
+            with self.transaction(backend, "a") as txn:
+                backend.put_blob("col", "a", txn.put("one"), "newer one")
+                txn.delete("four")
+                raise ValueError()
+        except ValueError:
+            pass
+        assert sorted(backend.list_blobs("col", "a")) == ["four", "one"]
+        assert backend.get_blob("col", "a", "one") == "new one"
+        assert journal.open_transactions() == []
+
+        # and a container which a failed transaction was creating is removed
+        try:
+            with self.transaction(backend, "b", created=True) as txn:
+                backend.create_container("col", "b")
+                backend.put_blob("col", "b", txn.put("one"), "one")
+                raise ValueError()
+        except ValueError:
+            pass
+        assert not backend.container_exists("col", "b")
+
+    def crash(self, backend, id, state):
+        """ leave a transaction open, as if its process had stopped just after writing the journal """
+        txn = self.transaction(backend, id)
+        backend.put_blob("col", id, txn.put("one"), "one from " + state)
+        txn.delete("two")
+        record = txn.record(state)
+        record["pid"] = self.dead_pid
+        Journal(backend).write(record)
+        return txn
+
+    def test_01_filesystem_transactions(self):
+        backend = FilesystemBackend(Config(store_dir=os.path.join(self.tmp_dir, "store")))
+        self.exercise(backend)
+        assert not [f for f in os.listdir(os.path.join(self.tmp_dir, "store", "col", "a")) if f.startswith("sss_")]
+
+    def test_02_s3_transactions(self):
+        server = S3StandIn().start()
+        try:
+            self.exercise(S3Backend(Config(tmp_dir=os.path.join(self.tmp_dir, "tmp"), s3_endpoint=server.endpoint, s3_bucket="sss")))
+            assert [k for k in server.objects.keys() if STAGING in k] == []
+        finally:
+            server.stop()
+
+    def test_03_recovery(self):
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        self.dead_pid = p.pid
+
+        backend = FilesystemBackend(Config(store_dir=os.path.join(self.tmp_dir, "store")))
+        backend.create_collection("col")
+        for id in ["committed", "open", "live"]:
+            backend.create_container("col", id)
+            backend.put_blob("col", id, "one", "old one")
+            backend.put_blob("col", id, "two", "old two")
+
+        # a committed transaction is completed, one which was still open is rolled back
+        self.crash(backend, "committed", "committed")
+        self.crash(backend, "open", "open")
+        live = self.transaction(backend, "live")
+        backend.put_blob("col", "live", live.put("one"), "live one")
+        journal = Journal(backend)
+        assert len(journal.open_transactions()) == 3
+        assert journal.recover() == 2
+        assert backend.get_blob("col", "committed", "one") == "one from committed"
+        assert backend.list_blobs("col", "committed") == ["one"]
+        assert backend.get_blob("col", "open", "one") == "old one"
+        assert sorted(backend.list_blobs("col", "open")) == ["one", "two"]
+
+        # but one whose process is still running is left alone
+        assert journal.open_transactions() == [live.txid]
+        assert backend.get_blob("col", "live", "one") == "old one"
+        live.commit()
+        assert backend.get_blob("col", "live", "one") == "live one"
+        assert journal.open_transactions() == []
+
+        # a transaction may have been part way through being applied, which is applied again
+        txn = self.crash(backend, "committed", "committed")
+        Journal(backend).apply(txn.record("committed"))
+        backend.put_blob("col", "committed", txn.put("one"), "one again")
+        assert journal.recover() == 1
+        assert backend.get_blob("col", "committed", "one") == "one again"
+
+    def test_04_recovery_takes_the_lock(self):
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        self.dead_pid = p.pid
+        backend = FilesystemBackend(Config(store_dir=os.path.join(self.tmp_dir, "store"), lock_timeout=0.05))
+        backend.create_collection("col")
+        backend.create_container("col", "a")
+        backend.put_blob("col", "a", "one", "old one")
+        backend.put_blob("col", "a", "two", "old two")
+        self.crash(backend, "a", "committed")
+
+        # a transaction whose container is locked (as if its process were running after all) is left alone
+        locks = ContainerLocks(backend.config)
+        journal = Journal(backend, locks)
+        held = []
+        def hold():
+            held.append(locks.lock("col", "a"))
+        t = threading.Thread(target=hold)
+        t.start()
+        t.join()
+        assert journal.recover() == 0
+        assert backend.get_blob("col", "a", "one") == "old one"
+
+        # until the lock is released
+        held[0].release()
+        assert journal.recover() == 1
+        assert backend.get_blob("col", "a", "one") == "one from committed"
+
+    def test_05_recovery_releases_blobs(self):
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        self.dead_pid = p.pid
+
+        # with hard links (one root) and with counted pointers (several roots)
+        for roots in [[os.path.join(self.tmp_dir, "links")], [os.path.join(self.tmp_dir, "pointers" + str(i)) for i in range(2)]]:
+            config = Config(store_dirs=roots, tmp_dir=os.path.join(self.tmp_dir, "tmp"))
+            backend = FilesystemBackend(config)
+            blobs = BlobStore(backend, config)
+            backend.create_collection("col")
+            backend.create_container("col", "a")
+            kept = blobs.store("col", "a", "kept", "kept content")
+
+            # a transaction which referenced a new blob and one which was already there, and then stopped
+            txn = ContainerTransaction(Journal(backend), blobs, "col", "a")
+            txn.begin()
+            for content in ["new content", "kept content"]:
+                name = txn.put(content.split()[0]) if backend.supports_links else content.split()[0]
+                txn.acquire(blobs.store("col", "a", name, content))
+            new = txn.acquired[0]
+            assert blobs.refcount(kept) == 2
+            record = Journal(backend).read(txn.txid)
+            assert record["acquired"] == [new, kept]
+            record["pid"] = self.dead_pid
+            Journal(backend).write(record)
+
+            # gives back its references when it is rolled back
+            assert Journal(backend, blobs=blobs).recover() == 1
+            assert not blobs.exists(new)
+            assert blobs.refcount(new) == 0
+            assert blobs.exists(kept)
+            assert blobs.refcount(kept) == 1
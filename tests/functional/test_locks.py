@@ -0,0 +1,114 @@
+import os, shutil, tempfile, subprocess, sys, json, socket, threading, time
+
+from . import TestController
+from .test_storage import Config
+
+from sss.locks import ContainerLocks, LockTimeout
+
+class TestLocks(TestController):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def locks(self, method, **kwargs):
+        return ContainerLocks(Config(store_dir=self.tmp_dir, lock_method=method, **kwargs))
+
+    def counter(self):
+        path = os.path.join(self.tmp_dir, "counter")
+        with open(path, "w") as f:
+            f.write("0")
+        return path
+
+    def increment(self, locks, path, n):
+        """ a read-modify-write of the counter, which loses counts unless the lock keeps the writers apart """
+        for i in range(n):
+            with locks.lock("col", "a"):
+                with open(path) as f:
+                    count = int(f.read())
+                time.sleep(0.0005)
+                with open(path, "w") as f:
+                    f.write(str(count + 1))
+
+    def exercise_threads(self, method):
+        locks = self.locks(method)
+        path = self.counter()
+        threads = [threading.Thread(target=self.increment, args=(locks, path, 20)) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with open(path) as f:
+            assert f.read() == "100"
+
+    def exercise_processes(self, method):
+        path = self.counter()
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.increment(self.locks(method), path, 20)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        with open(path) as f:
+            assert f.read() == "80"
+
+    def test_01_threads(self):
+        self.exercise_threads("fcntl")
+        self.exercise_threads("lockfile")
+
+    def test_02_processes(self):
+        self.exercise_processes("fcntl")
+        self.exercise_processes("lockfile")
+
+    def test_03_timeout(self):
+        for method in ["fcntl", "lockfile"]:
+            locks = self.locks(method, lock_timeout=0.05)
+            held = locks.lock("col", "a")
+            failed = []
+            def wait():
+                try:
+                    locks.lock("col", "a")
+                except LockTimeout:
+                    failed.append(True)
+            t = threading.Thread(target=wait)
+            t.start()
+            t.join()
+            assert failed == [True]
+
+            # while other containers can still be locked
+            locks.lock("col", "b").release()
+            held.release()
+            locks.lock("col", "a").release()
+
+        # unless there is no locking at all
+        locks = self.locks("none", lock_timeout=0)
+        locks.lock("col", "a")
+        locks.lock("col", "a").release()
+
+    def test_04_stale_lock_file(self):
+        p = subprocess.Popen([sys.executable, "-c", "pass"])
+        p.wait()
+        locks = self.locks("lockfile", lock_timeout=1)
+
+        # a lock file left by a process on this host which has died is broken
+        held = locks.lock("col", "a")
+        with open(held.path, "w") as f:
+            f.write(json.dumps({"host" : socket.gethostname(), "pid" : p.pid, "time" : time.time()}))
+        held.held = False
+        held._forget_thread_lock()
+        locks.lock("col", "a").release()
+        assert not os.path.exists(held.path)
+
+        # and one from another host once it is old enough
+        locks.stale_after = 0.2
+        with open(held.path, "w") as f:
+            f.write(json.dumps({"host" : "elsewhere", "pid" : 1, "time" : time.time()}))
+        start = time.time()
+        locks.lock("col", "a").release()
+        assert time.time() - start >= 0.1
@@ -0,0 +1,96 @@
+import os, shutil, tempfile, base64, hashlib
+from StringIO import StringIO
+
+from . import TestController
+
+from sss.spec import ValidationException, HttpHeaders
+from sss.multipart import parse_multipart, get_entry_and_media_parts, get_boundary
+
+ENTRY = """<?xml version="1.0" ?>
+<entry xmlns="http://www.w3.org/2005/Atom">
+    <title>Multipart Entry</title>
+</entry>"""
+
+PAYLOAD = "".join([chr(i % 256) for i in range(20000)])
+
+def multipart_body(boundary, parts, preamble="", epilogue=""):
+    body = preamble
+    for headers, content in parts:
+        body += "--" + boundary + "\r\n"
+        for k, v in headers:
+            body += k + ": " + v + "\r\n"
+        body += "\r\n" + content + "\r\n"
+    body += "--" + boundary + "--\r\n" + epilogue
+    return body
+
+def deposit_body(boundary, payload=PAYLOAD, payload_headers=None):
+    entry_headers = [("Content-Type", "application/atom+xml"), ("Content-Disposition", "attachment; name=\"atom\"")]
+    media_headers = payload_headers or [
+        ("Content-Type", "application/zip"),
+        ("Content-Disposition", "attachment; name=payload; filename=\"example.zip\""),
+        ("Content-MD5", hashlib.md5(payload).hexdigest()),
+        ("Packaging", "http://purl.org/net/sword/package/SimpleZip"),
+        ("Content-Transfer-Encoding", "base64")
+    ]
+    return multipart_body(boundary, [(entry_headers, ENTRY), (media_headers, base64.encodestring(payload))])
+
+class TestMultipart(TestController):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_boundary(self):
+        assert get_boundary('multipart/related; boundary="===abc==="; type="application/atom+xml"') == "===abc==="
+        assert get_boundary('multipart/related; boundary=abc; type="application/atom+xml"') == "abc"
+        self.assertRaises(ValidationException, get_boundary, "multipart/related")
+
+    def test_02_parse_deposit(self):
+        body = deposit_body("XyZ")
+        content_type = 'multipart/related; boundary="XyZ"; type="application/atom+xml"'
+        # use a buffer smaller than the boundary, so that the delimiters are split across reads
+        parts = parse_multipart(StringIO(body), content_type, self.tmp_dir, len(body), 3, threshold=1000)
+        entry, media = get_entry_and_media_parts(parts)
+
+        assert entry.content == ENTRY
+        assert entry.body is None
+        assert media.name == "payload"
+        assert media.content is None
+        assert media.body.getvalue() == PAYLOAD
+        assert media.body.size == len(PAYLOAD)
+        assert media.body.md5 == hashlib.md5(PAYLOAD).hexdigest()
+        assert not media.body.in_memory
+        assert os.path.dirname(media.body.path) == self.tmp_dir
+
+        # the part headers can be interpreted just like the HTTP headers of a binary deposit
+        assert HttpHeaders().extract_filename(media.headers) == "example.zip"
+        assert media.get_header("packaging") == "http://purl.org/net/sword/package/SimpleZip"
+        assert media.get_header("content-md5") == hashlib.md5(PAYLOAD).hexdigest()
+
+    def test_03_parse_unencoded(self):
+        body = multipart_body("b", [
+            ([("Content-Disposition", "attachment; name=\"atom\"")], ENTRY),
+            ([("Content-Disposition", "attachment; name=\"payload\"")], PAYLOAD)
+        ], preamble="this is the preamble\r\n", epilogue="this is the epilogue")
+        parts = parse_multipart(StringIO(body), "multipart/related; boundary=b", self.tmp_dir, None, 1024, threshold=100000)
+        entry, media = get_entry_and_media_parts(parts)
+        assert entry.content == ENTRY
+        assert media.body.in_memory
+        assert media.body.getvalue() == PAYLOAD
+
+    def test_04_invalid_requests(self):
+        content_type = "multipart/related; boundary=XyZ"
+
+        # truncated bodies are rejected, and anything spooled is removed
+        body = deposit_body("XyZ")
+        self.assertRaises(ValidationException, parse_multipart, StringIO(body[:-100]), content_type, self.tmp_dir, threshold=0)
+        assert os.listdir(self.tmp_dir) == []
+
+        # so are bodies without the boundary from the content type
+        self.assertRaises(ValidationException, parse_multipart, StringIO(body), "multipart/related; boundary=other", self.tmp_dir)
+
+        # and bodies which do not have exactly an atom and a payload part
+        body = multipart_body("XyZ", [([("Content-Disposition", "attachment; name=\"atom\"")], ENTRY)])
+        parts = parse_multipart(StringIO(body), content_type, self.tmp_dir)
+        self.assertRaises(ValidationException, get_entry_and_media_parts, parts)
@@ -0,0 +1,88 @@
+import os, shutil, tempfile, base64, unittest
+from StringIO import StringIO
+
+from . import TestController
+
+try:
+    import pylons
+    from pylons.controllers.util import Request, Response
+except ImportError:
+    pylons = None
+
+AUTH = "Basic " + base64.b64encode("sword:sword")
+
+@unittest.skipIf(pylons is None, "Pylons is not installed")
+class TestPylons(TestController):
+    def setUp(self):
+        from sss import pylons_sword_controller
+        # the controller stores content relative to the current directory, so give it one of its own
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.controller = pylons_sword_controller
+        self.config = dict(pylons_sword_controller.config.cfg)
+        self.collection = pylons_sword_controller.SwordServer(pylons_sword_controller.config, None).dao.get_collection_names()[0]
+
+    def tearDown(self):
+        self.controller.config.cfg = self.config
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def request(self, action, method, path, body="", headers=None):
+        """ call the action of the controller, as routed from a request, and give back the response """
+        env = {
+            "REQUEST_METHOD" : method,
+            "PATH_INFO" : "/",
+            "QUERY_STRING" : "",
+            "HTTP_HOST" : "localhost:5000",
+            "wsgi.input" : StringIO(body),
+            "wsgi.url_scheme" : "http",
+            "CONTENT_LENGTH" : str(len(body))
+        }
+        for k, v in (headers or {}).items():
+            key = k.upper().replace("-", "_")
+            env[key if key in ["CONTENT_LENGTH", "CONTENT_TYPE"] else "HTTP_" + key] = v
+        pylons.request._push_object(Request(env))
+        pylons.response._push_object(Response())
+        try:
+            controller = self.controller.SwordController()
+            body = getattr(controller, action)(path)
+            response = pylons.response._current_obj()
+            if body is not None:
+                response.body = body
+            return response
+        finally:
+            pylons.response._pop_object()
+            pylons.request._pop_object()
+
+    def test_01_etags(self):
+        binary = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin"
+        }
+        r = self.request("collection", "POST", self.collection, "first", binary)
+        assert r.status_int == 201
+        oid = r.headers["Location"].split("/edit-uri/")[1]
+        created = r.headers["ETag"]
+
+        # the container and its media resource are at the version given in the receipt
+        assert self.request("container", "GET", oid, headers={"Authorization" : AUTH}).headers["ETag"] == created
+        assert self.request("media_resource", "GET", oid, headers={"Authorization" : AUTH}).headers["ETag"] == created
+
+        # which a change must be made against, and which it changes
+        r = self.request("media_resource", "POST", oid, "second", dict(binary, **{"If-Match" : '"other"'}))
+        assert r.status_int == 412
+        r = self.request("media_resource", "POST", oid, "second", dict(binary, **{"If-Match" : created}))
+        assert r.status_int == 201
+        added = r.headers["ETag"]
+        assert added != created
+        assert self.request("container", "GET", oid, headers={"Authorization" : AUTH}).headers["ETag"] == added
+
+        # as do replacing and removing the content
+        r = self.request("media_resource", "PUT", oid, "third", dict(binary, **{"If-Match" : added}))
+        assert r.status_int == 204
+        replaced = r.headers["ETag"]
+        r = self.request("media_resource", "DELETE", oid, headers={"Authorization" : AUTH, "If-Match" : replaced})
+        assert r.status_int == 204
+        assert r.headers["ETag"] not in [created, added, replaced]
@@ -0,0 +1,258 @@
+import os, shutil, tempfile, hashlib, threading, gzip, zlib
+from StringIO import StringIO
+
+from . import TestController
+
+from sss import Configuration
+from sss.spool import copy_stream, spool_to_tmp, digest_stream, move_file, sync_file, GroupCommitter, SpooledBody, spool_body, MaxSizeExceeded
+from sss.spool import DecodingReader, parse_content_encoding, ContentEncodingError, UnsupportedContentEncoding
+from sss.core import DepositRequest
+from sss.repository import DAO
+from sss import spool
+
+class TestSpool(TestController):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_01_copy_stream(self):
+        source = StringIO("a" * 1000)
+        target = StringIO()
+        copied = copy_stream(source, target, chunk_size=64)
+        assert copied == 1000
+        assert target.getvalue() == "a" * 1000
+
+        # the size limit must be respected, even if there is more to read
+        source = StringIO("a" * 1000)
+        target = StringIO()
+        copied = copy_stream(source, target, chunk_size=64, size=100)
+        assert copied == 100
+        assert len(target.getvalue()) == 100
+
+    def test_02_spool_to_tmp(self):
+        source = StringIO("b" * 5000)
+        fn, writer = spool_to_tmp(source, os.path.join(self.tmp_dir, "spool"), 5000, 512)
+        assert os.path.isfile(fn)
+        assert os.path.dirname(fn) == os.path.join(self.tmp_dir, "spool")
+        with open(fn, "rb") as f:
+            assert f.read() == "b" * 5000
+
+        # the digests are computed in the same pass as the spooling
+        assert writer.size == 5000
+        assert writer.md5 == hashlib.md5("b" * 5000).hexdigest()
+        assert writer.sha256 == hashlib.sha256("b" * 5000).hexdigest()
+        assert writer.digests() == {"md5" : writer.md5, "sha256" : writer.sha256}
+
+    def test_03_store_content_from_file(self):
+        config = Configuration()
+        config.store_dir = os.path.join(self.tmp_dir, "store")
+        config.tmp_dir = os.path.join(self.tmp_dir, "spool")
+        config.num_collections = 1
+        config.copy_chunk_size = 16
+
+        dao = DAO(config)
+        collection = dao.get_collection_names()[0]
+        id = dao.create_container(collection)
+
+        fn = dao.store_content(collection, id, StringIO("c" * 100), "content.bin")
+        with open(dao.get_store_path(collection, id, fn), "rb") as f:
+            assert f.read() == "c" * 100
+
+    def test_04_digest_stream(self):
+        source = StringIO("d" * 3000)
+        writer = digest_stream(source, 100)
+        assert writer.size == 3000
+        assert writer.md5 == hashlib.md5("d" * 3000).hexdigest()
+        assert writer.sha256 == hashlib.sha256("d" * 3000).hexdigest()
+
+    def test_05_move_file(self):
+        source = os.path.join(self.tmp_dir, "source")
+        target = os.path.join(self.tmp_dir, "target")
+        with open(source, "wb") as f:
+            f.write("e" * 1000)
+        move_file(source, target, 64)
+        assert not os.path.exists(source)
+        with open(target, "rb") as f:
+            assert f.read() == "e" * 1000
+
+    def test_06_store_spooled_content(self):
+        config = Configuration()
+        config.store_dir = os.path.join(self.tmp_dir, "store")
+        config.tmp_dir = os.path.join(self.tmp_dir, "spool")
+        config.num_collections = 1
+
+        dao = DAO(config)
+        collection = dao.get_collection_names()[0]
+        id = dao.create_container(collection)
+
+        # a spooled file is moved into the store, not copied
+        spooled, writer = spool_to_tmp(StringIO("f" * 100), config.tmp_dir)
+        inode = os.stat(spooled).st_ino
+        fn = dao.store_content(collection, id, open(spooled, "rb"), "content.bin")
+        stored = dao.get_store_path(collection, id, fn)
+        assert not os.path.exists(spooled)
+        assert os.stat(stored).st_ino == inode
+        with open(stored, "rb") as f:
+            assert f.read() == "f" * 100
+
+        # but a file from anywhere else is left where it is
+        other = os.path.join(self.tmp_dir, "other.bin")
+        with open(other, "wb") as f:
+            f.write("g" * 100)
+        fn = dao.store_content(collection, id, open(other, "rb"), "other.bin")
+        assert os.path.exists(other)
+        with open(dao.get_store_path(collection, id, fn), "rb") as f:
+            assert f.read() == "g" * 100
+
+    def test_07_adaptive_chunk_size(self):
+        class RecordingReader(object):
+            def __init__(self, data):
+                self.source = StringIO(data)
+                self.reads = []
+            def read(self, n):
+                self.reads.append(n)
+                return self.source.read(n)
+
+        source = RecordingReader("h" * 10000)
+        target = StringIO()
+        copied = copy_stream(source, target, chunk_size=100, max_chunk_size=1000)
+        assert copied == 10000
+        assert target.getvalue() == "h" * 10000
+        assert source.reads[:5] == [100, 200, 400, 800, 1000]
+        assert max(source.reads) == 1000
+
+    def test_08_durability_modes(self):
+        for mode in [None, "none", "on-close", "group-commit"]:
+            fn, writer = spool_to_tmp(StringIO("i" * 1000), self.tmp_dir, 1000, durability=mode)
+            with open(fn, "rb") as f:
+                assert f.read() == "i" * 1000
+
+        with open(os.path.join(self.tmp_dir, "unknown"), "wb") as f:
+            self.assertRaises(ValueError, sync_file, f, "sometimes")
+
+    def test_09_group_commit_batches(self):
+        # count the batches that the committer makes
+        created = []
+        original = spool._Batch
+        class CountingBatch(original):
+            def __init__(self):
+                original.__init__(self)
+                created.append(self)
+        spool._Batch = CountingBatch
+        try:
+            committer = GroupCommitter(interval=0.5)
+            files = [open(os.path.join(self.tmp_dir, str(i)), "wb") for i in range(5)]
+            for f in files:
+                f.write("j")
+            threads = [threading.Thread(target=committer.sync, args=(f,)) for f in files]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for f in files:
+                f.close()
+        finally:
+            spool._Batch = original
+
+        # the concurrent syncs all joined the one batch
+        assert len(created) == 1
+        assert len(created[0].fds) == 5
+        assert created[0].done.is_set()
+        for i in range(5):
+            with open(os.path.join(self.tmp_dir, str(i)), "rb") as f:
+                assert f.read() == "j"
+
+    def test_10_spooled_body_in_memory(self):
+        body = spool_body(StringIO("k" * 100), self.tmp_dir, 100, 16, threshold=1000)
+        assert body.in_memory
+        assert body.path is None
+        assert os.listdir(self.tmp_dir) == []
+        assert body.size == 100
+        assert body.digests == {"md5" : hashlib.md5("k" * 100).hexdigest(), "sha256" : hashlib.sha256("k" * 100).hexdigest()}
+
+        # the content can be read as many times as necessary
+        assert body.open().read() == "k" * 100
+        assert body.open().read() == "k" * 100
+        assert body.getvalue() == "k" * 100
+
+    def test_11_spooled_body_on_disk(self):
+        body = SpooledBody(self.tmp_dir, threshold=1000)
+        for i in range(20):
+            body.write("l" * 100)
+        body.close()
+        assert not body.in_memory
+        assert os.path.dirname(body.path) == self.tmp_dir
+        assert body.size == 2000
+        assert body.md5 == hashlib.md5("l" * 2000).hexdigest()
+        with open(body.path, "rb") as f:
+            assert f.read() == "l" * 2000
+        assert body.open().read() == "l" * 2000
+        assert body.open().read() == "l" * 2000
+
+        # the temp file goes when the body is discarded
+        path = body.path
+        body.discard()
+        assert not os.path.exists(path)
+
+        # or when it is garbage collected
+        body = spool_body(StringIO("m" * 2000), self.tmp_dir, threshold=1000)
+        path = body.path
+        assert os.path.exists(path)
+        del body
+        assert not os.path.exists(path)
+
+    def test_12_deposit_request_body(self):
+        d = DepositRequest()
+        assert not d.has_content()
+        d.body = spool_body(StringIO("n" * 2000), self.tmp_dir, threshold=1000)
+        assert d.has_content()
+        assert d.content_size == 2000
+        assert d.digests["md5"] == hashlib.md5("n" * 2000).hexdigest()
+        assert d.content == "n" * 2000
+        assert d.content == "n" * 2000
+        assert d.content_file.read() == "n" * 2000
+
+    def test_13_max_size(self):
+        # a stream of unknown length (e.g. a chunked request body) is copied until it exceeds max_size
+        target = StringIO()
+        assert copy_stream(StringIO("o" * 1000), target, chunk_size=64, max_size=1000) == 1000
+        self.assertRaises(MaxSizeExceeded, copy_stream, StringIO("o" * 1001), StringIO(), chunk_size=64, max_size=1000)
+
+        # and a body which is spooled to disk is removed when it turns out to be too large
+        self.assertRaises(MaxSizeExceeded, spool_body, StringIO("p" * 5000), self.tmp_dir, threshold=100, max_size=4000)
+        assert os.listdir(self.tmp_dir) == []
+
+    def test_14_decoding_reader(self):
+        content = "".join([chr(65 + i % 7) for i in range(100000)])
+        buf = StringIO()
+        g = gzip.GzipFile(fileobj=buf, mode="wb")
+        g.write(content)
+        g.close()
+        gz = buf.getvalue()
+
+        # the content is decoded as it is read, and the MD5 is of the encoded bytes
+        reader = DecodingReader(StringIO(gz), "gzip", len(gz), 512)
+        body = spool_body(reader, self.tmp_dir, threshold=1000)
+        assert body.getvalue() == content
+        assert reader.md5 == hashlib.md5(gz).hexdigest()
+        assert reader.encoded_size == len(gz)
+
+        # deflate may be zlib wrapped (as HTTP says) or raw (as many clients send it)
+        assert DecodingReader(StringIO(zlib.compress(content)), "deflate").read() == content
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        assert DecodingReader(StringIO(raw.compress(content) + raw.flush()), "deflate").read() == content
+
+        # corrupt and truncated content is rejected
+        self.assertRaises(ContentEncodingError, DecodingReader(StringIO("not gzip"), "gzip").read)
+        self.assertRaises(ContentEncodingError, DecodingReader(StringIO(gz[:len(gz) / 2]), "gzip").read)
+
+        # the limits apply to both the encoded and the decoded size
+        self.assertRaises(MaxSizeExceeded, DecodingReader(StringIO(gz), "gzip", max_size=100).read)
+        self.assertRaises(MaxSizeExceeded, spool_body, DecodingReader(StringIO(gz), "gzip"), self.tmp_dir, max_size=50000)
+
+        assert parse_content_encoding(None) is None
+        assert parse_content_encoding("identity") is None
+        assert parse_content_encoding("GZIP") == "gzip"
+        self.assertRaises(UnsupportedContentEncoding, parse_content_encoding, "br")
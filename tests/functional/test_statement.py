@@ -1,6 +1,7 @@
-import os
+import os, json
 from lxml import etree
 from datetime import datetime
+from StringIO import StringIO
 
 from . import TestController
 
@@ -315,3 +316,76 @@ class TestEntry(TestController):
                     
                     
                     
+
+    def test_07_json_serialise(self):
+        n = datetime.now().replace(microsecond=0)
+        ods = [
+            ("http://od1/", n, "http://package/", "sword", "obo"),
+            ("http://od2/", n, "http://package/", "bob", None)
+        ]
+        s = Statement(aggregation_uri="http://aggregation/", rem_uri="http://rem/",
+                        original_deposits=ods,
+                        aggregates=["http://agg1/", "http://agg2/"],
+                        states=[("http://state/", "everything is groovy")])
+
+        # the statement read back from its JSON form is the same, and serialises the same way
+        s2 = Statement(json_file=StringIO(s.serialise_json()))
+        assert s2.aggregation_uri == "http://aggregation/"
+        assert s2.rem_uri == "http://rem/"
+        assert s2.original_deposits == ods
+        assert s2.aggregates == ["http://agg1/", "http://agg2/"]
+        assert s2.states == [("http://state/", "everything is groovy")]
+        assert s2.serialise_rdf() == s.serialise_rdf()
+        assert s2.serialise_atom() == s.serialise_atom()
+
+        # as is one read from its RDF/XML form
+        s3 = Statement(rdf_file=StringIO(s.serialise_rdf()))
+        assert Statement(json_file=StringIO(s3.serialise_json())).original_deposits == ods
+
+    def test_08_events(self):
+        n = datetime.now().replace(microsecond=0)
+        base = Statement(aggregation_uri="http://aggregation/", rem_uri="http://rem/",
+                        original_deposits=[("http://od1/", n, "http://package/", "sword", None)],
+                        aggregates=["http://agg1/"],
+                        states=[("http://state/", "in progress")])
+
+        # a statement with more deposits and aggregates than the base is made from it by events for just those
+        s = base.copy()
+        s.set_state("http://archived/", "archived")
+        s.original_deposit("http://od2/", n, "http://package/", "sword", "obo")
+        s.add_normalised_aggregations(["http://agg1/", "http://agg2/"])
+        events = s.events_since(base)
+        assert [e["event"] for e in events] == ["state_changed", "deposit_added", "aggregates_added"]
+        assert events[2]["aggregates"] == ["http://agg2/"]
+        assert s.events_since(s.copy()) == []
+
+        # and any other statement is made by removing the content first; either way, the events survive JSON
+        for other in [s, Statement(aggregation_uri="http://other/", rem_uri="http://rem/", aggregates=["http://agg3/"])]:
+            made = base.copy()
+            for event in json.loads(json.dumps(other.events_since(base))):
+                made.apply_event(event)
+            assert made.serialise_json() == other.serialise_json()
+
+    def test_09_unsaved_events(self):
+        n = datetime.now().replace(microsecond=0)
+        s = Statement(aggregation_uri="http://aggregation/", rem_uri="http://rem/", aggregates=["http://agg1/"])
+
+        # nothing is logged until the statement has been saved
+        s.set_state("http://state/", "in progress")
+        assert s.unsaved_events == []
+
+        # after which the changes made through its methods are logged, as events_since would give them
+        s.mark_saved("collection", "id", 3)
+        base = s.copy()
+        assert base.saved_as is None
+        s.set_state("http://archived/", "archived")
+        s.original_deposit("http://od1/", n, "http://package/", "sword", None)
+        s.add_normalised_aggregations(["http://agg1/", "http://agg2/"])
+        s.add_normalised_aggregations(["http://agg2/"])
+        assert s.saved_as == ("collection", "id", 3)
+        assert json.loads(json.dumps(s.unsaved_events)) == json.loads(json.dumps(s.events_since(base)))
+        assert s.logged_events_since(base) is s.unsaved_events
+
+        # unless it has also been changed directly, when the events are found by comparing it with the base
+        s.aggregates.append("http://agg3/")
+        assert s.logged_events_since(base)[-1] == {"event" : "aggregates_added", "aggregates" : ["http://agg2/", "http://agg3/"]}
@@ -0,0 +1,582 @@
+import os, shutil, tempfile, base64, gzip, hashlib, tarfile, threading
+from zipfile import ZipFile, ZIP_DEFLATED
+from StringIO import StringIO
+from wsgiref.util import FileWrapper
+
+from . import TestController
+from .s3_stand_in import S3StandIn
+
+from sss import webpy
+from sss.repository import DAO, MANIFEST, UNPACKED
+from sss.storage import FilesystemBackend
+
+AUTH = "Basic " + base64.b64encode("sword:sword")
+
+class UnreadableInput(object):
+    """ wsgi.input which fails the test if the application tries to read the body """
+    def read(self, *args):
+        raise AssertionError("the request body was read")
+
+class TestWebPy(TestController):
+    def setUp(self):
+        # the web.py application stores content relative to the current directory, so give it one of its own
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.webpy = webpy
+        self.config = dict(webpy.config.cfg)
+        self.collection = webpy.SwordServer(webpy.config, None).dao.get_collection_names()[0]
+
+    def tearDown(self):
+        self.webpy.config.cfg = self.config
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def request(self, method, path, body="", headers=None, wsgi_input=None):
+        env = {
+            "REQUEST_METHOD" : method,
+            "PATH_INFO" : path,
+            "QUERY_STRING" : "",
+            "HTTP_HOST" : "localhost:8080",
+            "wsgi.input" : wsgi_input if wsgi_input is not None else StringIO(body),
+            "wsgi.url_scheme" : "http",
+            "CONTENT_LENGTH" : str(len(body))
+        }
+        for k, v in (headers or {}).items():
+            key = k.upper().replace("-", "_")
+            env[key if key in ["CONTENT_LENGTH", "CONTENT_TYPE"] else "HTTP_" + key] = v
+        if "HTTP_TRANSFER_ENCODING" in env:
+            # the server has already decoded the chunks, and there is no length to pass on
+            del env["CONTENT_LENGTH"]
+        response = {}
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = dict(headers)
+        response["body"] = "".join(self.webpy.application(env, start_response))
+        return response
+
+    def test_01_binary_deposit(self):
+        r = self.request("POST", "/col-uri/" + self.collection, "binary content", {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin"
+        })
+        assert r["status"] == "201 Created"
+        assert r["headers"]["Location"] is not None
+
+    def test_02_early_rejection(self):
+        headers = {
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip",
+            "Expect" : "100-continue",
+            "Content-Length" : str(500 * 1024 * 1024)
+        }
+        path = "/col-uri/" + self.collection
+
+        # bad credentials are rejected without reading the body
+        r = self.request("POST", path, headers=dict(headers, Authorization="Basic " + base64.b64encode("sword:wrong")), wsgi_input=UnreadableInput())
+        assert r["status"].startswith("401")
+
+        # as are oversized uploads
+        r = self.request("POST", path, headers=dict(headers, Authorization=AUTH), wsgi_input=UnreadableInput())
+        assert r["status"] == "413 Request Entity Too Large"
+
+        # and mediated deposits, when mediation is turned off
+        self.webpy.config.cfg["mediation"] = False
+        headers["Content-Length"] = "100"
+        r = self.request("POST", path, headers=dict(headers, Authorization=AUTH, **{"On-Behalf-Of" : "obo"}), wsgi_input=UnreadableInput())
+        assert r["status"] == "412 Precondition Failed"
+
+    def test_03_chunked_deposit(self):
+        headers = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin",
+            "Transfer-Encoding" : "chunked"
+        }
+        path = "/col-uri/" + self.collection
+        r = self.request("POST", path, "chunked content" * 1000, headers)
+        assert r["status"] == "201 Created"
+
+        # the max upload size is enforced as the body is read, as there is no Content-Length to check up front
+        # and anything spooled to disk before the limit was reached is removed
+        self.webpy.config.cfg["max_upload_size"] = 10000
+        self.webpy.config.cfg["spool_memory_threshold"] = 100
+        r = self.request("POST", path, "chunked content" * 1000, headers)
+        assert r["status"] == "413 Request Entity Too Large"
+        assert os.listdir(self.webpy.config.tmp_dir) == []
+
+    def test_04_gzip_deposit(self):
+        content = "<xml>text heavy content</xml>" * 10000
+        buf = StringIO()
+        g = gzip.GzipFile(fileobj=buf, mode="wb")
+        g.write(content)
+        g.close()
+        gz = buf.getvalue()
+        headers = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/xml",
+            "Content-Disposition" : "attachment; filename=content.xml",
+            "Content-Encoding" : "gzip",
+            "Content-MD5" : hashlib.md5(gz).hexdigest()
+        }
+        path = "/col-uri/" + self.collection
+
+        # the content is decoded before it is stored, but the Content-MD5 is of the encoded bytes
+        r = self.request("POST", path, gz, headers)
+        assert r["status"] == "201 Created"
+        stored = [os.path.join(d, f) for d, ds, fs in os.walk(self.webpy.config.store_dir) for f in fs if f.endswith("content.xml")]
+        assert len(stored) == 1
+        with open(stored[0]) as f:
+            assert f.read() == content
+
+        r = self.request("POST", path, gz, dict(headers, **{"Content-MD5" : hashlib.md5(content).hexdigest()}))
+        assert r["status"] == "412 Precondition Failed"
+
+        # a body which decompresses to more than the max upload size is rejected, however small it was on the wire
+        self.webpy.config.cfg["max_upload_size"] = 100000
+        r = self.request("POST", path, gz, headers)
+        assert r["status"] == "413 Request Entity Too Large"
+
+        # as are encodings that we can't decode, without reading the body
+        r = self.request("POST", path, headers=dict(headers, **{"Content-Encoding" : "br", "Content-Length" : "100"}), wsgi_input=UnreadableInput())
+        assert r["status"] == "415 Unsupported Media Type"
+
+    def test_05_s3_storage(self):
+        server = S3StandIn().start()
+        try:
+            self.webpy.config.cfg.update({"storage_backend" : "sss.storage.S3Backend", "s3_endpoint" : server.endpoint, "s3_bucket" : "sss"})
+            collection = self.webpy.SwordServer(self.webpy.config, None).dao.get_collection_names()[0]
+            with open(os.path.join(self.cwd, "tests", "resources", "example.zip"), "rb") as f:
+                package = f.read()
+            r = self.request("POST", "/col-uri/" + collection, package, {
+                "Authorization" : AUTH,
+                "Content-Type" : "application/zip",
+                "Content-Disposition" : "attachment; filename=example.zip",
+                "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+            })
+            assert r["status"] == "201 Created"
+            oid = r["headers"]["Location"].split("/edit-uri/")[1]
+
+            # the package and everything unpacked from it went into the bucket, not the store_dir
+            keys = [k for k in server.objects.keys() if k.startswith(oid + "/")]
+            assert oid + "/mets.xml" in keys
+            assert oid + "/sss_statement.json" in keys
+            assert not os.path.exists(os.path.join(self.webpy.config.store_dir, oid))
+
+            # and the media resource is packaged up from the bucket
+            r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})
+            assert r["status"] == "200 OK"
+            z = ZipFile(StringIO(r["body"]))
+            assert z.testzip() is None
+            assert "mets.xml" in z.namelist()
+
+            r = self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+            assert r["status"] == "204 No Content"
+            assert [k for k in server.objects.keys() if k.startswith(oid + "/")] == []
+        finally:
+            server.stop()
+
+    def test_06_deduplicated_deposits(self):
+        self.webpy.config.cfg["deduplicate"] = True
+        with open(os.path.join(self.cwd, "tests", "resources", "example.zip"), "rb") as f:
+            package = f.read()
+        headers = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+        }
+        oids = []
+        for i in range(2):
+            r = self.request("POST", "/col-uri/" + self.collection, package, headers)
+            assert r["status"] == "201 Created"
+            oids.append(r["headers"]["Location"].split("/edit-uri/")[1])
+
+        # both containers have the package and its files, but each distinct file is stored only once
+        dao = self.webpy.SwordServer(self.webpy.config, None).dao
+        pool = os.path.join(self.webpy.config.store_dir, ".blobs")
+        pooled = [os.path.join(d, f) for d, ds, fs in os.walk(pool) for f in fs]
+        assert len(pooled) == 5
+        for path in pooled:
+            assert os.stat(path).st_nlink == 3
+        for oid in oids:
+            collection, id = oid.split("/")
+            assert "mets.xml" in dao.list_content(collection, id)
+            assert os.stat(dao.get_store_path(collection, id, "mets.xml")).st_ino in [os.stat(p).st_ino for p in pooled]
+        assert dao.get_collection_names().count(".blobs") == 0
+
+        # the blobs are released as the containers go
+        r = self.request("DELETE", "/edit-uri/" + oids[0], headers={"Authorization" : AUTH})
+        assert r["status"] == "204 No Content"
+        for path in pooled:
+            assert os.stat(path).st_nlink == 2
+        r = self.request("DELETE", "/edit-uri/" + oids[1], headers={"Authorization" : AUTH})
+        assert [f for d, ds, fs in os.walk(pool) for f in fs] == []
+
+    def test_07_failed_deposit_leaves_nothing(self):
+        dao = self.webpy.SwordServer(self.webpy.config, None).dao
+        before = dao.get_container_ids(self.collection)
+
+        # the package is stored, and then found not to be a zip file part way through the deposit
+        r = self.request("POST", "/col-uri/" + self.collection, "not a zip file", {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+        })
+        assert r["status"] != "201 Created"
+        assert dao.get_container_ids(self.collection) == before
+        assert dao.journal.open_transactions() == []
+
+    def test_08_concurrent_changes(self):
+        r = self.request("POST", "/col-uri/" + self.collection, "first", {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=file0.bin"
+        })
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+
+        # files added to the same container at the same time are all kept in its statement
+        statuses = []
+        def add(i):
+            r = self.request("POST", "/em-uri/" + oid, "content " + str(i), {
+                "Authorization" : AUTH,
+                "Content-Type" : "application/octet-stream",
+                "Content-Disposition" : "attachment; filename=file" + str(i) + ".bin"
+            })
+            statuses.append(r["status"])
+        threads = [threading.Thread(target=add, args=(i,)) for i in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert statuses == ["201 Created"] * 8
+        collection, id = oid.split("/")
+        dao = self.webpy.SwordServer(self.webpy.config, None).dao
+        deposits = [uri.split("_")[-1] for uri, d, f, b, o in dao.load_statement(collection, id).original_deposits]
+        assert sorted(deposits) == ["file" + str(i) + ".bin" for i in range(9)]
+
+        # a request which cannot get the lock is told to try again
+        self.webpy.config.cfg["lock_timeout"] = 0
+        with dao.locks.lock(collection, id):
+            r = self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["status"] == "503 Service Unavailable"
+        assert r["headers"]["Retry-After"] == "1"
+        r = self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["status"] == "204 No Content"
+
+    def test_09_versions(self):
+        binary = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin"
+        }
+        r = self.request("POST", "/col-uri/" + self.collection, "first", binary)
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+        created = r["headers"]["ETag"]
+
+        # the container and its media resource are at the version given in the receipt
+        r = self.request("GET", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["headers"]["ETag"] == created
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["headers"]["ETag"] == created
+
+        # a change against another version is refused
+        r = self.request("POST", "/em-uri/" + oid, "second", dict(binary, **{"If-Match" : '"other", W/' + created}))
+        assert r["status"] == "412 Precondition Failed"
+        r = self.request("GET", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["headers"]["ETag"] == created
+
+        # and one against the current version changes it
+        r = self.request("POST", "/em-uri/" + oid, "second", dict(binary, **{"If-Match" : '"other", ' + created}))
+        assert r["status"] == "201 Created"
+        added = r["headers"]["ETag"]
+        assert added != created
+        r = self.request("GET", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert r["headers"]["ETag"] == added
+        r = self.request("PUT", "/em-uri/" + oid, "third", dict(binary, **{"If-Match" : created}))
+        assert r["status"] == "412 Precondition Failed"
+
+        # any version will do for *
+        r = self.request("DELETE", "/em-uri/" + oid, headers={"Authorization" : AUTH, "If-Match" : "*"})
+        assert r["status"] == "204 No Content"
+        emptied = r["headers"]["ETag"]
+        assert emptied not in [created, added]
+        r = self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH, "If-Match" : added})
+        assert r["status"] == "412 Precondition Failed"
+        r = self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH, "If-Match" : emptied})
+        assert r["status"] == "204 No Content"
+
+    def test_10_package_cache(self):
+        binary = {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin"
+        }
+        r = self.request("POST", "/col-uri/" + self.collection, "first", binary)
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+        cache = DAO.package_cache
+        hits, misses = cache.hits, cache.misses
+
+        # the package is made once for the version of the container, and not in the container
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})
+        assert len(ZipFile(StringIO(r["body"])).namelist()) == 1
+        assert self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"] == r["body"]
+        assert (cache.hits, cache.misses) == (hits + 1, misses + 1)
+        collection, id = oid.split("/")
+        dao = webpy.SwordServer(webpy.config, None).dao
+        assert len(dao.list_content(collection, id)) == 1
+
+        # as is each other format
+        feed = {"Authorization" : AUTH, "Accept" : "application/atom+xml;type=feed"}
+        assert "content.bin" in self.request("GET", "/em-uri/" + oid, headers=feed)["body"]
+        assert "content.bin" in self.request("GET", "/em-uri/" + oid, headers=feed)["body"]
+        assert (cache.hits, cache.misses) == (hits + 2, misses + 2)
+        assert cache.stats()["entries"] == 2
+
+        # and once the container changes, it is made again, replacing those made from the old version
+        r = self.request("POST", "/em-uri/" + oid, "second", dict(binary, **{"Content-Disposition" : "attachment; filename=other.bin"}))
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})
+        assert len(ZipFile(StringIO(r["body"])).namelist()) == 2
+        assert (cache.hits, cache.misses) == (hits + 2, misses + 3)
+        assert cache.stats()["entries"] == 1
+
+        # packages go when there are too many of them, or they have not been used for too long
+        self.request("GET", "/em-uri/" + oid, headers=feed)
+        cache.size = cache.stats()["used"] - 1
+        cache.trim()
+        assert cache.stats()["entries"] == 1
+        assert self.request("GET", "/em-uri/" + oid, headers=feed)["status"] == "200 OK"
+        cache.max_age = -1
+        cache.trim()
+        assert cache.stats()["entries"] == 0
+
+        # or when their container is removed
+        self.request("GET", "/em-uri/" + oid, headers=feed)
+        assert cache.stats()["entries"] == 1
+        self.request("DELETE", "/edit-uri/" + oid, headers={"Authorization" : AUTH})
+        assert cache.stats()["entries"] == 0
+
+        # and without the cache, the package is made for each request
+        del self.webpy.config.cfg["package_cache_dir"]
+        r = self.request("POST", "/col-uri/" + self.collection, "first", binary)
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})
+        assert len(ZipFile(StringIO(r["body"])).namelist()) == 1
+        assert DAO.package_cache is None
+
+    def test_11_streamed_package(self):
+        with open(os.path.join(self.cwd, "tests", "resources", "example.zip"), "rb") as f:
+            package = f.read()
+        r = self.request("POST", "/col-uri/" + self.collection, package, {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+        })
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+
+        # the package is sent as it is made, a chunk at a time
+        self.webpy.config.cfg["stream_packages"] = True
+        env = {"REQUEST_METHOD" : "GET", "PATH_INFO" : "/em-uri/" + oid, "QUERY_STRING" : "", "HTTP_HOST" : "localhost:8080",
+                "wsgi.input" : StringIO(""), "wsgi.url_scheme" : "http", "HTTP_AUTHORIZATION" : AUTH}
+        chunks = list(self.webpy.application(env, lambda status, headers: None))
+        assert len(chunks) > 1
+        streamed = "".join(chunks)
+        z = ZipFile(StringIO(streamed))
+        assert z.testzip() is None
+        assert "mets.xml" in z.namelist()
+
+        # and kept for the next request, once it has all been sent
+        hits = DAO.package_cache.hits
+        assert self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"] == streamed
+        assert DAO.package_cache.hits == hits + 1
+
+        # while a package made before it is sent has the same content
+        del self.webpy.config.cfg["package_cache_dir"]
+        self.webpy.config.cfg["stream_packages"] = False
+        made = ZipFile(StringIO(self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"]))
+        assert made.namelist() == z.namelist()
+        assert [made.read(n) for n in made.namelist()] == [z.read(n) for n in z.namelist()]
+
+    def test_12_package_copied_from_deposit(self):
+        with open(os.path.join(self.cwd, "tests", "resources", "example.zip"), "rb") as f:
+            package = f.read()
+        original = ZipFile(StringIO(package))
+        r = self.request("POST", "/col-uri/" + self.collection, package, {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+        })
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+
+        # the files unpacked from the deposit are copied from it still compressed, whether the package is streamed
+        # or not, while the deposit itself is stored
+        for stream in [True, False]:
+            self.webpy.config.cfg["stream_packages"] = stream
+            del self.webpy.config.cfg["package_cache_dir"]
+            z = ZipFile(StringIO(self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"]))
+            assert z.testzip() is None
+            for info in original.infolist():
+                copied = z.getinfo(info.filename)
+                assert (copied.compress_type, copied.compress_size, copied.CRC) == (info.compress_type, info.compress_size, info.CRC)
+                assert z.read(info.filename) == original.read(info.filename)
+            assert [info.compress_type for info in z.infolist() if info.filename.endswith("example.zip")] == [0]
+            self.webpy.config.cfg = dict(self.config)
+
+        # except a file which has been written since, even with the same number of bytes
+        collection, id = oid.split("/")
+        dao = webpy.SwordServer(webpy.config, None).dao
+        changed = "x" * original.getinfo("mets.xml").file_size
+        with dao.transaction(collection, id):
+            dao.store_file(collection, id, "mets.xml", changed)
+        z = ZipFile(StringIO(self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"]))
+        assert z.read("mets.xml") == changed
+        assert z.getinfo("pdf1.pdf").compress_size == original.getinfo("pdf1.pdf").compress_size
+
+        # but not once there is more than one deposit
+        r = self.request("POST", "/em-uri/" + oid, "more", {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=more.bin"
+        })
+        z = ZipFile(StringIO(self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH})["body"]))
+        assert z.getinfo("mets.xml").compress_type == 0
+        assert z.read("mets.xml") == changed
+
+    def test_13_parallel_packages(self):
+        with open(os.path.join(self.cwd, "tests", "resources", "example.zip"), "rb") as f:
+            package = f.read()
+        original = ZipFile(StringIO(package))
+        r = self.request("POST", "/col-uri/" + self.collection, package, {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/zip",
+            "Content-Disposition" : "attachment; filename=example.zip",
+            "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+        })
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+        self.webpy.config.cfg["package_compression_workers"] = 2
+
+        # the content can be had as a tar.gz
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH, "Accept" : "application/gzip"})
+        assert r["headers"]["Content-Type"] == "application/gzip"
+        t = tarfile.open(fileobj=StringIO(r["body"]), mode="r:gz")
+        deposit = [name for name in t.getnames() if name.endswith("example.zip")][0]
+        assert t.extractfile(deposit).read() == package
+        for name in original.namelist():
+            assert t.extractfile(name).read() == original.read(name)
+
+        # and as a zip deflated in parallel, still copying the files unpacked from the deposit as they are
+        r = self.request("GET", "/em-uri/" + oid, headers={"Authorization" : AUTH, "Accept" : "application/x-zip-compressed"})
+        assert r["headers"]["Content-Type"] == "application/x-zip-compressed"
+        z = ZipFile(StringIO(r["body"]))
+        assert z.testzip() is None
+        assert z.read(deposit) == package
+        assert z.getinfo(deposit).compress_type == ZIP_DEFLATED
+        for info in original.infolist():
+            assert z.getinfo(info.filename).compress_size == info.compress_size
+
+    def test_14_file_responses(self):
+        content = "".join([chr(i % 256) for i in range(100000)])
+        r = self.request("POST", "/col-uri/" + self.collection, content, {
+            "Authorization" : AUTH,
+            "Content-Type" : "application/octet-stream",
+            "Content-Disposition" : "attachment; filename=content.bin"
+        })
+        oid = r["headers"]["Location"].split("/edit-uri/")[1]
+        collection, id = oid.split("/")
+        name = webpy.SwordServer(webpy.config, None).dao.list_content(collection, id)[0]
+
+        # a part is sent a chunk at a time, with its length from the file
+        r = self.request("GET", "/part-uri/" + oid + "/" + name)
+        assert r["body"] == content
+        assert r["headers"]["Content-Length"] == "100000"
+
+        # unless the server has a file_wrapper, which it is handed to as it is (to send with sendfile), and which
+        # closes it once it has been sent
+        wrapped = []
+        class Wrapper(FileWrapper):
+            def __init__(self, f, blksize=8192):
+                FileWrapper.__init__(self, f, blksize)
+                wrapped.append(f)
+        def get(path):
+            env = {"REQUEST_METHOD" : "GET", "PATH_INFO" : path, "QUERY_STRING" : "", "HTTP_HOST" : "localhost:8080",
+                    "wsgi.input" : StringIO(""), "wsgi.url_scheme" : "http", "wsgi.file_wrapper" : Wrapper}
+            response = {}
+            def start_response(status, headers):
+                response["headers"] = dict(headers)
+            response["body"] = self.webpy.application(env, start_response)
+            return response
+        r = get("/part-uri/" + oid + "/" + name)
+        assert isinstance(r["body"], Wrapper)
+        assert r["headers"]["Content-Length"] == "100000"
+        assert "".join(r["body"]) == content
+        r["body"].close()
+        assert wrapped[0].closed
+
+        # as is a package, once it has been kept in the package cache
+        made = get("/cont-uri/" + oid)
+        assert not isinstance(made["body"], Wrapper) and "Content-Length" not in made["headers"]
+        package = "".join(made["body"])
+        r = get("/cont-uri/" + oid)
+        assert isinstance(r["body"], Wrapper)
+        assert r["headers"]["Content-Length"] == str(len(package))
+        assert "".join(r["body"]) == package
+        r["body"].close()
+
+    def test_15_manifest_written_once(self):
+        self.webpy.config.cfg["deduplicate"] = True
+        package = StringIO()
+        z = ZipFile(package, "w")
+        for i in range(50):
+            z.writestr("file" + str(i) + ".txt", "content of file " + str(i))
+        z.close()
+
+        # however many files are unpacked from a zip, the manifest and the record of what was unpacked are each
+        # written once, when the deposit is committed
+        written = []
+        put_blob = FilesystemBackend.put_blob
+        def counting_put_blob(backend, collection, id, name, content):
+            written.append(name.split("/")[-1])
+            return put_blob(backend, collection, id, name, content)
+        FilesystemBackend.put_blob = counting_put_blob
+        try:
+            r = self.request("POST", "/col-uri/" + self.collection, package.getvalue(), {
+                "Authorization" : AUTH,
+                "Content-Type" : "application/zip",
+                "Content-Disposition" : "attachment; filename=many.zip",
+                "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+            })
+        finally:
+            FilesystemBackend.put_blob = put_blob
+        assert r["status"] == "201 Created"
+        assert written.count(MANIFEST) == 1
+        assert written.count(UNPACKED) == 1
+
+        # and they hold every file
+        collection, id = r["headers"]["Location"].split("/edit-uri/")[1].split("/")
+        dao = self.webpy.SwordServer(self.webpy.config, None).dao
+        assert len(dao.get_manifest(collection, id)) == 51
+        assert len(dao.get_unpacked(collection, id)["members"]) == 50
+        assert dao._read(collection, id, "file49.txt") == "content of file 49"
+
+        # as they are when the same files are deposited in the container again, replacing those already unpacked
+        del written[:]
+        FilesystemBackend.put_blob = counting_put_blob
+        try:
+            r = self.request("POST", "/em-uri/" + collection + "/" + id, package.getvalue(), {
+                "Authorization" : AUTH,
+                "Content-Type" : "application/zip",
+                "Content-Disposition" : "attachment; filename=again.zip",
+                "Packaging" : "http://purl.org/net/sword/package/SimpleZip"
+            })
+        finally:
+            FilesystemBackend.put_blob = put_blob
+        assert r["status"] == "201 Created"
+        assert (written.count(MANIFEST), written.count(UNPACKED)) == (1, 1)
+        unpacked = dao.get_unpacked(collection, id)
+        assert unpacked["package"] != "many.zip"
+        assert len(unpacked["members"]) == 50